@@ -0,0 +1,344 @@
+import asyncio
+import contextlib
+import functools
+import time
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse as StarletteJSONResponse
+from starlette.routing import Mount, Route
+
+import jsonlib
+import logs
+import metrics
+import prpr
+import settings
+import compress
+from converter import convert_receipt
+from token_cache import LoginError
+
+# asyncio serving mode for prpr: same /process and /process/batch contract,
+# upstream calls go through a shared httpx connection pool per upstream, so a
+# worker is not tied up while waiting for vdpaybox. Swagger UI and the apispec
+# are served by the mounted Flask app. Run with: uvicorn asgi:app
+
+# upstream name -> (routing.Upstream, httpx.AsyncClient)
+clients = {}
+# Pools of upstreams replaced by a routing reload; requests may still be using
+# them, so each is closed once its longest delivery has passed
+retired = []
+_closing = set()
+
+class JSONResponse(StarletteJSONResponse):
+    """JSONResponse encoded with jsonlib (orjson when available)."""
+
+    def render(self, content):
+        return jsonlib.dumps(content)
+
+def make_client(options):
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            options["read_timeout"],
+            connect=options["connect_timeout"],
+            pool=settings.ASYNC_POOL_TIMEOUT,
+        ),
+        limits=httpx.Limits(
+            max_connections=options["async_pool_size"],
+            max_keepalive_connections=options["async_pool_size"],
+        ),
+        # httpx only retries failed connects, so the receipt POST is never sent twice
+        transport=httpx.AsyncHTTPTransport(retries=options["retries"]),
+    )
+
+def retire(upstream, client):
+    async def close():
+        await asyncio.sleep(upstream.delivery_time)
+        if client in retired:
+            retired.remove(client)
+            await client.aclose()
+
+    retired.append(client)
+    task = asyncio.get_running_loop().create_task(close())
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+def client_for(upstream):
+    entry = clients.get(upstream.name)
+    if entry is not None and entry[0] is upstream:
+        return entry[1]
+    if entry is not None:
+        retire(*entry)
+    # Upstreams the routing table no longer has at all
+    for name, (old, client) in list(clients.items()):
+        if name != upstream.name and prpr.router.upstreams.get(name) is not old:
+            del clients[name]
+            retire(old, client)
+    client = make_client(upstream.options)
+    clients[upstream.name] = (upstream, client)
+    return client
+
+async def login(auth_header, upstream):
+    key = prpr.token_key(upstream, auth_header)
+    prpr.credentials.check(key)
+    breaker = upstream.breakers["token"]
+    async with upstream.limiter.aslot():
+        breaker.before()
+        started = time.perf_counter()
+        try:
+            response = await client_for(upstream).get(upstream.token_url, headers={"Authorization": auth_header})
+        except httpx.HTTPError as e:
+            breaker.after(started, error=e)
+            metrics.observe_upstream("token", started, error=e)
+            raise
+        except BaseException:
+            # Cancelled or failed before an answer; frees a half-open probe
+            breaker.abandon()
+            raise
+        breaker.after(started, response)
+        metrics.observe_upstream("token", started, response)
+    try:
+        return prpr.token_from_response(response)
+    except LoginError as e:
+        prpr.credentials.reject(key, e)
+        raise
+
+async def get_token(auth_header):
+    upstream = prpr.route(auth_header)
+    return await prpr.token_cache.aget(prpr.token_key(upstream, auth_header), lambda: login(auth_header, upstream))
+
+async def send_receipt(data, token, upstream):
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    breaker = upstream.breakers["receipt"]
+    async with upstream.limiter.aslot():
+        breaker.before()
+        started = time.perf_counter()
+        try:
+            response = await client_for(upstream).post(
+                upstream.receipt_url, content=prpr.receipt_body(data, upstream, headers), headers=headers
+            )
+        except httpx.HTTPError as e:
+            breaker.after(started, error=e)
+            metrics.observe_upstream("receipt", started, error=e)
+            raise
+        except BaseException:
+            # Cancelled or failed before an answer; frees a half-open probe
+            breaker.abandon()
+            raise
+        breaker.after(started, response)
+        metrics.observe_upstream("receipt", started, response)
+    return response
+
+async def forward_receipt(data, auth_header, token):
+    upstream = prpr.route(auth_header)
+    with metrics.timed("throttle"):
+        await upstream.limiter.athrottle(prpr.rate_key(data, auth_header))
+    response = await send_receipt(data, token, upstream)
+
+    if response.status_code == 401:
+        prpr.token_cache.invalidate(prpr.token_key(upstream, auth_header), token)
+        token, orgid = await get_token(auth_header)
+        if orgid is not None:
+            data["orgId"] = orgid
+        response = await send_receipt(data, token, prpr.route(auth_header))
+    return response
+
+async def deliver(data, auth_header, token, passthrough=False):
+    async def send():
+        response = await forward_receipt(data, auth_header, token)
+        return response.status_code, prpr.response_body(response, passthrough)
+
+    upstream = prpr.route(auth_header)
+    key = prpr.idempotency_key(upstream, data, auth_header)
+    if prpr.idempotency is None or key is None:
+        return await send() + (False,)
+    return await prpr.idempotency.arun(key, send, lease=upstream.delivery_time)
+
+UPSTREAM_ERRORS = prpr.UPSTREAM_ERRORS + (httpx.HTTPError,)
+
+def error_response(error, message):
+    status, body, headers = prpr.upstream_error(error, message)
+    return JSONResponse(body, status, headers=headers)
+
+def check_auth(request):
+    auth_header = request.headers.get('Authorization')
+    with metrics.timed("auth"):
+        username, password = prpr.check_basic_auth(auth_header)
+    return auth_header, username
+
+async def authenticate(auth_header, username):
+    try:
+        with metrics.timed("token"):
+            token, orgid = await get_token(auth_header)
+    except LoginError as e:
+        prpr.log_login_failure(username, e)
+        raise
+    return token, orgid
+
+async def read_json(request):
+    with metrics.timed("parse"):
+        body = await request.body()
+        coding = request.headers.get("content-encoding", "").strip()
+        if coding and coding.lower() != "identity":
+            body = compress.decode(body, coding, settings.DECOMPRESS_MAX_SIZE)
+        try:
+            return jsonlib.loads(body)
+        except ValueError:
+            return None
+
+def compress_response(request, response):
+    response.headers.add_vary_header("Accept-Encoding")
+    coding = compress.negotiate(request.headers.get("accept-encoding"))
+    if coding is None or len(response.body) < settings.COMPRESS_MIN_SIZE:
+        return
+    response.body = compress.encode(response.body, coding)
+    response.headers["Content-Encoding"] = coding
+    response.headers["Content-Length"] = str(len(response.body))
+
+def instrumented(endpoint):
+    """Count the response and attach Server-Timing like the Flask app does."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            rid = logs.new_request_id(request.headers.get("X-Request-ID"))
+            prpr.check_config()
+            metrics.begin_request()
+            length = request.headers.get("content-length")
+            if length and length.isdigit():
+                metrics.payload_bytes.observe(int(length), endpoint)
+            try:
+                response = await handler(request)
+            except compress.DecodeError as e:
+                response = JSONResponse({"error": str(e)}, e.status_code)
+            metrics.requests_total.inc(endpoint, str(response.status_code))
+            response.headers["X-Request-ID"] = rid
+            if settings.SERVER_TIMING:
+                timings = metrics.stage_timings()
+                if timings:
+                    response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+            if settings.RESPONSE_COMPRESSION:
+                compress_response(request, response)
+            return response
+        return wrapper
+    return decorator
+
+@instrumented("process")
+async def process(request):
+    input_data = await read_json(request)
+    if not isinstance(input_data, dict):
+        return JSONResponse({"error": "Body should be a JSON object"}, 400)
+
+    try:
+        auth_header, username = check_auth(request)
+    except LoginError as e:
+        return JSONResponse(e.body, e.status_code)
+
+    errors = prpr.validate_receipt(input_data)
+    if errors:
+        return JSONResponse({"error": "Receipt validation failed", "errors": errors}, 422)
+
+    if prpr.delivery_queue is not None:
+        queued = await asyncio.to_thread(prpr.queue_receipt, input_data, auth_header)
+        # GET /process/<id> is served by the mounted Flask app
+        location = "/process/%s" % queued["id"]
+        return JSONResponse({"id": queued["id"], "status": queued["status"]}, 202, headers={"Location": location})
+
+    try:
+        token, orgid = await authenticate(auth_header, username)
+    except UPSTREAM_ERRORS as e:
+        return error_response(e, "Failed to get token")
+
+    prpr.observe_items(input_data)
+    with metrics.timed("convert"):
+        cleaned_target_data = convert_receipt(input_data, orgid)
+    prpr.observe_conversion(input_data, orgid, cleaned_target_data)
+
+    try:
+        with metrics.timed("deliver"):
+            status, body, replayed = await deliver(
+                cleaned_target_data, auth_header, token, settings.PASSTHROUGH_RESPONSE
+            )
+    except UPSTREAM_ERRORS as e:
+        return error_response(e, "Failed to send receipt data")
+
+    prpr.log_delivery(status, body, replayed, cleaned_target_data)
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return JSONResponse(body, status, headers=headers)
+
+async def process_batch_item(input_data, auth_header, token, orgid, semaphore):
+    try:
+        cleaned_target_data = prpr.convert_batch_item(input_data, orgid)
+    except ValueError as e:
+        return {"status": 400, "error": str(e)}
+    async with semaphore:
+        try:
+            status, body, replayed = await deliver(cleaned_target_data, auth_header, token)
+        except UPSTREAM_ERRORS as e:
+            return prpr.batch_error(e)
+    return prpr.batch_item_result(status, body, replayed, cleaned_target_data)
+
+@instrumented("process_batch")
+async def process_batch(request):
+    input_data = await read_json(request)
+    if not isinstance(input_data, list):
+        return JSONResponse({"error": "Body should be a list of receipts"}, 400)
+    if len(input_data) > settings.BATCH_MAX_SIZE:
+        return JSONResponse({"error": "Batch is too large"}, 413)
+
+    try:
+        auth_header, username = check_auth(request)
+    except LoginError as e:
+        return JSONResponse(e.body, e.status_code)
+
+    invalid = prpr.validate_batch(input_data)
+    if len(invalid) == len(input_data):
+        return JSONResponse({"results": [invalid[i] for i in range(len(input_data))]}, 200)
+
+    if prpr.delivery_queue is not None:
+        # Queued without logging in, like /process
+        results = await asyncio.to_thread(lambda: [
+            invalid[index] if index in invalid else prpr.queue_batch_item(receipt, auth_header)
+            for index, receipt in enumerate(input_data)
+        ])
+        return JSONResponse({"results": results}, 200)
+
+    try:
+        token, orgid = await authenticate(auth_header, username)
+    except UPSTREAM_ERRORS as e:
+        return error_response(e, "Failed to get token")
+
+    async def run(index, receipt):
+        if index in invalid:
+            return invalid[index]
+        return await process_batch_item(receipt, auth_header, token, orgid, semaphore)
+
+    semaphore = asyncio.Semaphore(settings.BATCH_CONCURRENCY)
+    results = await asyncio.gather(*(
+        run(index, receipt) for index, receipt in enumerate(input_data)
+    ))
+    return JSONResponse({"results": list(results)}, 200)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    try:
+        yield
+    finally:
+        for task in list(_closing):
+            task.cancel()
+        for client in [client for _, client in clients.values()] + retired:
+            await client.aclose()
+        clients.clear()
+        del retired[:]
+
+app = Starlette(
+    routes=[
+        Route('/process', process, methods=['POST']),
+        Route('/process/batch', process_batch, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(prpr.app)),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app)
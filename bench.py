@@ -0,0 +1,229 @@
+import argparse
+import base64
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import converter
+import jsonlib
+import stub_upstream
+
+# Benchmarks for the /process conversion and request path.
+#
+#   python bench.py                      # everything
+#   python bench.py --only convert json  # skip the request cycle
+#   python bench.py --iterations 2000 > bench_output.txt
+#   python bench.py --only startup       # worker boot time per SWAGGER mode
+#
+# Each case reports throughput and p50/p99 latency per call. Receipts are
+# synthetic but deterministic, so numbers are comparable between runs.
+
+def make_item(n, dense=True, agent=False, mark=False):
+    item = {
+        "name": "Товар %d" % n,
+        "price": 120 + n % 7,
+        "quantity": 1.0,
+        "sum": 120 + n % 7,
+        "measure": 0,
+        "payment_method": "full_payment",
+        "payment_object": 1 + n % 27,
+        "vat": {"type": "vat20", "sum": 20.0},
+    }
+    if dense:
+        item.update({
+            "user_data": "Дополнительный реквизит предмета расчета",
+            "excise": 10.0,
+            "country_code": "056",
+            "declaration_number": "12332234533",
+            "supplier_info": {"phones": ["+79998887766"], "name": "Название поставщика", "inn": "287381373424"},
+        })
+    if agent:
+        item["agent_info"] = {
+            "type": "another",
+            "paying_agent": {"operation": "Операция 1", "phones": ["+79998887766"]},
+            "receive_payments_operator": {"phones": ["+79998887766"]},
+            "money_transfer_operator": {
+                "phones": ["+79998887766"],
+                "name": "Оператор перевода",
+                "address": "г. Москва, ул. Складочная д.3",
+                "inn": "8634330204",
+            },
+        }
+    if mark:
+        item["mark_code"] = {"egais20": base64.b64encode(("mark-%08d" % n).encode() * 8).decode()}
+    return item
+
+def make_receipt(items=1, dense=True, agent=False, mark=False):
+    receipt = {
+        "external_id": "892924433534522515289444",
+        "receipt": {
+            "company": {"email": "email@ofd.ru", "sno": "osn", "inn": "5010051677", "payment_address": "shop-url.ru"},
+            "items": [make_item(n, dense, agent, mark) for n in range(items)],
+            "payments": [{"type": 1, "sum": 120.0 * items}],
+            "total": 120.0 * items,
+        },
+    }
+    if dense:
+        receipt["device_number"] = "KKT014034"
+        receipt["receipt"].update({
+            "client": {
+                "email": "client@client.ru",
+                "phone": "+70002410085",
+                "name": "Иванов Иван Иванович",
+                "inn": "516974792202",
+                "address": "г.Москва, Ленинский проспект д.1 кв 43",
+            },
+            "vats": [{"type": "vat20", "sum": 20.0 * items}],
+            "cashier": "кассир",
+            "cashier_inn": "887405485310",
+        })
+    return receipt
+
+SHAPES = {
+    "1-item": make_receipt(1),
+    "sparse-50": make_receipt(50, dense=False),
+    "dense-50": make_receipt(50),
+    "heavy-agent-mark": make_receipt(50, agent=True, mark=True),
+    "1000-items": make_receipt(1000),
+}
+
+def measure(func, iterations, warmup=None):
+    for _ in range(warmup if warmup is not None else max(1, iterations // 10)):
+        func()
+    timings = []
+    clock = time.perf_counter_ns
+    started = clock()
+    for _ in range(iterations):
+        t = clock()
+        func()
+        timings.append(clock() - t)
+    total = (clock() - started) / 1e9
+    timings.sort()
+    return {
+        "ops": iterations / total if total else float("inf"),
+        "p50": timings[len(timings) // 2] / 1e6,
+        "p99": timings[min(len(timings) - 1, int(len(timings) * 0.99))] / 1e6,
+        "mean": statistics.fmean(timings) / 1e6,
+    }
+
+def report(group, name, result):
+    print("%-8s %-28s %12.1f ops/s  p50 %9.3f ms  p99 %9.3f ms" % (
+        group, name, result["ops"], result["p50"], result["p99"]))
+    sys.stdout.flush()
+
+def scaled(iterations, receipt):
+    # Keep big receipts from dominating the run time
+    items = len(receipt["receipt"]["items"])
+    return max(20, iterations * 10 // max(10, items))
+
+def bench_convert(iterations):
+    for shape, receipt in SHAPES.items():
+        n = scaled(iterations, receipt)
+        report("convert", shape, measure(lambda: converter.convert_receipt(receipt, "org"), n))
+        report("convert", shape + " (reference)", measure(
+            lambda: converter.remove_empty_fields(converter.build_target_data(receipt, "org")), n))
+        converted = converter.convert_receipt(receipt, "org")
+        report("convert", shape + " (reverse)", measure(lambda: converter.convert_to_atol(converted), n))
+
+    item = make_item(1, agent=True, mark=True)
+    for func in (converter.transform_measure, converter.transform_payment_method,
+                 converter.transform_payment_object, converter.transform_marking_code,
+                 converter.transform_agent):
+        report("helper", func.__name__, measure(lambda: func(item), iterations * 10))
+
+def bench_json(iterations):
+    for shape, receipt in SHAPES.items():
+        n = scaled(iterations, receipt)
+        raw = json.dumps(receipt, ensure_ascii=False).encode("utf-8")
+        converted = converter.convert_receipt(receipt, "org")
+        report("json", shape + " loads", measure(lambda: json.loads(raw), n))
+        report("json", shape + " dumps", measure(lambda: json.dumps(converted).encode("utf-8"), n))
+        if jsonlib.BACKEND != "json":
+            report("json", "%s loads (%s)" % (shape, jsonlib.BACKEND), measure(lambda: jsonlib.loads(raw), n))
+            report("json", "%s dumps (%s)" % (shape, jsonlib.BACKEND), measure(lambda: jsonlib.dumps(converted), n))
+
+def bench_request(iterations):
+    server = stub_upstream.start()
+    # settings is already loaded through jsonlib, so override it directly;
+    # setting UPSTREAM_BASE_URL in the environment here would be too late
+    import settings
+    settings.UPSTREAM_BASE_URL = "http://127.0.0.1:%d" % server.server_port
+    # A routing table would send the synthetic receipts to real upstreams
+    settings.UPSTREAMS_PATH = ""
+    # Every call reuses the same external_id; measure delivery, not replay
+    if "IDEMPOTENCY_BACKEND" not in os.environ:
+        settings.IDEMPOTENCY_BACKEND = "off"
+    import prpr
+    # Route everything to the stub even if prpr was imported before the overrides
+    prpr.router.load({})
+
+    client = prpr.app.test_client()
+    headers = {
+        "Authorization": "Basic " + base64.b64encode(b"bench:bench").decode(),
+        "Content-Type": "application/json",
+    }
+    try:
+        for shape, receipt in SHAPES.items():
+            n = scaled(iterations, receipt) // 2
+            raw = json.dumps(receipt, ensure_ascii=False).encode("utf-8")
+
+            def call():
+                response = client.post("/process", data=raw, headers=headers)
+                assert response.status_code == 200, response.status_code
+            report("request", shape, measure(call, max(10, n)))
+    finally:
+        server.shutdown()
+
+STARTUP = """
+import time
+started = time.perf_counter()
+import prpr
+prpr.app.test_client().get("/health")
+print(time.perf_counter() - started)
+"""
+
+def bench_startup(iterations):
+    # Import to first answered request in a fresh interpreter: what every
+    # worker pays when the app is not preloaded in the master
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = max(3, iterations // 100)
+    with tempfile.TemporaryDirectory() as tmp:
+        spec_path = os.path.join(tmp, "openapi.json")
+        subprocess.run([sys.executable, "openapi.py", "-o", spec_path], cwd=here, check=True, capture_output=True)
+        for mode in ("on", "static", "off"):
+            env = dict(os.environ, SWAGGER=mode, OPENAPI_SPEC_PATH=spec_path)
+            timings = []
+            for _ in range(runs):
+                out = subprocess.run([sys.executable, "-c", STARTUP], cwd=here, env=env,
+                                     check=True, capture_output=True, text=True)
+                timings.append(float(out.stdout.split()[-1]) * 1000)
+            timings.sort()
+            report("startup", "SWAGGER=" + mode, {
+                "ops": 1000 / statistics.fmean(timings),
+                "p50": timings[len(timings) // 2],
+                "p99": timings[-1],
+                "mean": statistics.fmean(timings),
+            })
+
+BENCHMARKS = {
+    "convert": bench_convert,
+    "json": bench_json,
+    "request": bench_request,
+    "startup": bench_startup,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the /process conversion and request path")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--iterations", type=int, default=1000, help="base iteration count per case")
+    args = parser.parse_args(argv)
+
+    for name in args.only or BENCHMARKS:
+        BENCHMARKS[name](args.iterations)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque
+
+# Circuit breaker for upstream calls. While the upstream fails or crawls,
+# callers are refused at once instead of tying up workers until a timeout.
+#
+# closed:    calls go through; the last ``window`` outcomes are kept and the
+#            breaker opens once the failure or slow-call rate crosses its limit.
+# open:      calls fail with CircuitOpen for ``open_seconds``.
+# half_open: up to ``probes`` calls go through. One failure reopens the
+#            breaker, ``probes`` successes close it. A probe that has not
+#            reported back within ``open_seconds`` is written off, so a lost
+#            probe cannot keep the breaker half open for good.
+#
+# A failure is a connection error, timeout or 5xx. A rate of 0 disables
+# that threshold. State is per process.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpen(Exception):
+    """The upstream is considered down; retry after ``retry_after`` seconds."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(name)
+        self.name = name
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    def __init__(self, name, window=20, min_calls=10, failure_rate=0.5,
+                 slow_call=5.0, slow_rate=0.8, open_seconds=15.0, probes=3):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = 0
+        self._probe_successes = 0
+        self._probed_at = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def before(self):
+        """Admit a call or raise CircuitOpen."""
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpen(self.name, remaining)
+                self.state = HALF_OPEN
+                self._probing = 0
+                self._probe_successes = 0
+            if self.state == HALF_OPEN:
+                now = time.monotonic()
+                if self._probing >= self.probes and now - self._probed_at >= self.open_seconds:
+                    self._probing = 0
+                if self._probing >= self.probes:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpen(self.name, self.open_seconds)
+                self._probing += 1
+                self._probed_at = now
+
+    def abandon(self):
+        """Release a call admitted by before() that ended without an outcome,
+        e.g. cancelled or failed before reaching the upstream."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probing:
+                self._probing -= 1
+
+    def after(self, started, response=None, error=None):
+        """Record the outcome of a call admitted by before(); ``started`` is a
+        time.perf_counter() value as for metrics.observe_upstream()."""
+        failed = error is not None or response.status_code >= 500
+        slow = time.perf_counter() - started >= self.slow_call
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = max(0, self._probing - 1)
+                if failed or slow:
+                    self._open()
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.probes:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self.state == OPEN:
+                # Admitted before the breaker opened
+                return
+            self._outcomes.append((failed, slow))
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for f, _ in self._outcomes if f)
+            slow_calls = sum(1 for _, s in self._outcomes if s)
+            if (self.failure_rate and failures >= self.failure_rate * calls
+                    or self.slow_rate and slow_calls >= self.slow_rate * calls):
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.stats["opened"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            state = self.state
+            remaining = self._opened_at + self.open_seconds - time.monotonic()
+            if state == OPEN and remaining <= 0:
+                # The next call is let through as a probe
+                state = HALF_OPEN
+            info = {"state": state, "calls": len(self._outcomes)}
+            if state == OPEN:
+                info["retry_after"] = round(remaining, 3)
+            elif state == HALF_OPEN:
+                info["probes"] = self._probing if self.state == HALF_OPEN else 0
+            return info
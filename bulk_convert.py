@@ -0,0 +1,126 @@
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+import jsonlib
+from converter import convert_receipt, convert_to_atol
+
+# Offline conversion of archived ATOL receipts (one JSON object per line) into
+# the vdpaybox receipt format, using the same mapping as /process.
+#
+#   python bulk_convert.py archive.jsonl -o converted.jsonl --errors rejects.jsonl
+#   zcat archive.jsonl.gz | python bulk_convert.py - --workers 8 > converted.jsonl
+#   python bulk_convert.py fetched.jsonl --reverse -o atol.jsonl
+
+def convert_line(line, orgid=None, body_only=False, reverse=False):
+    try:
+        input_data = jsonlib.loads(line)
+    except ValueError as e:
+        raise ValueError("Invalid JSON: %s" % e)
+    if not isinstance(input_data, dict):
+        raise ValueError("Receipt should be an object")
+    try:
+        if reverse:
+            return jsonlib.dumps(convert_to_atol(input_data)).decode("utf-8")
+        converted = convert_receipt(input_data, orgid)
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ValueError("Failed to convert receipt: %s" % e)
+    if body_only:
+        converted = converted["receiptBody"]
+    return jsonlib.dumps(converted).decode("utf-8")
+
+def convert_chunk(chunk, orgid=None, body_only=False, reverse=False):
+    results = []
+    for lineno, line in chunk:
+        try:
+            results.append((lineno, True, convert_line(line, orgid, body_only, reverse)))
+        except ValueError as e:
+            results.append((lineno, False, str(e)))
+    return results
+
+def read_chunks(lines, chunk_size):
+    numbered = ((lineno, line) for lineno, line in enumerate(lines, 1) if line.strip())
+    while True:
+        chunk = list(itertools.islice(numbered, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def convert_stream(lines, out, errors, workers=1, chunk_size=500, orgid=None, body_only=False, reverse=False):
+    """Convert JSONL lines into out, keeping input order. Returns (converted, rejected)."""
+    counts = [0, 0]
+
+    def write(chunk, results):
+        source = None
+        for lineno, ok, text in results:
+            if ok:
+                out.write(text + "\n")
+                counts[0] += 1
+                continue
+            counts[1] += 1
+            if errors is None:
+                continue
+            if source is None:
+                source = dict(chunk)
+            errors.write(json.dumps(
+                {"line": lineno, "error": text, "input": source[lineno].rstrip("\n")},
+                ensure_ascii=False
+            ) + "\n")
+
+    chunks = read_chunks(lines, chunk_size)
+    if workers <= 1:
+        for chunk in chunks:
+            write(chunk, convert_chunk(chunk, orgid, body_only, reverse))
+        return tuple(counts)
+
+    # Only a bounded number of chunks is in flight, so memory does not grow
+    # with the size of the input.
+    with multiprocessing.Pool(workers) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(convert_chunk, (chunk, orgid, body_only, reverse))))
+            if len(pending) >= workers * 2:
+                done, result = pending.popleft()
+                write(done, result.get())
+        while pending:
+            done, result = pending.popleft()
+            write(done, result.get())
+    return tuple(counts)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert ATOL receipts (JSONL) into the vdpaybox format")
+    parser.add_argument("input", help="JSONL file with ATOL receipts, or - for stdin")
+    parser.add_argument("-o", "--output", help="output JSONL file (default: stdout)")
+    parser.add_argument("--errors", help="JSONL file for rejected lines with the reason (default: stderr)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--chunk-size", type=int, default=500, help="lines per work unit")
+    parser.add_argument("--org-id", help="orgId to put into converted receipts")
+    parser.add_argument("--body-only", action="store_true", help="write only receiptBody")
+    parser.add_argument("--reverse", action="store_true", help="convert vdpaybox receipts back into ATOL format")
+    args = parser.parse_args(argv)
+
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    out = sys.stdout if not args.output else open(args.output, "w", encoding="utf-8")
+    errors = sys.stderr if not args.errors else open(args.errors, "w", encoding="utf-8")
+    try:
+        converted, rejected = convert_stream(
+            source, out, errors,
+            workers=args.workers,
+            chunk_size=args.chunk_size,
+            orgid=args.org_id,
+            body_only=args.body_only,
+            reverse=args.reverse,
+        )
+    finally:
+        for f in (source, out, errors):
+            if f not in (sys.stdin, sys.stdout, sys.stderr):
+                f.close()
+    print("converted %d, rejected %d" % (converted, rejected), file=sys.stderr)
+    return 1 if rejected else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+import glob
+import gzip
+import importlib
+import itertools
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import converter
+import jsonlib
+import logs
+
+# Checking a conversion change against real traffic.
+#
+# Capture: a sampled share of live conversions is written as (input, output)
+# pairs to gzipped JSON-lines segments, for replay.py to run through a new
+# build later. Shadow: a share of live conversions is also run through a
+# candidate transformer and differences are logged and counted; nothing from
+# the candidate is sent upstream. Both do their work on a background thread.
+
+log = logs.get_logger("shadow")
+
+class _Missing:
+    def __repr__(self):
+        return "<missing>"
+
+    __str__ = __repr__
+
+MISSING = _Missing()
+
+def load_transformer(spec):
+    """'module:function' -> the function, called like convert_receipt(input_data, orgid)."""
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name or "convert_receipt")
+
+def diff(expected, actual, limit=50):
+    """Structural differences as [(path, expected, actual)], at most ``limit``.
+    A key or list element present on one side only shows as MISSING."""
+    out = []
+    _diff(expected, actual, "", out, limit)
+    return out
+
+def _diff(a, b, path, out, limit):
+    if len(out) >= limit:
+        return
+    if isinstance(a, dict) and isinstance(b, dict):
+        for key in itertools.chain(a, (k for k in b if k not in a)):
+            _diff(a.get(key, MISSING), b.get(key, MISSING), "%s.%s" % (path, key) if path else key, out, limit)
+    elif isinstance(a, list) and isinstance(b, list):
+        for index, (x, y) in enumerate(itertools.zip_longest(a, b, fillvalue=MISSING)):
+            _diff(x, y, "%s[%d]" % (path, index), out, limit)
+    elif a != b or isinstance(a, bool) != isinstance(b, bool):
+        out.append((path or "$", a, b))
+
+def pattern(path):
+    """receiptBody.items[3].price -> receiptBody.items[].price, for counting by field."""
+    return re.sub(r"\[\d+\]", "[]", path)
+
+def read_capture(paths):
+    """Records from capture segments; directories are read oldest segment first.
+    A segment cut short by a crash yields what was flushed before it."""
+    for path in paths:
+        segments = sorted(glob.glob(os.path.join(path, "capture-*.jsonl.gz"))) if os.path.isdir(path) else [path]
+        for segment in segments:
+            with gzip.open(segment, "rb") as f:
+                try:
+                    for line in f:
+                        yield jsonlib.loads(line)
+                except (EOFError, OSError, ValueError):
+                    continue
+
+class _Background:
+    """Bounded queue drained by a daemon thread, restarted after a fork.
+    Jobs that do not fit in the queue are dropped, never waited for."""
+
+    def __init__(self, name, queue_size):
+        self.name = name
+        self.queue_size = queue_size
+        self.queue = None
+        self.stats = {"dropped": 0}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def count(self, result):
+        with self._lock:
+            self.stats[result] += 1
+
+    def submit(self, job):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(self.queue_size)
+                    threading.Thread(target=self._run, args=(self.queue,), name=self.name, daemon=True).start()
+                    self._pid = os.getpid()
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.count("dropped")
+
+    def _run(self, jobs):
+        while True:
+            try:
+                job = jobs.get(timeout=1)
+            except queue.Empty:
+                self.idle()
+                continue
+            try:
+                self.handle(job)
+            except Exception:
+                log.exception("%s failed" % self.name)
+
+    def idle(self):
+        pass
+
+class Capture(_Background):
+    """Writes sampled conversions to DIRECTORY/capture-<time>-<pid>.jsonl.gz,
+    starting a new segment after ``segment_size`` bytes of JSON and keeping
+    the newest ``keep`` segments across all workers. A worker holds a lock on
+    its open segment, so pruning never removes a segment still written to."""
+
+    def __init__(self, directory, sample, segment_size, keep, queue_size):
+        super().__init__("capture", queue_size)
+        self.directory = directory
+        self.sample = sample
+        self.segment_size = segment_size
+        self.keep = keep
+        self.stats["written"] = 0
+        self._raw = None
+        self._file = None
+        self._written = 0
+
+    def sampled(self):
+        return self.sample >= 1 or random.random() < self.sample
+
+    def record(self, input_data, output):
+        if self.sampled():
+            self.write(input_data, output)
+
+    def write(self, input_data, output):
+        # Serialized here: the output dict is changed again during delivery
+        self.submit(jsonlib.dumps({
+            "ts": round(time.time(), 3),
+            "mappings": converter.current_mappings().version,
+            "input": input_data,
+            "output": output,
+        }))
+
+    def handle(self, line):
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, "capture-%s-%d.jsonl.gz" % (
+                time.strftime("%Y%m%dT%H%M%S"), os.getpid()))
+            # Receipts carry customer contacts; keep the files private
+            self._raw = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "ab")
+            if fcntl is not None:
+                fcntl.flock(self._raw, fcntl.LOCK_EX)
+            self._file = gzip.GzipFile(fileobj=self._raw, mode="ab")
+            self._written = 0
+        self._file.write(line + b"\n")
+        self._written += len(line) + 1
+        self.count("written")
+        if self._written >= self.segment_size:
+            self._file.close()
+            self._raw.close()
+            self._file = self._raw = None
+            self.prune()
+
+    def idle(self):
+        if self._file is not None:
+            # Make what was written so far readable without closing the segment
+            self._file.flush()
+
+    def prune(self):
+        segments = sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl.gz")))
+        for path in segments[:max(0, len(segments) - self.keep)]:
+            if self._in_use(path):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _in_use(self, path):
+        """Whether another worker still has the segment open. A dead worker's
+        lock is gone with it. Without flock only our own segments are closed."""
+        if fcntl is None:
+            return not path.endswith("-%d.jsonl.gz" % os.getpid())
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+class Shadow(_Background):
+    """Runs ``percent`` % of live conversions through a candidate transformer
+    and compares its output with what was sent."""
+
+    def __init__(self, transformer, percent, queue_size):
+        super().__init__("shadow", queue_size)
+        self.transformer = load_transformer(transformer)
+        self.percent = percent
+        self.stats.update({"match": 0, "diff": 0, "error": 0})
+
+    def sampled(self):
+        return random.random() * 100 < self.percent
+
+    def offer(self, input_data, orgid, output):
+        if self.sampled():
+            self.compare(input_data, orgid, output)
+
+    def compare(self, input_data, orgid, output):
+        self.submit((input_data, orgid, jsonlib.dumps(output)))
+
+    def handle(self, job):
+        input_data, orgid, expected = job
+        extern_id = input_data.get("external_id") if isinstance(input_data, dict) else None
+        try:
+            actual = jsonlib.loads(jsonlib.dumps(self.transformer(input_data, orgid)))
+        except Exception as e:
+            self.count("error")
+            log.warning("Shadow conversion failed", extra={"fields": {"extern_id": extern_id, "error": repr(e)}})
+            return
+        differences = diff(jsonlib.loads(expected), actual, limit=20)
+        if not differences:
+            self.count("match")
+            return
+        self.count("diff")
+        log.warning("Shadow conversion differs", extra={"fields": {
+            "extern_id": extern_id,
+            "differences": [
+                {"path": path, "live": _redacted(path, live), "candidate": _redacted(path, candidate)}
+                for path, live, candidate in differences
+            ],
+        }})
+
+def _redacted(path, value):
+    field = re.split(r"[.\[]", path)[-1]
+    return logs.redact({field: value})[field]
@@ -0,0 +1,158 @@
+import gzip
+import io
+import zlib
+
+from werkzeug.wsgi import get_input_stream
+
+import jsonlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content-Encoding support. gzip and zstd request bodies are inflated while
+# they are read, with a cap on the decoded size; responses are compressed for
+# clients that accept it; receipt POSTs can go upstream compressed. zstd
+# needs the zstandard package.
+
+# In order of preference when a client accepts several
+CODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+class DecodeError(Exception):
+    """The request body could not be decoded; ``status_code`` is the answer."""
+
+    status_code = 400
+
+class TooLarge(DecodeError):
+    status_code = 413
+
+class UnsupportedEncoding(DecodeError):
+    status_code = 415
+
+class DecodedStream(io.RawIOBase):
+    """Read-only stream of the decoded body that fails once it grows past ``limit`` bytes."""
+
+    def __init__(self, reader, limit):
+        self.reader = reader
+        self.limit = limit
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(65536)
+                if not chunk:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+        try:
+            # One byte past the limit is enough to tell it was exceeded
+            data = self.reader.read(min(size, self.limit - self.size + 1))
+        except (OSError, EOFError, zlib.error) as e:
+            raise DecodeError("Malformed compressed body: %s" % e)
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise DecodeError("Malformed compressed body: %s" % e)
+            raise
+        self.size += len(data)
+        if self.size > self.limit:
+            raise TooLarge("Decompressed body is larger than %d bytes" % self.limit)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def decoding_stream(raw, coding, limit):
+    """Wrap the file-like ``raw`` so reads return the decoded body."""
+    coding = coding.strip().lower()
+    if coding in ("gzip", "x-gzip"):
+        return DecodedStream(gzip.GzipFile(fileobj=raw, mode="rb"), limit)
+    if coding == "zstd" and zstandard is not None:
+        return DecodedStream(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True), limit)
+    raise UnsupportedEncoding("Unsupported Content-Encoding: %s" % coding)
+
+def decode(data, coding, limit):
+    return decoding_stream(io.BytesIO(data), coding, limit).read()
+
+def negotiate(accept_encoding):
+    """The coding from CODINGS the client prefers, or None."""
+    best = None
+    best_rank = (0.0, 0)
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if name == "*":
+            name = CODINGS[0]
+        if name not in CODINGS:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        rank = (q, -CODINGS.index(name))
+        if q > 0 and rank > best_rank:
+            best, best_rank = name, rank
+    return best
+
+def encode(data, coding):
+    if coding == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if coding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError("Unsupported coding: %s" % coding)
+
+def encode_chunks(chunks, coding):
+    """Compress an iterable of byte chunks on the fly."""
+    if coding == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    elif coding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        raise ValueError("Unsupported coding: %s" % coding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class DecodingMiddleware:
+    """WSGI middleware that swaps a compressed request body for its decoded
+    stream, so the app reads plain JSON of unknown length."""
+
+    def __init__(self, app, limit):
+        self.app = app
+        self.limit = limit
+
+    def __call__(self, environ, start_response):
+        coding = environ.get("HTTP_CONTENT_ENCODING", "").strip()
+        if not coding or coding.lower() == "identity":
+            return self.app(environ, start_response)
+        try:
+            stream = decoding_stream(get_input_stream(environ), coding, self.limit)
+        except UnsupportedEncoding as e:
+            body = jsonlib.dumps({"error": str(e)})
+            start_response("415 Unsupported Media Type", [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(body))),
+                ("Accept-Encoding", ", ".join(CODINGS)),
+            ])
+            return [body]
+        length = environ.pop("CONTENT_LENGTH", "")
+        environ["prpr.encoded_length"] = int(length) if length.isdigit() else None
+        environ.pop("HTTP_CONTENT_ENCODING")
+        environ["wsgi.input"] = stream
+        environ["wsgi.input_terminated"] = True
+        return self.app(environ, start_response)
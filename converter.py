@@ -0,0 +1,516 @@
+import json
+import os
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+# ATOL -> vdpaybox receipt conversion. No Flask or network imports here so the
+# mapping can also be used offline. Code tables come from mappings.json.
+
+MAPPINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mappings.json")
+
+# Tables keyed by ATOL integer codes; JSON object keys are always strings
+_INT_KEYED = ("payment_objects", "measurement_units")
+
+def load_mappings(path=MAPPINGS_PATH):
+    """Read a mapping config into (version, {table name: read-only table})."""
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    tables = {}
+    for name in ("payment_objects", "payment_methods", "measurement_units"):
+        table = config[name]
+        if name in _INT_KEYED:
+            table = {int(code): value for code, value in table.items()}
+        tables[name] = MappingProxyType(table)
+    return config["version"], tables
+
+def _reverse(table):
+    reverse = {}
+    for code, value in table.items():
+        reverse.setdefault(value, code)
+    return MappingProxyType(reverse)
+
+# The tables in use, forward and reverse, with the version they came from
+Mappings = namedtuple("Mappings", (
+    "version payment_objects payment_methods measurement_units"
+    " payment_object_codes payment_method_codes measurement_unit_codes"
+))
+
+def use_mappings(version, tables):
+    """Swap in new tables. They are replaced together by a single rebinding,
+    and a conversion reads them once, so it uses either the old tables or
+    the new ones, never a mix."""
+    global _mappings
+    _mappings = Mappings(
+        version,
+        tables["payment_objects"],
+        tables["payment_methods"],
+        tables["measurement_units"],
+        _reverse(tables["payment_objects"]),
+        _reverse(tables["payment_methods"]),
+        _reverse(tables["measurement_units"]),
+    )
+
+def current_mappings():
+    return _mappings
+
+_mappings_source = (MAPPINGS_PATH, os.stat(MAPPINGS_PATH).st_mtime)
+use_mappings(*load_mappings())
+
+def reload_mappings(path=MAPPINGS_PATH):
+    """Load ``path`` if it is not the config in use or changed since it was
+    loaded; returns the new version, or None when nothing changed."""
+    global _mappings_source
+    source = (path, os.stat(path).st_mtime)
+    if source == _mappings_source:
+        return None
+    version, tables = load_mappings(path)
+    use_mappings(version, tables)
+    _mappings_source = source
+    return version
+
+# (ATOL field, code) -> how often it fell back to "unknown"
+_unknown_codes = {}
+_unknown_lock = threading.Lock()
+MAX_UNKNOWN_CODES = 1000
+
+def _unknown(field, code):
+    if code is not None:
+        key = (field, str(code)[:64])
+        with _unknown_lock:
+            if key not in _unknown_codes and len(_unknown_codes) >= MAX_UNKNOWN_CODES:
+                key = (field, "other")
+            _unknown_codes[key] = _unknown_codes.get(key, 0) + 1
+    return "unknown"
+
+def unknown_codes():
+    with _unknown_lock:
+        return dict(_unknown_codes)
+
+def get_nested(data, *keys, default=None):
+    for key in keys:
+        data = data.get(key, default)
+        if data is default:
+            break
+    return data
+
+def remove_empty_fields(data):
+    def empty(x):
+            return x is None or x == {} or x == []
+    
+    if not isinstance(data, (dict, list)):
+            return data
+    elif isinstance(data, list):
+            return [v for v in (remove_empty_fields(v) for v in data) if not empty(v)]
+    else:
+            return {k: v for k, v in ((k, remove_empty_fields(v)) for k, v in data.items()) if not empty(v)}
+
+def transform_electr(item):
+    return item.get("electronically") != "false"
+
+def transform_marking_code(item):
+    mark_code = item.get("mark_code", {})
+    if mark_code:
+        if "egais20" in mark_code:
+            mark_type = "egais20"
+        elif "egais30" in mark_code:
+            mark_type = "egais30"
+        else:
+            mark_type = "other"
+        return {
+            "type": mark_type,
+            "mark": next(iter(mark_code.values()))
+        }
+    return {
+        "type": "other",
+        "mark": mark_code
+    }
+
+def transform_payment_object(item):
+    payment_object = item.get("payment_object")
+    return _mappings.payment_objects.get(payment_object, "unknown")
+
+def transform_payment_method(item):
+    payment_method = item.get("payment_method")
+    return _mappings.payment_methods.get(payment_method, "unknown")
+
+def transform_agent(items):
+    agents = items.get("agent_info",{})
+    if agents:
+        return ["another"]
+    else:
+        return None
+
+def transform_measure(item):
+    measurement_unit = item.get("measure")
+    return _mappings.measurement_units.get(measurement_unit, "unknown")
+
+def build_target_data(input_data, orgid):
+    return {
+        "externId": input_data.get("external_id"),
+        "externDeviceId": input_data.get("device_number"),
+        "recreatePayment": None,  # Not found
+        "orgId": orgid,
+        "cashboxId": None,  # Not found
+        "receiptBody": {
+            "externId": input_data.get("external_id"),
+            "type": "sell",  # E
+            "taxationType": get_nested(input_data, "receipt", "company", "sno"),
+            "electronically": transform_electr(input_data),
+            "paymentsPlace": get_nested(input_data, "receipt", "client", "address"),
+            "operator": {
+                "name": get_nested(input_data, "receipt", "client", "name"),
+                "vatin": get_nested(input_data, "receipt", "client", "inn")
+            },
+            "clientInfo": {
+                "emailOrPhone": get_nested(input_data, "receipt", "client", "email"),
+                "vatin": get_nested(input_data, "receipt", "client", "inn"),
+                "name": get_nested(input_data, "receipt", "client", "name")
+            },
+            "items": [
+                {
+                    "type": "position",
+                    "name": item.get("name"),
+                    "price": item.get("price"),
+                    "quantity": item.get("quantity"),
+                    "amount": item.get("sum"),
+                    "measurementUnit": transform_measure(item),
+                    "paymentMethod": transform_payment_method(item),
+                    "paymentObject": transform_payment_object(item),
+                                        "supplierInfo": {
+                        "phones": item.get("supplier_info", {}).get("phones"),
+                        "name": item.get("supplier_info", {}).get("name"),
+                        "vatin": item.get("supplier_info", {}).get("inn")
+                    },
+                    "tax": {
+                        "type": item.get("vat", {}).get("type"),
+                        "sum": item.get("vat", {}).get("sum")
+                    },
+                    "markingCode": transform_marking_code(item),
+
+                    "agentInfo": {
+                        "agents": transform_agent(item),
+                        "payingAgent": {
+                            "operation": item.get("agent_info", {}).get("paying_agent", {}).get("operation"),
+                            "phones": item.get("agent_info", {}).get("paying_agent", {}).get("phones")
+                        },
+                        "receivePaymentsOperator": {
+                            "phones": item.get("agent_info", {}).get("receive_payments_operator", {}).get("phones")
+                        },
+                        "moneyTransferOperator": {
+                            "phones": item.get("agent_info", {}).get("money_transfer_operator", {}).get("phones"),
+                            "name": item.get("agent_info", {}).get("money_transfer_operator", {}).get("name"),
+                            "address": item.get("agent_info", {}).get("money_transfer_operator", {}).get("address"),
+                            "vatin": item.get("agent_info", {}).get("money_transfer_operator", {}).get("inn")
+                        }
+                    }
+                } for item in get_nested(input_data, "receipt", "items", default=[])
+            ],
+            "payments": [
+                {
+                    "sum": payment.get("sum"),
+                    "type": "electronically"
+                } for payment in get_nested(input_data, "receipt", "payments", default=[])
+            ],
+            "taxes": [
+                {
+                    "type": tax.get("type"),
+                    "sum": tax.get("sum")
+                } for tax in get_nested(input_data, "receipt", "vats", default=[])
+            ]
+        }
+    }
+
+
+# Fast path. Produces exactly remove_empty_fields(build_target_data(...)), but
+# looks up every nested object once and drops empty values while building the
+# output instead of walking the whole tree again afterwards.
+
+_NO_DATA = MappingProxyType({})
+
+def _put(out, key, value):
+    if value is None:
+        return
+    if value.__class__ is dict or value.__class__ is list:
+        # Values copied from the input may hold empties of their own
+        value = remove_empty_fields(value)
+        if not value:
+            return
+    out[key] = value
+
+def _convert_marking_code(mark_code):
+    if mark_code:
+        if "egais20" in mark_code:
+            mark_type = "egais20"
+        elif "egais30" in mark_code:
+            mark_type = "egais30"
+        else:
+            mark_type = "other"
+        marking = {"type": mark_type}
+        _put(marking, "mark", next(iter(mark_code.values())))
+        return marking
+    marking = {"type": "other"}
+    _put(marking, "mark", mark_code)
+    return marking
+
+def _convert_agent_info(agent_info):
+    out = {}
+    if agent_info:
+        out["agents"] = ["another"]
+
+    paying_agent = agent_info.get("paying_agent") or _NO_DATA
+    paying = {}
+    _put(paying, "operation", paying_agent.get("operation"))
+    _put(paying, "phones", paying_agent.get("phones"))
+    if paying:
+        out["payingAgent"] = paying
+
+    operator = agent_info.get("receive_payments_operator") or _NO_DATA
+    receive = {}
+    _put(receive, "phones", operator.get("phones"))
+    if receive:
+        out["receivePaymentsOperator"] = receive
+
+    operator = agent_info.get("money_transfer_operator") or _NO_DATA
+    transfer = {}
+    _put(transfer, "phones", operator.get("phones"))
+    _put(transfer, "name", operator.get("name"))
+    _put(transfer, "address", operator.get("address"))
+    _put(transfer, "vatin", operator.get("inn"))
+    if transfer:
+        out["moneyTransferOperator"] = transfer
+    return out
+
+def convert_item(item, mappings=None):
+    """Convert one receipt item; ``mappings`` is the current_mappings() the
+    rest of the receipt is converted with."""
+    mappings = mappings or _mappings
+    get = item.get
+    out = {"type": "position"}
+    _put(out, "name", get("name"))
+    _put(out, "price", get("price"))
+    _put(out, "quantity", get("quantity"))
+    _put(out, "amount", get("sum"))
+    value = mappings.measurement_units.get(get("measure"))
+    out["measurementUnit"] = value if value is not None else _unknown("measure", get("measure"))
+    value = mappings.payment_methods.get(get("payment_method"))
+    out["paymentMethod"] = value if value is not None else _unknown("payment_method", get("payment_method"))
+    value = mappings.payment_objects.get(get("payment_object"))
+    out["paymentObject"] = value if value is not None else _unknown("payment_object", get("payment_object"))
+
+    supplier_info = get("supplier_info") or _NO_DATA
+    supplier = {}
+    _put(supplier, "phones", supplier_info.get("phones"))
+    _put(supplier, "name", supplier_info.get("name"))
+    _put(supplier, "vatin", supplier_info.get("inn"))
+    if supplier:
+        out["supplierInfo"] = supplier
+
+    vat = get("vat") or _NO_DATA
+    tax = {}
+    _put(tax, "type", vat.get("type"))
+    _put(tax, "sum", vat.get("sum"))
+    if tax:
+        out["tax"] = tax
+
+    out["markingCode"] = _convert_marking_code(get("mark_code", {}))
+
+    agent_info = _convert_agent_info(get("agent_info") or _NO_DATA)
+    if agent_info:
+        out["agentInfo"] = agent_info
+    return out
+
+def convert_receipt(input_data, orgid=None):
+    """Convert an ATOL receipt into the payload for the vdpaybox receipt API."""
+    receipt = input_data.get("receipt") or _NO_DATA
+    company = receipt.get("company") or _NO_DATA
+    client = receipt.get("client") or _NO_DATA
+    external_id = input_data.get("external_id")
+
+    body = {}
+    _put(body, "externId", external_id)
+    body["type"] = "sell"
+    _put(body, "taxationType", company.get("sno"))
+    body["electronically"] = input_data.get("electronically") != "false"
+    _put(body, "paymentsPlace", client.get("address"))
+
+    operator = {}
+    _put(operator, "name", client.get("name"))
+    _put(operator, "vatin", client.get("inn"))
+    if operator:
+        body["operator"] = operator
+
+    client_info = {}
+    _put(client_info, "emailOrPhone", client.get("email"))
+    _put(client_info, "vatin", client.get("inn"))
+    _put(client_info, "name", client.get("name"))
+    if client_info:
+        body["clientInfo"] = client_info
+
+    mappings = _mappings
+    items = [convert_item(item, mappings) for item in receipt.get("items") or ()]
+    if items:
+        body["items"] = items
+
+    payments = []
+    for payment in receipt.get("payments") or ():
+        converted = {}
+        _put(converted, "sum", payment.get("sum"))
+        converted["type"] = "electronically"
+        payments.append(converted)
+    if payments:
+        body["payments"] = payments
+
+    taxes = []
+    for vat in receipt.get("vats") or ():
+        converted = {}
+        _put(converted, "type", vat.get("type"))
+        _put(converted, "sum", vat.get("sum"))
+        if converted:
+            taxes.append(converted)
+    if taxes:
+        body["taxes"] = taxes
+
+    out = {}
+    _put(out, "externId", external_id)
+    _put(out, "externDeviceId", input_data.get("device_number"))
+    _put(out, "orgId", orgid)
+    out["receiptBody"] = body
+    return out
+
+# Reverse direction: vdpaybox receipt -> ATOL, for showing receipts fetched
+# from vdpaybox to ATOL-speaking systems. Uses the reverse of the same code
+# tables, so convert_receipt(convert_to_atol(x), x["orgId"]) gives x back for
+# anything convert_receipt produced (see tests/test_converter.py).
+
+def _code(table, field, value):
+    code = table.get(value)
+    if code is None and value != "unknown":
+        _unknown(field, value)
+    return code
+
+def _revert_agent_info(agent_info):
+    out = {}
+    agents = agent_info.get("agents")
+    if agents:
+        out["type"] = agents[0]
+
+    paying = agent_info.get("payingAgent") or _NO_DATA
+    paying_agent = {}
+    _put(paying_agent, "operation", paying.get("operation"))
+    _put(paying_agent, "phones", paying.get("phones"))
+    if paying_agent:
+        out["paying_agent"] = paying_agent
+
+    receive = agent_info.get("receivePaymentsOperator") or _NO_DATA
+    operator = {}
+    _put(operator, "phones", receive.get("phones"))
+    if operator:
+        out["receive_payments_operator"] = operator
+
+    transfer = agent_info.get("moneyTransferOperator") or _NO_DATA
+    operator = {}
+    _put(operator, "phones", transfer.get("phones"))
+    _put(operator, "name", transfer.get("name"))
+    _put(operator, "address", transfer.get("address"))
+    _put(operator, "inn", transfer.get("vatin"))
+    if operator:
+        out["money_transfer_operator"] = operator
+    return out
+
+def convert_item_to_atol(item, mappings=None):
+    mappings = mappings or _mappings
+    get = item.get
+    out = {}
+    _put(out, "name", get("name"))
+    _put(out, "price", get("price"))
+    _put(out, "quantity", get("quantity"))
+    _put(out, "sum", get("amount"))
+    _put(out, "measure", _code(mappings.measurement_unit_codes, "measurementUnit", get("measurementUnit")))
+    _put(out, "payment_method", _code(mappings.payment_method_codes, "paymentMethod", get("paymentMethod")))
+    _put(out, "payment_object", _code(mappings.payment_object_codes, "paymentObject", get("paymentObject")))
+
+    supplier = get("supplierInfo") or _NO_DATA
+    supplier_info = {}
+    _put(supplier_info, "phones", supplier.get("phones"))
+    _put(supplier_info, "name", supplier.get("name"))
+    _put(supplier_info, "inn", supplier.get("vatin"))
+    if supplier_info:
+        out["supplier_info"] = supplier_info
+
+    tax = get("tax") or _NO_DATA
+    vat = {}
+    _put(vat, "type", tax.get("type"))
+    _put(vat, "sum", tax.get("sum"))
+    if vat:
+        out["vat"] = vat
+
+    marking = get("markingCode") or _NO_DATA
+    mark = marking.get("mark")
+    mark_type = marking.get("type")
+    if mark_type in ("egais20", "egais30"):
+        # The original ATOL key is only kept for EGAIS codes. It carries the
+        # type even without a mark: {"egais20": null} converts back to
+        # {"type": "egais20"}
+        out["mark_code"] = {mark_type: mark}
+    elif mark is not None:
+        out["mark_code"] = {"unknown": mark}
+
+    agent_info = _revert_agent_info(get("agentInfo") or _NO_DATA)
+    if agent_info:
+        out["agent_info"] = agent_info
+    return out
+
+def convert_to_atol(data):
+    """Convert a vdpaybox receipt (with or without its envelope) into ATOL format."""
+    body = data.get("receiptBody")
+    if body is None:
+        body = data
+    operator = body.get("operator") or _NO_DATA
+    client_info = body.get("clientInfo") or _NO_DATA
+
+    receipt = {}
+    client = {}
+    _put(client, "email", client_info.get("emailOrPhone"))
+    _put(client, "inn", client_info.get("vatin") or operator.get("vatin"))
+    _put(client, "name", client_info.get("name") or operator.get("name"))
+    _put(client, "address", body.get("paymentsPlace"))
+    if client:
+        receipt["client"] = client
+
+    company = {}
+    _put(company, "sno", body.get("taxationType"))
+    if company:
+        receipt["company"] = company
+
+    mappings = _mappings
+    items = [convert_item_to_atol(item, mappings) for item in body.get("items") or ()]
+    if items:
+        receipt["items"] = items
+
+    payments = []
+    for payment in body.get("payments") or ():
+        # vdpaybox only takes electronic payments, ATOL type 1
+        converted = {"type": 1}
+        _put(converted, "sum", payment.get("sum"))
+        payments.append(converted)
+    if payments:
+        receipt["payments"] = payments
+
+    vats = []
+    for tax in body.get("taxes") or ():
+        converted = {}
+        _put(converted, "type", tax.get("type"))
+        _put(converted, "sum", tax.get("sum"))
+        if converted:
+            vats.append(converted)
+    if vats:
+        receipt["vats"] = vats
+
+    out = {}
+    _put(out, "external_id", data.get("externId") or body.get("externId"))
+    _put(out, "device_number", data.get("externDeviceId"))
+    if body.get("electronically") is False:
+        out["electronically"] = "false"
+    out["receipt"] = receipt
+    return out
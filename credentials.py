@@ -0,0 +1,83 @@
+import base64
+import binascii
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from token_cache import LoginError
+
+# Basic-auth credentials: decoded headers are cached, and logins the upstream
+# rejected are remembered for a short while, so a terminal retrying with a
+# bad password is answered here instead of costing a login call each time.
+
+Credential = namedtuple("Credential", "username password key")
+
+def credential_key(username, password):
+    """Stable key for caches keyed by credential; the password never leaves it."""
+    return hashlib.sha256(("%s\0%s" % (username, password)).encode('utf-8')).hexdigest()
+
+def parse_basic(auth_header):
+    if not auth_header or not auth_header.startswith('Basic '):
+        raise LoginError({"error": "Authorization header is required and should be Basic"}, 400)
+    try:
+        auth_decoded = base64.b64decode(auth_header[6:].strip(), validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError):
+        raise LoginError({"error": "Malformed Basic credentials"}, 400)
+    # Passwords may contain colons, usernames may not (RFC 7617)
+    username, colon, password = auth_decoded.partition(':')
+    if not colon:
+        raise LoginError({"error": "Malformed Basic credentials"}, 400)
+    if not password:
+        raise LoginError({"error": "Password is required"}, 400)
+    return Credential(username, password, credential_key(username, password))
+
+class Credentials:
+    """LRU cache of parsed Authorization headers plus a negative cache of
+    logins rejected with 401 or 403, kept for ``reject_ttl`` seconds."""
+
+    def __init__(self, maxsize, reject_ttl):
+        self.maxsize = maxsize
+        self.reject_ttl = reject_ttl
+        self._parsed = OrderedDict()
+        self._rejected = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"rejected": 0, "refused": 0}
+
+    def parse(self, auth_header):
+        """Credential for the header; raises LoginError (400) if it is not valid Basic auth."""
+        with self._lock:
+            credential = self._parsed.get(auth_header)
+            if credential is not None:
+                self._parsed.move_to_end(auth_header)
+                return credential
+        credential = parse_basic(auth_header)
+        with self._lock:
+            self._parsed[auth_header] = credential
+            if len(self._parsed) > self.maxsize:
+                self._parsed.popitem(last=False)
+        return credential
+
+    def check(self, key):
+        """Raise the stored LoginError if the login for ``key`` was rejected recently."""
+        with self._lock:
+            entry = self._rejected.get(key)
+            if entry is None:
+                return
+            expires_at, body, status_code = entry
+            if expires_at <= time.monotonic():
+                del self._rejected[key]
+                return
+            self.stats["refused"] += 1
+        raise LoginError(body, status_code)
+
+    def reject(self, key, error):
+        """Remember a failed login if the upstream turned the credential down."""
+        if not self.reject_ttl or error.status_code not in (401, 403):
+            return
+        with self._lock:
+            self._rejected[key] = (time.monotonic() + self.reject_ttl, error.body, error.status_code)
+            self._rejected.move_to_end(key)
+            if len(self._rejected) > self.maxsize:
+                self._rejected.popitem(last=False)
+            self.stats["rejected"] += 1
@@ -0,0 +1,295 @@
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+import jsonlib
+
+# Durable outbox for receipts accepted with 202. Receipts are stored in an
+# SQLite database in WAL mode and delivered by background threads; several
+# worker processes on one host can share the same file.
+#
+# The Authorization header is stored with each receipt so a delivery can log
+# in again after a restart, and cleared once the receipt is delivered or has
+# failed. Such final receipts are deleted after a retention period. The
+# database file is created readable by its owner only.
+
+QUEUED = 'queued'
+DELIVERING = 'delivering'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+log = logging.getLogger("prpr.delivery")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id TEXT PRIMARY KEY,
+    dedup_key TEXT UNIQUE,
+    state TEXT NOT NULL,
+    auth TEXT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    upstream_status INTEGER,
+    response TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipts_due ON receipts (state, next_attempt);
+"""
+
+class DeliveryQueue:
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        if path != ':memory:' and not os.path.exists(path):
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection inherited through fork (gunicorn --preload) must not be reused
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def enqueue(self, payload, auth_header, dedup_key=None):
+        """Store a converted receipt and return its tracking id.
+
+        A receipt with the same dedup_key that is still pending or delivered
+        is not queued again; its existing id is returned.
+        """
+        now = time.time()
+        receipt_id = uuid.uuid4().hex
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if dedup_key is not None:
+                row = db.execute("SELECT id FROM receipts WHERE dedup_key = ?", (dedup_key,)).fetchone()
+                if row is not None:
+                    db.execute("COMMIT")
+                    return row["id"]
+            db.execute(
+                "INSERT INTO receipts (id, dedup_key, state, auth, payload, next_attempt, created, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (receipt_id, dedup_key, QUEUED, auth_header, jsonlib.dumps(payload).decode("utf-8"), now, now, now)
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return receipt_id
+
+    def status(self, receipt_id):
+        row = self._connect().execute(
+            "SELECT id, state, attempts, upstream_status, response, error, created, updated"
+            " FROM receipts WHERE id = ?", (receipt_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "status": row["state"],
+            "attempts": row["attempts"],
+            "upstream_status": row["upstream_status"],
+            "response": jsonlib.loads(row["response"]) if row["response"] is not None else None,
+            "error": row["error"],
+            "created": row["created"],
+            "updated": row["updated"],
+        }
+
+    def claim(self, limit, lease):
+        """Take up to limit due receipts; they return to the queue if the lease runs out."""
+        now = time.time()
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(
+                "SELECT id, auth, payload, attempts FROM receipts"
+                " WHERE state IN (?, ?) AND next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                (QUEUED, DELIVERING, now, limit)
+            ).fetchall()
+            db.executemany(
+                "UPDATE receipts SET state = ?, attempts = attempts + 1, next_attempt = ?, updated = ?"
+                " WHERE id = ?",
+                [(DELIVERING, now + lease, now, row["id"]) for row in rows]
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return [(row["id"], row["auth"], jsonlib.loads(row["payload"]), row["attempts"] + 1) for row in rows]
+
+    def complete(self, receipt_id, upstream_status, response):
+        self._finish(receipt_id, DELIVERED, upstream_status, response, None)
+
+    def fail(self, receipt_id, upstream_status, response, error):
+        # A failed receipt may be submitted again under the same key
+        self._finish(receipt_id, FAILED, upstream_status, response, error, release_key=True)
+
+    def retry(self, receipt_id, delay, upstream_status, response, error):
+        now = time.time()
+        self._connect().execute(
+            "UPDATE receipts SET state = ?, next_attempt = ?, upstream_status = ?, response = ?,"
+            " error = ?, updated = ? WHERE id = ?",
+            (QUEUED, now + delay, upstream_status, _dump(response), error, now, receipt_id)
+        )
+
+    def _finish(self, receipt_id, state, upstream_status, response, error, release_key=False):
+        # The credential is no longer needed once the receipt is final
+        self._connect().execute(
+            "UPDATE receipts SET state = ?, upstream_status = ?, response = ?, error = ?, updated = ?, auth = NULL"
+            + (", dedup_key = NULL" if release_key else "") + " WHERE id = ?",
+            (state, upstream_status, _dump(response), error, time.time(), receipt_id)
+        )
+
+    def prune(self, retention):
+        """Delete delivered and failed receipts last updated over ``retention`` seconds ago."""
+        return self._connect().execute(
+            "DELETE FROM receipts WHERE state IN (?, ?) AND updated < ?",
+            (DELIVERED, FAILED, time.time() - retention)
+        ).rowcount
+
+def _dump(response):
+    return jsonlib.dumps(response).decode("utf-8") if response is not None else None
+
+class Retry(Exception):
+    """Raised by the deliver callable for failures worth another attempt."""
+
+    def __init__(self, error, upstream_status=None, response=None):
+        super().__init__(error)
+        self.error = error
+        self.upstream_status = upstream_status
+        self.response = response
+
+class DeliveryWorkers:
+    """Background threads draining a DeliveryQueue.
+
+    ``deliver(payload, auth_header)`` returns (status, body) for a final
+    upstream answer or raises Retry. Threads are started lazily and restarted
+    after a fork, so this works with pre-fork servers. Final receipts older
+    than ``retention`` seconds are pruned while the queue is idle (0 keeps
+    them).
+    """
+
+    # Seconds between two prunes of final receipts
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, queue, deliver, threads=4, max_attempts=10, backoff=1, backoff_max=300,
+                 lease=120, poll=1, retention=0):
+        self.queue = queue
+        self.deliver = deliver
+        self.threads = threads
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.poll = poll
+        self.retention = retention
+        self._pruned_at = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._workers = []
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._workers = [
+                threading.Thread(target=self._run, name="delivery-%d" % n, daemon=True)
+                for n in range(self.threads)
+            ]
+            for worker in self._workers:
+                worker.start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._pid = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                busy = self._deliver_due()
+            except Exception:
+                # A locked database or a bad row must not stop the thread; a
+                # receipt left delivering is claimed again after its lease
+                log.exception("Delivery worker failed")
+                busy = False
+            if not busy:
+                self._wakeup.wait(self.poll)
+                self._wakeup.clear()
+
+    def _deliver_due(self):
+        """Deliver the next due receipt; False when there was none."""
+        try:
+            claimed = self.queue.claim(1, self.lease)
+        except sqlite3.OperationalError:
+            # Locked by another worker process; try again on the next poll
+            return False
+        if not claimed:
+            self._prune()
+            return False
+        for receipt_id, auth_header, payload, attempt in claimed:
+            self._deliver_one(receipt_id, auth_header, payload, attempt)
+        return True
+
+    def _prune(self):
+        now = time.monotonic()
+        with self._lock:
+            if not self.retention or self._pruned_at is not None and now - self._pruned_at < self.PRUNE_INTERVAL:
+                return
+            self._pruned_at = now
+        pruned = self.queue.prune(self.retention)
+        if pruned:
+            log.info("Pruned final receipts", extra={"fields": {"count": pruned}})
+
+    def _deliver_one(self, receipt_id, auth_header, payload, attempt):
+        fields = {"receipt_id": receipt_id, "attempt": attempt}
+        try:
+            status, body = self.deliver(payload, auth_header)
+        except Retry as e:
+            fields.update(error=e.error, status=e.upstream_status)
+            if attempt >= self.max_attempts:
+                log.error("Delivery failed, giving up", extra={"fields": fields})
+                self.queue.fail(receipt_id, e.upstream_status, e.response, e.error)
+            else:
+                delay = self._delay(attempt)
+                fields["retry_in"] = round(delay, 3)
+                log.warning("Delivery failed, will retry", extra={"fields": fields})
+                self.queue.retry(receipt_id, delay, e.upstream_status, e.response, e.error)
+            return
+        except Exception as e:
+            log.exception("Delivery crashed", extra={"fields": fields})
+            self.queue.fail(receipt_id, None, None, repr(e))
+            return
+        fields["status"] = status
+        if status == 200:
+            log.info("Queued receipt delivered", extra={"fields": fields})
+            self.queue.complete(receipt_id, status, body)
+        else:
+            log.warning("Queued receipt rejected", extra={"fields": fields})
+            self.queue.fail(receipt_id, status, body, "Upstream rejected the receipt")
+
+    def _delay(self, attempt):
+        delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1)
@@ -0,0 +1,52 @@
+import gc
+import math
+import multiprocessing
+import os
+
+# Production gunicorn config:
+#
+#   python openapi.py && gunicorn -c gunicorn.conf.py prpr:app
+#
+# The app is imported once in the master and the workers are forked from it,
+# so the mapping tables, routing table and OpenAPI spec are shared copy-on-write
+# and a new worker is ready as soon as it is forked. Swagger UI is off unless
+# SWAGGER is set; the spec is served from the file openapi.py wrote.
+#
+# A worker killed mid-delivery leaves its idempotency claim behind, and
+# retries of that receipt get 409 until the claim expires, although it may
+# already have been posted. So the worker timeout defaults to the longest
+# possible delivery (routing.delivery_time) of the slowest upstream, plus
+# time to read and convert the request. A WORKER_TIMEOUT below that is
+# raised to it; a routing table reloaded later with slower upstreams needs
+# a restart to take effect here.
+
+os.environ.setdefault("SWAGGER", "static")
+
+import settings
+import routing
+
+# Reading and converting the request, on top of the delivery
+REQUEST_TIME = 30
+
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get("WORKER_CLASS", "sync")
+timeout = max(
+    int(os.environ.get("WORKER_TIMEOUT", 0)),
+    math.ceil(routing.max_delivery_time(settings, settings.UPSTREAMS_PATH)) + REQUEST_TIME,
+)
+preload_app = True
+
+def when_ready(server):
+    import prpr
+    if prpr.delivery_workers is not None:
+        # Queued receipts are delivered by the workers, not the master
+        prpr.delivery_workers.stop(timeout=10)
+    # Objects created at import are never freed; keeping them out of the
+    # collector stops it from touching, and so unsharing, their pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    import prpr
+    if prpr.delivery_workers is not None:
+        prpr.delivery_workers.start()
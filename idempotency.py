@@ -0,0 +1,308 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import jsonlib
+
+# Upstream responses are remembered per (upstream, orgId, external_id) so that
+# a POS retrying on timeout gets the original answer instead of a second receipt.
+
+PENDING = object()
+
+# Statuses worth replaying: anything final. Auth failures, timeouts, conflicts
+# and rate limits may succeed on retry, as may any 5xx.
+RETRYABLE_STATUSES = frozenset((401, 408, 409, 425, 429))
+
+def cacheable(status):
+    return status < 500 and status not in RETRYABLE_STATUSES
+
+def receipt_key(upstream, owner, external_id):
+    """Key of a receipt; the same external_id is another receipt on another
+    upstream environment or for another owner (organization or credential)."""
+    if not external_id:
+        return None
+    return "%s:%s:%s" % (upstream, owner, external_id)
+
+class IdempotencyConflict(Exception):
+    """Another worker is still processing the same receipt."""
+
+class MemoryBackend:
+    """Per-process LRU. In-flight duplicates are already coalesced in-process."""
+
+    blocking = False
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, status, body = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return status, body
+
+    def claim(self, key, lease):
+        return True
+
+    def release(self, key):
+        pass
+
+    def set(self, key, status, body, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, status, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+class SQLiteBackend:
+    """Shared by all workers on one host through a WAL-mode database file."""
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                " key TEXT PRIMARY KEY, status INTEGER, body TEXT, expires_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection inherited through fork (gunicorn --preload) must not be reused
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT status, body FROM idempotency WHERE key = ? AND expires_at > ?",
+            (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        if row[0] is None:
+            return PENDING
+        return row[0], jsonlib.loads(row[1])
+
+    def claim(self, key, lease):
+        now = time.time()
+        db = self._connect()
+        db.execute("DELETE FROM idempotency WHERE key = ? AND expires_at <= ?", (key, now))
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO idempotency (key, status, body, expires_at) VALUES (?, NULL, NULL, ?)",
+            (key, now + lease)
+        )
+        return cursor.rowcount == 1
+
+    def release(self, key):
+        self._connect().execute("DELETE FROM idempotency WHERE key = ? AND status IS NULL", (key,))
+
+    def set(self, key, status, body, ttl):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO idempotency (key, status, body, expires_at) VALUES (?, ?, ?, ?)",
+            (key, status, jsonlib.dumps(body).decode("utf-8"), time.time() + ttl)
+        )
+
+class RedisBackend:
+    """Works with Redis or anything speaking its protocol (KeyDB, Dragonfly...)."""
+
+    blocking = True
+
+    def __init__(self, url, prefix="prpr:idempotency:"):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        if value is None:
+            return None
+        if value == b"pending":
+            return PENDING
+        status, body = jsonlib.loads(value)
+        return status, body
+
+    def claim(self, key, lease):
+        return bool(self.redis.set(self.prefix + key, b"pending", nx=True, px=int(lease * 1000)))
+
+    def release(self, key):
+        # Only remove our own claim, never a stored response
+        self.redis.eval(
+            "if redis.call('get', KEYS[1]) == 'pending' then return redis.call('del', KEYS[1]) end",
+            1, self.prefix + key
+        )
+
+    def set(self, key, status, body, ttl):
+        self.redis.set(self.prefix + key, jsonlib.dumps([status, jsonlib.plain(body)]), px=int(ttl * 1000))
+
+def make_backend(name, settings):
+    if name == 'memory':
+        return MemoryBackend(settings.IDEMPOTENCY_SIZE)
+    if name == 'sqlite':
+        return SQLiteBackend(settings.IDEMPOTENCY_SQLITE_PATH)
+    if name == 'redis':
+        return RedisBackend(settings.IDEMPOTENCY_REDIS_URL)
+    raise ValueError("Unknown idempotency backend: %s" % name)
+
+class _Abandoned(Exception):
+    """The leading call was interrupted; a waiting duplicate takes over."""
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class IdempotencyCache:
+    """Runs func() once per key within the TTL and replays its (status, body).
+
+    run() returns (status, body, replayed). Concurrent duplicates in this
+    process wait for the first one; duplicates in other workers wait on the
+    backend's pending marker for up to ``wait`` seconds. The marker expires
+    after ``lease`` seconds (or the lease given to run()), which must outlast
+    func(), or a duplicate could claim the key while it is still running.
+    If the first call is interrupted, a waiting duplicate runs func() instead.
+    """
+
+    def __init__(self, backend, ttl, wait=30, lease=None, poll=0.05):
+        self.backend = backend
+        self.ttl = ttl
+        self.wait = wait
+        self.lease = lease or wait
+        self.poll = poll
+        self._inflight = {}
+        self._async_inflight = {}
+        self._lock = threading.Lock()
+        self.stats = {"replay": 0, "miss": 0}
+
+    def _count(self, result):
+        with self._lock:
+            self.stats["replay" if result[2] else "miss"] += 1
+        return result
+
+    def run(self, key, func, lease=None):
+        while True:
+            with self._lock:
+                call = self._inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = self._inflight[key] = _Call()
+            if leader:
+                break
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if call.result is not None:
+                status, body, _ = call.result
+                return self._count((status, body, True))
+            # The leader was interrupted without an answer
+
+        try:
+            call.result = self._run(key, func, lease or self.lease)
+            return self._count(call.result)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+
+    def _run(self, key, func, lease):
+        deadline = time.monotonic() + self.wait
+        while True:
+            cached = self.backend.get(key)
+            if cached is not None and cached is not PENDING:
+                return cached[0], cached[1], True
+            if cached is None and self.backend.claim(key, lease):
+                break
+            if time.monotonic() >= deadline:
+                raise IdempotencyConflict(key)
+            time.sleep(self.poll)
+
+        try:
+            status, body = func()
+        except BaseException:
+            self.backend.release(key)
+            raise
+        if cacheable(status):
+            self.backend.set(key, status, body, self.ttl)
+        else:
+            self.backend.release(key)
+        return status, body, False
+
+    async def arun(self, key, func, lease=None):
+        """Coroutine flavour of run(); func is an async callable."""
+        while True:
+            future = self._async_inflight.get(key)
+            if future is None:
+                break
+            try:
+                status, body, _ = await asyncio.shield(future)
+            except _Abandoned:
+                continue
+            return self._count((status, body, True))
+
+        future = self._async_inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._arun(key, func, lease or self.lease)
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()
+            raise
+        except BaseException:
+            # Cancelled, e.g. the client went away; must not cancel the duplicates
+            future.set_exception(_Abandoned())
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return self._count(result)
+        finally:
+            del self._async_inflight[key]
+
+    async def _arun(self, key, func, lease):
+        backend = self.backend
+
+        async def call(method, *args):
+            if backend.blocking:
+                return await asyncio.to_thread(method, *args)
+            return method(*args)
+
+        deadline = time.monotonic() + self.wait
+        while True:
+            cached = await call(backend.get, key)
+            if cached is not None and cached is not PENDING:
+                return cached[0], cached[1], True
+            if cached is None and await call(backend.claim, key, lease):
+                break
+            if time.monotonic() >= deadline:
+                raise IdempotencyConflict(key)
+            await asyncio.sleep(self.poll)
+
+        try:
+            status, body = await func()
+        except BaseException:
+            await call(backend.release, key)
+            raise
+        if cacheable(status):
+            await call(backend.set, key, status, body, self.ttl)
+        else:
+            await call(backend.release, key)
+        return status, body, False
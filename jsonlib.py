@@ -0,0 +1,43 @@
+import json
+
+import settings
+
+# Pluggable JSON encoding. orjson is used when it is installed, unless
+# JSON_BACKEND=json. dumps() always returns UTF-8 bytes.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if settings.JSON_BACKEND == 'json':
+    orjson = None
+elif settings.JSON_BACKEND == 'orjson' and orjson is None:
+    raise ImportError("JSON_BACKEND=orjson but orjson is not installed")
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+class RawJSON(bytes):
+    """Already encoded JSON that is passed through without decoding."""
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj):
+    if isinstance(obj, RawJSON):
+        return bytes(obj)
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # Non-string keys, integers over 64 bits and the like
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def plain(obj):
+    """Decode a RawJSON value; anything else is returned unchanged."""
+    if isinstance(obj, RawJSON):
+        return loads(bytes(obj))
+    return obj
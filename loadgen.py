@@ -0,0 +1,144 @@
+import argparse
+import base64
+import itertools
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+import requests
+
+from bench import SHAPES
+
+# Open-loop load generator for /process. Requests are scheduled at a fixed
+# rate and latency is measured from the scheduled send time, so a slow server
+# shows up as latency rather than as a quietly reduced request rate.
+#
+#   python stub_upstream.py --receipt-latency lognormal:0.08:0.5 &
+#   UPSTREAM_BASE_URL=http://127.0.0.1:8081 gunicorn -w 4 -b 127.0.0.1:8000 prpr:app &
+#   python loadgen.py http://127.0.0.1:8000 --rps 200 --duration 60 --mix 1-item:80,dense-50:18,1000-items:2
+
+DEFAULT_MIX = "1-item:80,dense-50:15,heavy-agent-mark:4,1000-items:1"
+
+def parse_mix(spec):
+    """'1-item:80,dense-50:20' -> [(shape, weight)]; shapes come from bench.SHAPES."""
+    mix = []
+    for part in spec.split(","):
+        shape, _, weight = part.partition(":")
+        if shape not in SHAPES:
+            raise ValueError("Unknown receipt shape %r, choose from %s" % (shape, ", ".join(SHAPES)))
+        mix.append((shape, float(weight or 1)))
+    return mix
+
+def templates(mix):
+    """Serialized receipts with a placeholder external_id, so each request
+    gets a fresh id without serializing the receipt again."""
+    out = {}
+    for shape, _ in mix:
+        receipt = dict(SHAPES[shape], external_id="@@EXTERNAL_ID@@")
+        out[shape] = json.dumps(receipt, ensure_ascii=False).encode("utf-8").split(b"@@EXTERNAL_ID@@")
+    return out
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def run(url, rps, duration, concurrency=64, mix=DEFAULT_MIX, users=1, timeout=30.0, seed=None):
+    """Drive POST url/process; returns a list of (shape, status, latency seconds).
+
+    status is 0 when the request failed without a response.
+    """
+    rng = random.Random(seed)
+    mix = parse_mix(mix)
+    bodies = templates(mix)
+    shapes, weights = zip(*mix)
+    credentials = [
+        "Basic " + base64.b64encode(("load%d:secret" % n).encode()).decode() for n in range(users)
+    ]
+    endpoint = url.rstrip("/") + "/process"
+    run_id = "%x" % int(time.time())
+    schedule = queue.Queue(maxsize=concurrency * 4)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            job = schedule.get()
+            if job is None:
+                return
+            n, shape, due = job
+            head, tail = bodies[shape]
+            body = head + ("%s-%d" % (run_id, n)).encode() + tail
+            headers = {"Authorization": credentials[n % users], "Content-Type": "application/json"}
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                status = session.post(endpoint, data=body, headers=headers, timeout=timeout).status_code
+            except requests.RequestException:
+                status = 0
+            elapsed = time.perf_counter() - due
+            with lock:
+                results.append((shape, status, elapsed))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    total = int(rps * duration)
+    for n in range(total):
+        schedule.put((n, rng.choices(shapes, weights)[0], started + n / rps))
+    for _ in threads:
+        schedule.put(None)
+    for thread in threads:
+        thread.join()
+    return results
+
+def summarize(results, wall):
+    lines = []
+    by_status = {}
+    for _, status, _ in results:
+        by_status[status] = by_status.get(status, 0) + 1
+    ok = sum(count for status, count in by_status.items() if status in (200, 202))
+    lines.append("requests %d in %.1fs, %.1f req/s, errors %.2f%%" % (
+        len(results), wall, len(results) / wall if wall else 0,
+        100.0 * (len(results) - ok) / len(results) if results else 0))
+    lines.append("status   " + ", ".join(
+        "%s: %d" % (status or "failed", count) for status, count in sorted(by_status.items())))
+
+    def row(name, latencies):
+        latencies = sorted(latencies)
+        return "%-18s n=%-7d p50 %8.1f ms  p90 %8.1f ms  p99 %8.1f ms  max %8.1f ms" % (
+            name, len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, (latencies[-1] if latencies else 0) * 1000)
+
+    lines.append(row("all", [latency for _, _, latency in results]))
+    key = lambda result: result[0]
+    for shape, group in itertools.groupby(sorted(results, key=key), key=key):
+        lines.append(row(shape, [latency for _, _, latency in group]))
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive /process at a fixed request rate")
+    parser.add_argument("url", help="base URL of the service, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--rps", type=float, default=50, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--concurrency", type=int, default=64, help="maximum requests in flight")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="receipt shapes with weights, from bench.SHAPES")
+    parser.add_argument("--users", type=int, default=1, help="distinct Basic credentials to rotate through")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, help="seed for the receipt mix")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    results = run(args.url, args.rps, args.duration, args.concurrency, args.mix,
+                  args.users, args.timeout, args.seed)
+    print(summarize(results, time.perf_counter() - started))
+    return 0 if results else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
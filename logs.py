@@ -0,0 +1,141 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+
+# JSON logs written off the request thread. Records go into a bounded queue
+# and a listener thread formats and writes them; when the queue is full,
+# records are dropped instead of blocking the request.
+
+REDACTED = "***"
+
+request_id = contextvars.ContextVar("prpr_request_id", default=None)
+
+def new_request_id(incoming=None):
+    value = incoming if incoming and len(incoming) <= 128 else uuid.uuid4().hex
+    request_id.set(value)
+    return value
+
+class Redactor:
+
+    def __init__(self, fields):
+        self.fields = frozenset(f.strip().lower() for f in fields if f.strip())
+
+    def __call__(self, data):
+        if isinstance(data, dict):
+            return {
+                k: REDACTED if isinstance(k, str) and k.lower() in self.fields and v is not None else self(v)
+                for k, v in data.items()
+            }
+        if isinstance(data, list):
+            return [self(v) for v in data]
+        return data
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        rid = getattr(record, "request_id", None)
+        if rid is not None:
+            entry["request_id"] = rid
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+_exception_formatter = logging.Formatter()
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Non-blocking queue handler that restarts its listener after a fork."""
+
+    def __init__(self, queue, listener_factory):
+        super().__init__(queue)
+        self.listener_factory = listener_factory
+        self.listener = None
+        self.dropped = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.listener = self.listener_factory(self.queue)
+                self.listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Resolve everything that depends on the calling thread or on mutable
+        # arguments before the record crosses to the writer thread
+        record = copy.copy(record)
+        record.request_id = request_id.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+        self._pid = None
+
+redact = Redactor(())
+_payload_sample = 0.0
+_handler = None
+
+def setup(settings, stream=None):
+    """Route the prpr loggers through the background JSON writer."""
+    global redact, _payload_sample, _handler
+    redact = Redactor(settings.LOG_REDACT_FIELDS.split(","))
+    _payload_sample = settings.LOG_PAYLOAD_SAMPLE
+    if _handler is not None:
+        return _handler
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter())
+    _handler = _QueueHandler(
+        queue.Queue(settings.LOG_QUEUE_SIZE),
+        lambda q: logging.handlers.QueueListener(q, output, respect_handler_level=False),
+    )
+    logger = logging.getLogger("prpr")
+    logger.setLevel(settings.LOG_LEVEL.upper())
+    logger.addHandler(_handler)
+    logger.propagate = False
+    atexit.register(shutdown)
+    return _handler
+
+def shutdown():
+    if _handler is not None:
+        _handler.stop()
+
+def sample_payload():
+    return _payload_sample > 0 and (_payload_sample >= 1 or random.random() < _payload_sample)
+
+def get_logger(name):
+    return logging.getLogger("prpr." + name if name else "prpr")
@@ -0,0 +1,171 @@
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+# Minimal Prometheus text-format metrics. Values are per process; under a
+# pre-fork server every worker exposes its own /metrics.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s counter" % self.name
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield "%s%s %s" % (self.name, _format_labels(self.labels, labels), _format_value(value))
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s histogram" % self.name
+        with self._lock:
+            values = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items())
+        for labels, (counts, count, total) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield "%s_bucket%s %d" % (
+                    self.name, _format_labels(self.labels, labels, [("le", _format_value(float(bound)))]), cumulative)
+            yield "%s_bucket%s %d" % (self.name, _format_labels(self.labels, labels, [("le", "+Inf")]), count)
+            yield "%s_count%s %d" % (self.name, _format_labels(self.labels, labels), count)
+            yield "%s_sum%s %s" % (self.name, _format_labels(self.labels, labels), _format_value(total))
+
+class CallbackCounter:
+    """Counter whose values are read from func() -> {labels tuple: value} at scrape time."""
+
+    def __init__(self, name, help, labels, func):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s counter" % self.name
+        for labels, value in sorted(self.func().items()):
+            yield "%s%s %s" % (self.name, _format_labels(self.labels, labels), _format_value(value))
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+requests_total = registry.counter(
+    "prpr_requests_total", "HTTP requests by endpoint and response status", ("endpoint", "status"))
+stage_seconds = registry.histogram(
+    "prpr_stage_seconds", "Time spent in each stage of receipt processing", ("stage",))
+upstream_seconds = registry.histogram(
+    "prpr_upstream_request_seconds", "Latency of vdpaybox calls", ("target",))
+upstream_errors = registry.counter(
+    "prpr_upstream_errors_total", "Failed vdpaybox calls by kind (HTTP status or exception)", ("target", "kind"))
+payload_bytes = registry.histogram(
+    "prpr_request_payload_bytes", "Size of incoming request bodies", ("endpoint",), SIZE_BUCKETS)
+receipt_items = registry.histogram(
+    "prpr_receipt_items", "Line items per receipt", (), COUNT_BUCKETS)
+
+# Stage timings of the current request, for the Server-Timing header
+_timings = contextvars.ContextVar("prpr_stage_timings", default=None)
+
+def begin_request():
+    _timings.set([])
+
+def stage_timings():
+    return _timings.get() or []
+
+@contextlib.contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+def server_timing_header(timings):
+    # Stages repeated within a request (batch items) are summed
+    totals = {}
+    for stage, elapsed in timings:
+        totals[stage] = totals.get(stage, 0) + elapsed
+    return ", ".join("%s;dur=%.3f" % (stage, elapsed * 1000) for stage, elapsed in totals.items())
+
+def observe_upstream(target, started, response=None, error=None):
+    upstream_seconds.observe(time.perf_counter() - started, target)
+    if error is not None:
+        upstream_errors.inc(target, error.__class__.__name__)
+    elif response is not None and response.status_code >= 400:
+        upstream_errors.inc(target, str(response.status_code))
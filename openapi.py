@@ -0,0 +1,33 @@
+import argparse
+import json
+import sys
+
+import settings
+
+# Writes the OpenAPI spec of prpr, built by flasgger from the view docstrings,
+# to a static file. With SWAGGER=static the service serves that file and reads
+# the receipt schema from it, so workers skip flasgger and the YAML parsing.
+#
+#   python openapi.py                # writes OPENAPI_SPEC_PATH
+#   SWAGGER=static gunicorn -c gunicorn.conf.py prpr:app
+
+def build():
+    settings.SWAGGER = 'on'
+    import prpr
+    with prpr.app.test_request_context():
+        return prpr.swagger.get_apispecs()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the static OpenAPI spec for SWAGGER=static")
+    parser.add_argument("-o", "--output", default=settings.OPENAPI_SPEC_PATH, help="file to write")
+    args = parser.parse_args(argv)
+
+    spec = build()
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(spec, f, ensure_ascii=False, indent=1, sort_keys=True)
+        f.write("\n")
+    print("wrote %s (%d paths)" % (args.output, len(spec.get("paths", {}))))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,65 @@
 import json
+import math
+import os
+import time
+import contextvars
 import requests
-from flask import Flask, request, jsonify
-import base64
-from flasgger import Swagger, swag_from
+from flask import Flask, request, jsonify, send_file, url_for
+from flask.json.provider import DefaultJSONProvider
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+import converter
+from converter import convert_receipt, convert_to_atol
+from token_cache import TokenCache, LoginError
+from credentials import Credentials
+from upstream import InvalidResponse
+from idempotency import IdempotencyCache, IdempotencyConflict, cacheable, make_backend, receipt_key
+from delivery_queue import DeliveryQueue, DeliveryWorkers, Retry
+import ratelimit
+import routing
+from ratelimit import RateLimited
+from breaker import CircuitOpen
+import metrics
+import logs
+import jsonlib
+import validation
+import streaming
+import compress
+import capture
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by jsonlib (orjson when available)."""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return jsonlib.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return jsonlib.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(jsonlib.dumps(obj), mimetype=self.mimetype)
+
+# Swagger UI with the spec built from the view docstrings (on), only the spec
+# prebuilt by openapi.py (static), or neither (off). The last two keep
+# flasgger and the YAML parsing out of worker startup.
+if settings.SWAGGER == 'on':
+    from flasgger import Swagger, swag_from
+elif settings.SWAGGER in ('static', 'off'):
+    def swag_from(specs):
+        return lambda view: view
+else:
+    raise ValueError("Unknown SWAGGER mode: %s" % settings.SWAGGER)
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+app.wsgi_app = compress.DecodingMiddleware(app.wsgi_app, settings.DECOMPRESS_MAX_SIZE)
+
+logs.setup(settings)
+log = logs.get_logger("process")
 
 # Custom Swagger configuration
 swagger_template = {
@@ -44,136 +99,458 @@ app.config['SWAGGER'] = {
     }
 }
 
-swagger = Swagger(app)
+# flasgger's default spec URL, kept for the static spec
+SPEC_ROUTE = '/apispec_1.json'
 
-TOKEN_URL = "https://api.stage.vdpaybox.ru/api/atol/login"
-RECEIPT_URL = "https://api.stage.vdpaybox.ru/api/receipt"
+swagger = None
+if settings.SWAGGER == 'on':
+    swagger = Swagger(app)
+elif settings.SWAGGER == 'static':
+    # Validation reads the receipt schema from it too; the docstring is not
+    # a stand-in for a spec that was never generated
+    if not os.path.exists(settings.OPENAPI_SPEC_PATH):
+        raise FileNotFoundError("SWAGGER=static needs %s, written by openapi.py" % settings.OPENAPI_SPEC_PATH)
 
-def get_nested(data, *keys, default=None):
-    for key in keys:
-        data = data.get(key, default)
-        if data is default:
-            break
-    return data
+    @app.route(SPEC_ROUTE, methods=['GET'])
+    def apispec():
+        return send_file(settings.OPENAPI_SPEC_PATH, mimetype="application/json")
 
-def remove_empty_fields(data):
-    def empty(x):
-            return x is None or x == {} or x == []
-    
-    if not isinstance(data, (dict, list)):
-            return data
-    elif isinstance(data, list):
-            return [v for v in (remove_empty_fields(v) for v in data) if not empty(v)]
-    else:
-            return {k: v for k, v in ((k, remove_empty_fields(v)) for k, v in data.items()) if not empty(v)}
-
-def transform_electr(item):
-    return item.get("electronically") != "false"
-
-def transform_marking_code(item):
-    mark_code = item.get("mark_code", {})
-    if mark_code:
-        if "egais20" in mark_code:
-            mark_type = "egais20"
-        elif "egais30" in mark_code:
-            mark_type = "egais30"
-        else:
-            mark_type = "other"
-        return {
-            "type": mark_type,
-            "mark": mark_code[list(mark_code.keys())[0]]
-        }
-    return {
-        "type": "other",
-        "mark": mark_code
-    }
+token_cache = TokenCache(settings.TOKEN_CACHE_TTL, settings.TOKEN_CACHE_SIZE)
+credentials = Credentials(settings.CREDENTIAL_CACHE_SIZE, settings.LOGIN_REJECT_TTL)
+
+idempotency = None
+if settings.IDEMPOTENCY_BACKEND != 'off':
+    idempotency = IdempotencyCache(
+        make_backend(settings.IDEMPOTENCY_BACKEND, settings),
+        settings.IDEMPOTENCY_TTL,
+        wait=settings.IDEMPOTENCY_WAIT,
+    )
+
+router = routing.Router(settings, ratelimit.make_backend(settings.RATE_LIMIT_BACKEND, settings))
+router.reload(settings.UPSTREAMS_PATH)
+
+def login(auth_header, upstream):
+    key = token_key(upstream, auth_header)
+    credentials.check(key)
+    breaker = upstream.breakers["token"]
+    with upstream.limiter.slot():
+        breaker.before()
+        started = time.perf_counter()
+        try:
+            response = upstream.client.get(upstream.token_url, headers={"Authorization": auth_header})
+        except requests.RequestException as e:
+            breaker.after(started, error=e)
+            metrics.observe_upstream("token", started, error=e)
+            raise
+        except BaseException:
+            # Cancelled or failed before an answer; frees a half-open probe
+            breaker.abandon()
+            raise
+        breaker.after(started, response)
+        metrics.observe_upstream("token", started, response)
+    try:
+        return token_from_response(response)
+    except LoginError as e:
+        credentials.reject(key, e)
+        raise
+
+def token_from_response(response):
+    try:
+        body = jsonlib.loads(response.content)
+    except ValueError:
+        raise InvalidResponse("Token response with status %d is not JSON" % response.status_code)
+    if response.status_code != 200:
+        raise LoginError(body, response.status_code)
+
+    token = body.get('token')
+    orgid = body.get('orgId')
+    if not token:
+        raise LoginError({"error": "Token not found in response"}, 400)
+    log.debug("Logged in", extra={"fields": {"org_id": orgid}})
+    return token, orgid
+
+def receipt_body(data, upstream, headers):
+    """Serialized receipt, compressed when the upstream is configured for it."""
+    coding = upstream.options["compression"]
+    if isinstance(data, streaming.StreamedReceipt):
+        # A generator body goes out with chunked transfer encoding
+        body = data.chunks()
+        if coding:
+            body = compress.encode_chunks(body, coding)
+            headers["Content-Encoding"] = coding
+        return body
+    body = jsonlib.dumps(data)
+    if coding and len(body) >= settings.COMPRESS_MIN_SIZE:
+        body = compress.encode(body, coding)
+        headers["Content-Encoding"] = coding
+    return body
+
+def send_receipt(data, token, upstream):
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    breaker = upstream.breakers["receipt"]
+    with upstream.limiter.slot():
+        breaker.before()
+        started = time.perf_counter()
+        try:
+            response = upstream.client.post(
+                upstream.receipt_url, data=receipt_body(data, upstream, headers), headers=headers
+            )
+        except requests.RequestException as e:
+            breaker.after(started, error=e)
+            metrics.observe_upstream("receipt", started, error=e)
+            raise
+        except BaseException:
+            # Cancelled or failed before an answer; frees a half-open probe
+            breaker.abandon()
+            raise
+        breaker.after(started, response)
+        metrics.observe_upstream("receipt", started, response)
+    return response
 
-def transform_payment_object(item):
-    payment_object = item.get("payment_object")
-    tr_list = {
-        1: "commodity",
-        2: "excise",
-        3: "job",
-        4: "service",
-        5: "gamblingBet",
-        6: "gamblingPrize",
-        7: "lottery",
-        8: "lotteryPrize",
-        9: "intellectualActivity",
-        10: "payment",
-        11: "agentCommission",
-        12: "pay",
-        13: "another",
-        14: "proprietaryLaw",
-        15: "nonOperatingIncome",
-        16: "otherContributions",
-        17: "merchantTax",
-        18: "resortFee",
-        19: "deposit",
-        20: "consumption",
-        21: "soleProprietorCPIContributions",
-        22: "cpiContributions",
-        23: "soleProprietorCMIContributions",
-        24: "cmiContributions",
-        25: "csiContributions",
-        26: "casinoPayment",
-        27: "bankAgentPayment",
-        30: "markedExciseNoCode",
-        31: "markedExciseWithCode",
-        32: "markedCommodityNoCode",
-        33: "markedCommodityWithCode"
+conversion_capture = None
+if settings.CAPTURE_SAMPLE > 0:
+    conversion_capture = capture.Capture(
+        settings.CAPTURE_DIR,
+        settings.CAPTURE_SAMPLE,
+        settings.CAPTURE_SEGMENT_SIZE,
+        settings.CAPTURE_KEEP,
+        settings.CAPTURE_QUEUE_SIZE,
+    )
+
+shadow = None
+if settings.SHADOW_TRANSFORMER and settings.SHADOW_PERCENT > 0:
+    shadow = capture.Shadow(settings.SHADOW_TRANSFORMER, settings.SHADOW_PERCENT, settings.CAPTURE_QUEUE_SIZE)
+
+def observe_conversion(input_data, orgid, output):
+    if conversion_capture is not None:
+        conversion_capture.record(input_data, output)
+    if shadow is not None:
+        shadow.offer(input_data, orgid, output)
+
+def stream_observers():
+    """observe_conversion() for a streamed receipt, sampled up front so that
+    its input items are only kept when capture or shadow takes it."""
+    observers = []
+    if conversion_capture is not None and conversion_capture.sampled():
+        observers.append(lambda input_data, orgid, output: conversion_capture.write(input_data, output))
+    if shadow is not None and shadow.sampled():
+        observers.append(shadow.compare)
+    return observers
+
+def observe_items(input_data):
+    receipt = input_data.get("receipt") if isinstance(input_data, dict) else None
+    items = receipt.get("items") if isinstance(receipt, dict) else None
+    if isinstance(items, list):
+        metrics.receipt_items.observe(len(items))
+
+metrics.registry.register(metrics.CallbackCounter(
+    "prpr_token_cache_requests_total", "Token cache lookups by result", ("result",),
+    lambda: {(result,): count for result, count in token_cache.stats.items()}
+))
+metrics.registry.register(metrics.CallbackCounter(
+    "prpr_rejected_logins_total", "Logins rejected upstream and requests refused without a login", ("result",),
+    lambda: {(result,): count for result, count in credentials.stats.items()}
+))
+metrics.registry.register(metrics.CallbackCounter(
+    "prpr_unknown_codes_total", "ATOL codes missing from the mapping tables", ("field", "code"),
+    converter.unknown_codes
+))
+metrics.registry.register(metrics.CallbackCounter(
+    "prpr_rate_limit_total", "Upstream calls held back by rate or concurrency limits", ("upstream", "result"),
+    lambda: {
+        (name, result): count
+        for name, upstream in router.upstreams.items()
+        for result, count in upstream.limiter.stats.items()
     }
-    return tr_list.get(payment_object, "unknown")
-
-def transform_payment_method(item):
-    payment_method = item.get("payment_method")
-    pm_list = {
-        "full_prepayment": "fullPrepayment",
-        "prepayment": "prepayment",
-        "advance": "advance",
-        "full_payment": "fullPayment",
-        "partial_payment": "partialPayment",
-        "credit": "credit",
-        "credit_payment": "creditPayment"
+))
+metrics.registry.register(metrics.CallbackCounter(
+    "prpr_circuit_breaker_total", "Circuit breaker openings and refused calls", ("upstream", "target", "result"),
+    lambda: {
+        (name, target, result): count
+        for name, upstream in router.upstreams.items()
+        for target, breaker in upstream.breakers.items()
+        for result, count in breaker.stats.items()
     }
-    return pm_list.get(payment_method, "unknown")
+))
+if conversion_capture is not None:
+    metrics.registry.register(metrics.CallbackCounter(
+        "prpr_capture_total", "Captured conversions written or dropped", ("result",),
+        lambda: {(result,): count for result, count in conversion_capture.stats.items()}
+    ))
+if shadow is not None:
+    metrics.registry.register(metrics.CallbackCounter(
+        "prpr_shadow_total", "Shadow conversions by comparison result", ("result",),
+        lambda: {(result,): count for result, count in shadow.stats.items()}
+    ))
+if idempotency is not None:
+    metrics.registry.register(metrics.CallbackCounter(
+        "prpr_idempotency_requests_total", "Idempotency lookups by result", ("result",),
+        lambda: {(result,): count for result, count in idempotency.stats.items()}
+    ))
 
-def transform_agent(items):
-    agents = items.get("agent_info",{})
-    if agents:
-        return ["another"]
-    else:
-        return None
-
-def transform_measure(item):
-    measurement_unit = item.get("measure")
-    units_list = {
-        0: "шт",
-        10: "Грамм",
-        11: "Килограмм",
-        12: "Тонна",
-        20: "Сантиметр",
-        21: "Дециметр",
-        22: "Метр",
-        30: "Квадратный сантиметр",
-        31: "Квадратный дециметр",
-        32: "Квадратный метр",
-        40: "Миллилитр",
-        41: "Литр",
-        42: "Кубический метр",
-        50: "Киловатт час",
-        51: "Гигакалория",
-        70: "Сутки (день)",
-        71: "Час",
-        72: "Минута",
-        73: "Секунда",
-        80: "Килобайт",
-        81: "Мегабайт",
-        82: "Гигабайт",
-        83: "Терабайт",
-        255: "иное"
+converter.reload_mappings(settings.MAPPINGS_PATH)
+
+def watch(name, interval, reload):
+    """Return a check() for request hooks that calls reload() at most once per
+    ``interval`` seconds; reload returns the new version or None if unchanged."""
+    config_log = logs.get_logger(name)
+    checked = [time.monotonic()]
+
+    def check():
+        now = time.monotonic()
+        if not interval or now - checked[0] < interval:
+            return
+        checked[0] = now
+        try:
+            version = reload()
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            # Keep running with the config already loaded
+            config_log.error("Failed to reload %s" % name, extra={"fields": {"error": repr(e)}})
+            return
+        if version is not None:
+            config_log.info("Reloaded %s" % name, extra={"fields": {"version": version}})
+    return check
+
+check_mappings = watch("mappings", settings.MAPPINGS_RELOAD_INTERVAL,
+                       lambda: converter.reload_mappings(settings.MAPPINGS_PATH))
+check_routes = watch("upstreams", settings.UPSTREAMS_RELOAD_INTERVAL,
+                     lambda: router.reload(settings.UPSTREAMS_PATH))
+
+def check_config():
+    check_mappings()
+    check_routes()
+
+@app.before_request
+def start_request_metrics():
+    check_config()
+    logs.new_request_id(request.headers.get("X-Request-ID"))
+    metrics.begin_request()
+    length = request_length()
+    if length:
+        metrics.payload_bytes.observe(length, request.endpoint or "unknown")
+
+@app.after_request
+def record_request_metrics(response):
+    metrics.requests_total.inc(request.endpoint or "unknown", str(response.status_code))
+    response.headers["X-Request-ID"] = logs.request_id.get()
+    if settings.SERVER_TIMING:
+        timings = metrics.stage_timings()
+        if timings:
+            response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+    if settings.RESPONSE_COMPRESSION:
+        compress_response(response)
+    return response
+
+def request_length():
+    # Bytes on the wire; a compressed body has no decoded length up front
+    return request.content_length or request.environ.get("prpr.encoded_length")
+
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 304) or "Content-Encoding" in response.headers):
+        return
+    response.vary.add("Accept-Encoding")
+    coding = compress.negotiate(request.headers.get("Accept-Encoding"))
+    data = response.get_data()
+    if coding is None or len(data) < settings.COMPRESS_MIN_SIZE:
+        return
+    response.set_data(compress.encode(data, coding))
+    response.headers["Content-Encoding"] = coding
+
+@app.errorhandler(compress.DecodeError)
+def undecodable_body(e):
+    return jsonify({"error": str(e)}), e.status_code
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    return metrics.registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# 503 while a circuit of the default upstream (or the one named by
+# ?upstream=) is open, so a load balancer can route around it. Another
+# tenant's upstream being down is reported, but does not take this instance
+# out for everyone.
+@app.route('/health', methods=['GET'])
+def health():
+    upstreams = {
+        name: {target: breaker.snapshot() for target, breaker in upstream.breakers.items()}
+        for name, upstream in router.upstreams.items()
     }
-    return units_list.get(measurement_unit, "unknown")
+    checked = request.args.get("upstream") or router.default.name
+    if checked not in upstreams:
+        return jsonify({"error": "Unknown upstream: %s" % checked}), 404
+    states = {info["state"] for targets in upstreams.values() for info in targets.values()}
+    if any(info["state"] == "open" for info in upstreams[checked].values()):
+        status, summary = 503, "unavailable"
+    elif "open" in states:
+        status, summary = 200, "degraded"
+    elif "half_open" in states:
+        # Probing the upstream; it needs traffic to close again
+        status, summary = 200, "recovering"
+    else:
+        status, summary = 200, "ok"
+    return jsonify({
+        "status": summary,
+        "upstream": upstreams,
+        "mappings": converter.current_mappings().version,
+        "routes": router.version,
+    }), status
+
+def check_basic_auth(auth_header):
+    credential = credentials.parse(auth_header)
+    return credential.username, credential.password
+
+def route(auth_header):
+    return router.route(credentials.parse(auth_header).username)
+
+def token_key(upstream, auth_header):
+    # A token is only good on the upstream that issued it
+    return upstream.name + ":" + credentials.parse(auth_header).key
+
+def get_token(auth_header):
+    upstream = route(auth_header)
+    return token_cache.get(token_key(upstream, auth_header), lambda: login(auth_header, upstream))
+
+def rate_key(data, auth_header):
+    if settings.RATE_LIMIT_KEY == 'org' and data.get("orgId"):
+        return "org:%s" % data["orgId"]
+    return "credential:" + credentials.parse(auth_header).key
+
+def retry_after(error):
+    return str(max(1, math.ceil(error.retry_after)))
+
+# Exceptions of a login or delivery that are answered with upstream_error();
+# asgi.py adds httpx.HTTPError
+UPSTREAM_ERRORS = (LoginError, RateLimited, CircuitOpen, IdempotencyConflict, requests.RequestException)
+
+def upstream_error(error, message):
+    """(status, body, headers) answering one of UPSTREAM_ERRORS; ``message``
+    is the error for a failed connection or timeout."""
+    if isinstance(error, LoginError):
+        return error.status_code, error.body, {}
+    if isinstance(error, RateLimited):
+        return 429, {"error": "Too many requests"}, {"Retry-After": retry_after(error)}
+    if isinstance(error, CircuitOpen):
+        return 503, {"error": "Upstream unavailable"}, {"Retry-After": retry_after(error)}
+    if isinstance(error, IdempotencyConflict):
+        return 409, {"error": "Receipt with this external_id is already being processed"}, {}
+    return 502, {"error": message}, {}
+
+def error_response(error, message):
+    status, body, headers = upstream_error(error, message)
+    return jsonify(body), status, headers
+
+def batch_error(error):
+    """upstream_error() as a /process/batch result."""
+    status, body, headers = upstream_error(error, "Failed to send receipt data")
+    result = {"status": status, "error": body if isinstance(error, LoginError) else body["error"]}
+    if "Retry-After" in headers:
+        result["retry_after"] = int(headers["Retry-After"])
+    return result
+
+def forward_receipt(data, auth_header, token):
+    upstream = route(auth_header)
+    with metrics.timed("throttle"):
+        upstream.limiter.throttle(rate_key(data, auth_header))
+    response = send_receipt(data, token, upstream)
+
+    if response.status_code == 401:
+        # The cached token may have expired upstream before our TTL; log in once more
+        token_cache.invalidate(token_key(upstream, auth_header), token)
+        token, orgid = get_token(auth_header)
+        if orgid is not None:
+            data["orgId"] = orgid
+        response = send_receipt(data, token, route(auth_header))
+    return response
+
+def response_body(response, passthrough=False):
+    if passthrough and response.status_code == 200:
+        return jsonlib.RawJSON(response.content)
+    try:
+        return jsonlib.loads(response.content)
+    except ValueError:
+        raise InvalidResponse("Receipt response with status %d is not JSON" % response.status_code)
+
+def idempotency_key(upstream, data, auth_header):
+    orgid = data.get("orgId")
+    # Without an orgId the credential keeps tenants apart
+    owner = "org:%s" % orgid if orgid else "credential:" + credentials.parse(auth_header).key
+    return receipt_key(upstream.name, owner, data.get("externId"))
+
+def deliver(data, auth_header, token, passthrough=False):
+    """Forward the receipt, returning (status, body, replayed).
+
+    A receipt whose upstream, orgId and externId were already delivered within
+    IDEMPOTENCY_TTL gets the stored upstream answer instead of a second POST.
+    With passthrough, a successful body is returned undecoded as RawJSON.
+    """
+    def send():
+        response = forward_receipt(data, auth_header, token)
+        return response.status_code, response_body(response, passthrough)
+
+    upstream = route(auth_header)
+    key = idempotency_key(upstream, data, auth_header)
+    if idempotency is None or key is None:
+        return send() + (False,)
+    # The pending marker must outlive the slowest possible send()
+    return idempotency.run(key, send, lease=upstream.delivery_time)
+
+def deliver_queued(data, auth_header):
+    try:
+        # Receipts are queued before any login; the orgId is filled in here
+        token, orgid = get_token(auth_header)
+        if orgid is not None:
+            data["orgId"] = orgid
+        status, body, replayed = deliver(data, auth_header, token)
+    except LoginError as e:
+        if e.status_code >= 500 or e.status_code in (408, 429):
+            raise Retry("Failed to get token", e.status_code, e.body)
+        return e.status_code, e.body
+    except requests.RequestException as e:
+        raise Retry("Failed to send receipt data: %s" % e.__class__.__name__)
+    except IdempotencyConflict:
+        raise Retry("Receipt with this external_id is already being processed")
+    except RateLimited:
+        raise Retry("Rate limited")
+    except CircuitOpen:
+        raise Retry("Upstream circuit is open")
+    if status != 200 and not cacheable(status):
+        raise Retry("Upstream returned %d" % status, status, body)
+    return status, body
+
+delivery_queue = None
+delivery_workers = None
+if settings.ASYNC_DELIVERY:
+    delivery_queue = DeliveryQueue(settings.DELIVERY_QUEUE_PATH)
+    delivery_workers = DeliveryWorkers(
+        delivery_queue,
+        deliver_queued,
+        threads=settings.DELIVERY_WORKERS,
+        max_attempts=settings.DELIVERY_MAX_ATTEMPTS,
+        backoff=settings.DELIVERY_BACKOFF,
+        backoff_max=settings.DELIVERY_BACKOFF_MAX,
+        lease=settings.DELIVERY_LEASE,
+        retention=settings.DELIVERY_RETENTION,
+    )
+    # Pick up receipts left over from a previous run
+    delivery_workers.start()
+
+def enqueue_receipt(data, auth_header):
+    """Persist a converted receipt for background delivery; returns its status dict."""
+    delivery_workers.start()
+    # The orgId is not known until delivery logs in, so this is keyed by credential
+    receipt_id = delivery_queue.enqueue(data, auth_header, idempotency_key(route(auth_header), data, auth_header))
+    delivery_workers.notify()
+    return delivery_queue.status(receipt_id)
+
+def queue_receipt(input_data, auth_header):
+    """Convert and enqueue a validated receipt without logging in, so that
+    accepting it never waits on the upstream; returns its status dict."""
+    observe_items(input_data)
+    with metrics.timed("convert"):
+        cleaned_target_data = convert_receipt(input_data)
+    observe_conversion(input_data, None, cleaned_target_data)
+    with metrics.timed("enqueue"):
+        return enqueue_receipt(cleaned_target_data, auth_header)
 
 @app.route('/process', methods=['POST'])
 @swag_from({
@@ -189,6 +566,17 @@ def transform_measure(item):
                 }
             }
         },
+        202: {
+            'description': 'Accepted for background delivery (ASYNC_DELIVERY mode), see GET /process/{id}',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'id': '3f2b6c1e9a8d4e0f8b7a6c5d4e3f2a1b',
+                        'status': 'queued'
+                    }
+                }
+            }
+        },
         400: {
             'description': 'Bad Request',
             'content': {
@@ -208,6 +596,59 @@ def transform_measure(item):
                     }
                 }
             }
+        },
+        422: {
+            'description': 'The receipt does not match the schema; nothing was sent upstream',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Receipt validation failed',
+                        'errors': [
+                            {'field': 'receipt.items[0].price', 'error': 'should be number'}
+                        ]
+                    }
+                }
+            }
+        },
+        409: {
+            'description': 'A receipt with the same external_id is still being processed',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Receipt with this external_id is already being processed'
+                    }
+                }
+            }
+        },
+        429: {
+            'description': 'Upstream limits exhausted; retry after the Retry-After seconds',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Too many requests'
+                    }
+                }
+            }
+        },
+        503: {
+            'description': 'Upstream circuit breaker is open; retry after the Retry-After seconds',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Upstream unavailable'
+                    }
+                }
+            }
+        },
+        502: {
+            'description': 'Upstream unavailable',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Failed to send receipt data'
+                    }
+                }
+            }
         }
     }
 })
@@ -228,12 +669,24 @@ def process():
         required: true
         schema:
           type: object
+          required:
+            - external_id
+            - receipt
           properties:
             external_id:
               type: string
               example: "892924433534522515289444"
+            device_number:
+              type: string
+              example: "KKT014034"
+            electronically:
+              description: Send the receipt electronically unless "false"
+              example: "true"
             receipt:
               type: object
+              required:
+                - items
+                - payments
               properties:
                 client:
                   type: object
@@ -284,6 +737,11 @@ def process():
                   type: array
                   items:
                     type: object
+                    required:
+                      - name
+                      - price
+                      - quantity
+                      - sum
                     properties:
                       name:
                         type: string
@@ -491,119 +949,548 @@ def process():
                         type: string
                         example: "Ид1=Знач1&Ид2=Знач2&Ид3=Знач3"
     """
-    input_data = request.json
+    if should_stream():
+        return process_stream()
+
+    with metrics.timed("parse"):
+        input_data = request.json
+    if not isinstance(input_data, dict):
+        return jsonify({"error": "Body should be a JSON object"}), 400
     auth_header = request.headers.get('Authorization')
     
-    if not auth_header or not auth_header.startswith('Basic '):
-        return jsonify({"error": "Authorization header is required and should be Basic"}), 400
-    
-    auth_encoded = auth_header.split(' ')[1]
-    auth_decoded = base64.b64decode(auth_encoded).decode('utf-8')
-    username, password = auth_decoded.split(':')
+    try:
+        with metrics.timed("auth"):
+            username, password = check_basic_auth(auth_header)
+    except LoginError as e:
+        return jsonify(e.body), e.status_code
     
-    if not password:
-        print(request.headers)
-        return jsonify({"error": "Password is required"}), 400
-    
-    response = requests.get(TOKEN_URL, headers={"Authorization": auth_header})
+    errors = validate_receipt(input_data)
+    if errors:
+        return jsonify({"error": "Receipt validation failed", "errors": errors}), 422
+
+    if delivery_queue is not None:
+        queued = queue_receipt(input_data, auth_header)
+        location = url_for('process_status', receipt_id=queued["id"])
+        return jsonify({"id": queued["id"], "status": queued["status"]}), 202, {"Location": location}
     
-    if response.status_code != 200:
-        print(username, "\n", password)
-        return jsonify(response.json()), response.status_code
+    try:
+        with metrics.timed("token"):
+            token, orgid = get_token(auth_header)
+    except UPSTREAM_ERRORS as e:
+        log_login_failure(username, e)
+        return error_response(e, "Failed to get token")
     
-    token = response.json().get('token')
-    orgid = response.json().get('orgId')
-    data = response.content
-    print(data)
-    if not token:
-        return jsonify({"error": "Token not found in response"}), 400
+    observe_items(input_data)
+    with metrics.timed("convert"):
+        cleaned_target_data = convert_receipt(input_data, orgid)
+    observe_conversion(input_data, orgid, cleaned_target_data)
+
+    try:
+        with metrics.timed("deliver"):
+            status, body, replayed = deliver(
+                cleaned_target_data, auth_header, token, settings.PASSTHROUGH_RESPONSE
+            )
+    except UPSTREAM_ERRORS as e:
+        return error_response(e, "Failed to send receipt data")
     
-    target_data = {
-        "externId": input_data.get("external_id"),
-        "externDeviceId": input_data.get("device_number"),
-        "recreatePayment": None,  # Not found
-        "orgId": orgid,
-        "cashboxId": None,  # Not found
-        "receiptBody": {
-            "externId": input_data.get("external_id"),
-            "type": "sell",  # E
-            "taxationType": get_nested(input_data, "receipt", "company", "sno"),
-            "electronically": transform_electr(input_data),
-            "paymentsPlace": get_nested(input_data, "receipt", "client", "address"),
-            "operator": {
-                "name": get_nested(input_data, "receipt", "client", "name"),
-                "vatin": get_nested(input_data, "receipt", "client", "inn")
-            },
-            "clientInfo": {
-                "emailOrPhone": get_nested(input_data, "receipt", "client", "email"),
-                "vatin": get_nested(input_data, "receipt", "client", "inn"),
-                "name": get_nested(input_data, "receipt", "client", "name")
-            },
-            "items": [
-                {
-                    "type": "position",
-                    "name": item.get("name"),
-                    "price": item.get("price"),
-                    "quantity": item.get("quantity"),
-                    "amount": item.get("sum"),
-                    "measurementUnit": transform_measure(item),
-                    "paymentMethod": transform_payment_method(item),
-                    "paymentObject": transform_payment_object(item),
-                                        "supplierInfo": {
-                        "phones": item.get("supplier_info", {}).get("phones"),
-                        "name": item.get("supplier_info", {}).get("name"),
-                        "vatin": item.get("supplier_info", {}).get("inn")
-                    },
-                    "tax": {
-                        "type": item.get("vat", {}).get("type"),
-                        "sum": item.get("vat", {}).get("sum")
-                    },
-                    "markingCode": transform_marking_code(item),
-
-                    "agentInfo": {
-                        "agents": transform_agent(item),
-                        "payingAgent": {
-                            "operation": item.get("agent_info", {}).get("paying_agent", {}).get("operation"),
-                            "phones": item.get("agent_info", {}).get("paying_agent", {}).get("phones")
-                        },
-                        "receivePaymentsOperator": {
-                            "phones": item.get("agent_info", {}).get("receive_payments_operator", {}).get("phones")
-                        },
-                        "moneyTransferOperator": {
-                            "phones": item.get("agent_info", {}).get("money_transfer_operator", {}).get("phones"),
-                            "name": item.get("agent_info", {}).get("money_transfer_operator", {}).get("name"),
-                            "address": item.get("agent_info", {}).get("money_transfer_operator", {}).get("address"),
-                            "vatin": item.get("agent_info", {}).get("money_transfer_operator", {}).get("inn")
-                        }
+    log_delivery(status, body, replayed, cleaned_target_data)
+    headers = {"Idempotent-Replayed": "true"} if replayed else {}
+    return jsonify(body), status, headers
+
+def load_receipt_schema():
+    if settings.SWAGGER != 'on' and os.path.exists(settings.OPENAPI_SPEC_PATH):
+        with open(settings.OPENAPI_SPEC_PATH, encoding="utf-8") as f:
+            return validation.spec_body_schema(json.load(f), "/process", "post")
+    return validation.body_schema(process.__doc__)
+
+receipt_validator = item_validator = None
+if settings.VALIDATION != 'off':
+    receipt_schema = load_receipt_schema()
+    receipt_validator = validation.from_schema(receipt_schema, settings.VALIDATION)
+    item_validator = validation.from_schema(
+        receipt_schema["properties"]["receipt"]["properties"]["items"]["items"], settings.VALIDATION
+    )
+
+def validate_receipt(input_data):
+    if receipt_validator is None:
+        return []
+    with metrics.timed("validate"):
+        return receipt_validator(input_data)
+
+def validate_batch(receipts):
+    """Map of index -> result for receipts that fail validation."""
+    invalid = {}
+    for index, receipt in enumerate(receipts):
+        errors = validate_receipt(receipt)
+        if errors:
+            invalid[index] = {"status": 422, "error": "Receipt validation failed", "errors": errors}
+    return invalid
+
+def should_stream():
+    if streaming.ijson is None or not settings.STREAM_THRESHOLD or delivery_queue is not None:
+        return False
+    length = request_length()
+    return length is None or length >= settings.STREAM_THRESHOLD
+
+def process_stream():
+    """process() for large bodies: items are validated and converted while the
+    body is read, then sent upstream from the spool as a chunked request."""
+    auth_header = request.headers.get('Authorization')
+    try:
+        with metrics.timed("auth"):
+            username, password = check_basic_auth(auth_header)
+    except LoginError as e:
+        return jsonify(e.body), e.status_code
+
+    observers = stream_observers()
+    data = streaming.StreamedReceipt(settings.STREAM_SPOOL_SIZE, keep_input=bool(observers))
+    try:
+        item_errors = []
+
+        def on_item(index, item):
+            if item_validator is not None:
+                item_errors.extend(item_validator(item, "receipt.items[%d]" % index))
+            if not item_errors:
+                data.add_item(item)
+
+        # Includes validating and converting the items
+        with metrics.timed("parse"):
+            try:
+                input_data = streaming.parse_receipt(request.stream, on_item)
+            except ValueError:
+                return jsonify({"error": "Body should be a JSON object"}), 400
+        if not isinstance(input_data, dict):
+            return jsonify({"error": "Body should be a JSON object"}), 400
+
+        errors = validate_receipt(input_data) + item_errors
+        if errors:
+            return jsonify({"error": "Receipt validation failed", "errors": errors}), 422
+
+        try:
+            with metrics.timed("token"):
+                token, orgid = get_token(auth_header)
+        except UPSTREAM_ERRORS as e:
+            log_login_failure(username, e)
+            return error_response(e, "Failed to get token")
+
+        metrics.receipt_items.observe(data.count)
+        with metrics.timed("convert"):
+            data.update(convert_receipt(input_data, orgid))
+
+        try:
+            with metrics.timed("deliver"):
+                status, body, replayed = deliver(data, auth_header, token, settings.PASSTHROUGH_RESPONSE)
+        except UPSTREAM_ERRORS as e:
+            return error_response(e, "Failed to send receipt data")
+
+        if observers:
+            # Read back into memory only after delivery, and only when sampled
+            if data.count:
+                input_data["receipt"]["items"] = data.input_items()
+            output = data.load()
+            for observe in observers:
+                observe(input_data, orgid, output)
+    finally:
+        data.close()
+
+    log_delivery(status, body, replayed, data)
+    headers = {"Idempotent-Replayed": "true"} if replayed else {}
+    return jsonify(body), status, headers
+
+def log_login_failure(username, error):
+    if not isinstance(error, LoginError):
+        return
+    log.warning("Login failed", extra={"fields": {"user": username, "status": error.status_code}})
+
+def log_delivery(status, body, replayed, data):
+    fields = {
+        "status": status,
+        "extern_id": data.get("externId"),
+        "org_id": data.get("orgId"),
+        "replayed": replayed,
+    }
+    if status != 200:
+        fields["payload"] = logs.redact(data)
+        fields["response"] = logs.redact(body)
+        log.warning("Upstream rejected receipt", extra={"fields": fields})
+        return
+    if logs.sample_payload():
+        fields["payload"] = logs.redact(data)
+    log.info("Receipt delivered", extra={"fields": fields})
+
+def convert_batch_item(input_data, orgid):
+    if not isinstance(input_data, dict):
+        raise ValueError("Receipt should be an object")
+    observe_items(input_data)
+    try:
+        with metrics.timed("convert"):
+            cleaned_target_data = convert_receipt(input_data, orgid)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError("Failed to convert receipt")
+    observe_conversion(input_data, orgid, cleaned_target_data)
+    return cleaned_target_data
+
+def queue_batch_item(input_data, auth_header):
+    try:
+        cleaned_target_data = convert_batch_item(input_data, None)
+    except ValueError as e:
+        return {"status": 400, "error": str(e)}
+    queued = enqueue_receipt(cleaned_target_data, auth_header)
+    return {"status": 202, "id": queued["id"], "delivery": queued["status"]}
+
+def process_batch_item(input_data, auth_header, token, orgid):
+    try:
+        cleaned_target_data = convert_batch_item(input_data, orgid)
+    except ValueError as e:
+        return {"status": 400, "error": str(e)}
+    try:
+        with metrics.timed("deliver"):
+            status, body, replayed = deliver(cleaned_target_data, auth_header, token)
+    except UPSTREAM_ERRORS as e:
+        return batch_error(e)
+    return batch_item_result(status, body, replayed, cleaned_target_data)
+
+def batch_item_result(status, body, replayed, cleaned_target_data):
+    log_delivery(status, body, replayed, cleaned_target_data)
+    if status != 200:
+        result = {"status": status, "error": body}
+    else:
+        result = {"status": 200, "data": jsonlib.plain(body)}
+    if replayed:
+        result["replayed"] = True
+    return result
+
+@app.route('/process/batch', methods=['POST'])
+@swag_from({
+    'responses': {
+        200: {
+            'description': 'Per-receipt results in request order',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'results': [
+                            {'status': 200, 'data': {}},
+                            {'status': 400, 'error': 'Failed to convert receipt'}
+                        ]
+                    }
+                }
+            }
+        },
+        400: {
+            'description': 'Bad Request',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Body should be a list of receipts'
+                    }
+                }
+            }
+        },
+        413: {
+            'description': 'Too many receipts in one batch',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Batch is too large'
+                    }
+                }
+            }
+        },
+        429: {
+            'description': 'Upstream limits exhausted; retry after the Retry-After seconds',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Too many requests'
+                    }
+                }
+            }
+        },
+        503: {
+            'description': 'Upstream circuit breaker is open; retry after the Retry-After seconds',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Upstream unavailable'
                     }
-                } for item in get_nested(input_data, "receipt", "items", default=[])
-            ],
-            "payments": [
-                {
-                    "sum": payment.get("sum"),
-                    "type": "electronically"
-                } for payment in get_nested(input_data, "receipt", "payments", default=[])
-            ],
-            "taxes": [
-                {
-                    "type": tax.get("type"),
-                    "sum": tax.get("sum")
-                } for tax in get_nested(input_data, "receipt", "vats", default=[])
-            ]
+                }
+            }
         }
     }
+})
+def process_batch():
+    """
+    Process a batch of receipts
+    Logs in once for the whole batch and forwards every receipt to the upstream.
+    A failed receipt does not fail the batch; check the status of each result.
+    ---
+    tags:
+      - Receipt
+    parameters:
+      - name: Authorization
+        in: header
+        type: string
+        required: true
+        description: Basic authorization header
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: array
+          description: Receipts in the same format as /process
+          items:
+            type: object
+    """
+    with metrics.timed("parse"):
+        input_data = request.json
+    auth_header = request.headers.get('Authorization')
 
-    cleaned_target_data = remove_empty_fields(target_data)
-    clear_data = target_data
+    if not isinstance(input_data, list):
+        return jsonify({"error": "Body should be a list of receipts"}), 400
+    if len(input_data) > settings.BATCH_MAX_SIZE:
+        return jsonify({"error": "Batch is too large"}), 413
 
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.post(RECEIPT_URL, json=cleaned_target_data, headers=headers)
-    
-    if response.status_code != 200:
-        print(cleaned_target_data)
-        return jsonify(response.json()), response.status_code
+    try:
+        with metrics.timed("auth"):
+            username, password = check_basic_auth(auth_header)
+    except LoginError as e:
+        return jsonify(e.body), e.status_code
+
+    # Invalid receipts are answered without any upstream call
+    invalid = validate_batch(input_data)
+    if len(invalid) == len(input_data):
+        return jsonify({"results": [invalid[i] for i in range(len(input_data))]}), 200
+
+    if delivery_queue is not None:
+        # Queued without logging in, like /process
+        return jsonify({"results": [
+            invalid[index] if index in invalid else queue_batch_item(receipt, auth_header)
+            for index, receipt in enumerate(input_data)
+        ]}), 200
+
+    try:
+        with metrics.timed("token"):
+            token, orgid = get_token(auth_header)
+    except UPSTREAM_ERRORS as e:
+        log_login_failure(username, e)
+        return error_response(e, "Failed to get token")
+
+    def run(index, receipt):
+        if index in invalid:
+            return invalid[index]
+        return process_batch_item(receipt, auth_header, token, orgid)
+
+    workers = min(settings.BATCH_CONCURRENCY, len(input_data) - len(invalid))
+    # Run items in a copy of this request's context so their logs keep the request id
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda args: context.copy().run(run, *args),
+            enumerate(input_data)
+        ))
+
+    return jsonify({"results": results}), 200
+
+@app.route('/process/<receipt_id>', methods=['GET'])
+@swag_from({
+    'responses': {
+        200: {
+            'description': 'Delivery status of a receipt accepted with 202',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'id': '3f2b6c1e9a8d4e0f8b7a6c5d4e3f2a1b',
+                        'status': 'delivered',
+                        'attempts': 1,
+                        'upstream_status': 200,
+                        'response': {},
+                        'error': None,
+                        'created': 1700000000.0,
+                        'updated': 1700000001.5
+                    }
+                }
+            }
+        },
+        404: {
+            'description': 'Unknown receipt id',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Receipt not found'
+                    }
+                }
+            }
+        }
+    }
+})
+def process_status(receipt_id):
+    """
+    Delivery status of a queued receipt
+    Status is one of queued, delivering, delivered or failed.
+    ---
+    tags:
+      - Receipt
+    parameters:
+      - name: receipt_id
+        in: path
+        type: string
+        required: true
+        description: Id returned by /process with status 202
+    """
+    status = delivery_queue.status(receipt_id) if delivery_queue is not None else None
+    if status is None:
+        return jsonify({"error": "Receipt not found"}), 404
+    return jsonify(status), 200
+
+def reverse_item(input_data):
+    if not isinstance(input_data, dict):
+        raise ValueError("Receipt should be an object")
+    try:
+        with metrics.timed("convert"):
+            return convert_to_atol(input_data)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError("Failed to convert receipt")
+
+@app.route('/reverse', methods=['POST'])
+@swag_from({
+    'responses': {
+        200: {
+            'description': 'The receipt in ATOL format',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'external_id': '17052917561851307',
+                        'receipt': {
+                            'client': {'email': 'kkt@kkt.ru'},
+                            'company': {'sno': 'osn'},
+                            'items': [
+                                {
+                                    'name': 'Колбаса',
+                                    'price': 1000,
+                                    'quantity': 0.3,
+                                    'sum': 300,
+                                    'measure': 0,
+                                    'payment_method': 'full_payment',
+                                    'payment_object': 1,
+                                    'vat': {'type': 'vat20'}
+                                }
+                            ],
+                            'payments': [{'type': 1, 'sum': 300}]
+                        }
+                    }
+                }
+            }
+        },
+        400: {
+            'description': 'Bad Request',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Failed to convert receipt'
+                    }
+                }
+            }
+        }
+    }
+})
+def reverse():
+    """
+    Convert a vdpaybox receipt back into ATOL format
+    Uses the same code tables as /process. Nothing is sent upstream.
+    ---
+    tags:
+      - Receipt
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          description: A receipt as sent to the vdpaybox receipt API, or just its receiptBody
+          properties:
+            externId:
+              type: string
+            externDeviceId:
+              type: string
+            receiptBody:
+              type: object
+    """
+    with metrics.timed("parse"):
+        input_data = request.json
+    try:
+        return jsonify(reverse_item(input_data)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/reverse/batch', methods=['POST'])
+@swag_from({
+    'responses': {
+        200: {
+            'description': 'Per-receipt results in request order',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'results': [
+                            {'status': 200, 'data': {}},
+                            {'status': 400, 'error': 'Receipt should be an object'}
+                        ]
+                    }
+                }
+            }
+        },
+        400: {
+            'description': 'Bad Request',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Body should be a list of receipts'
+                    }
+                }
+            }
+        },
+        413: {
+            'description': 'Too many receipts in one batch',
+            'content': {
+                'application/json': {
+                    'example': {
+                        'error': 'Batch is too large'
+                    }
+                }
+            }
+        }
+    }
+})
+def reverse_batch():
+    """
+    Convert a batch of vdpaybox receipts back into ATOL format
+    A receipt that fails to convert does not fail the batch.
+    ---
+    tags:
+      - Receipt
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: array
+          description: Receipts in the same format as /reverse
+          items:
+            type: object
+    """
+    with metrics.timed("parse"):
+        input_data = request.json
+    if not isinstance(input_data, list):
+        return jsonify({"error": "Body should be a list of receipts"}), 400
+    if len(input_data) > settings.BATCH_MAX_SIZE:
+        return jsonify({"error": "Batch is too large"}), 413
 
-    return jsonify(response.json()), 200
+    results = []
+    for receipt in input_data:
+        try:
+            results.append({"status": 200, "data": reverse_item(receipt)})
+        except ValueError as e:
+            results.append({"status": 400, "error": str(e)})
+    return jsonify({"results": results}), 200
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,289 @@
+import asyncio
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Per-key token buckets and a global cap on concurrent upstream calls, so one
+# merchant's burst is queued or refused here instead of overloading the
+# upstream for everyone. Buckets are kept as GCRA theoretical arrival times,
+# which lets a shared backend update one in a single atomic step.
+
+def _gcra(tat, now, interval, burst, max_wait):
+    """(granted, delay, new_tat) for one request against a bucket of ``burst``
+    tokens refilled every ``interval`` seconds. A granted request may have to
+    wait ``delay`` seconds for its token; it is refused if that exceeds max_wait."""
+    tat = max(tat or now, now)
+    delay = max(0.0, tat - now - (burst - 1) * interval)
+    if delay > max_wait:
+        return False, delay, None
+    return True, delay, tat + interval
+
+class RateLimited(Exception):
+    """A limit is exhausted for longer than the caller is allowed to wait."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class MemoryBackend:
+    """Per-process limits; each worker enforces its own budget."""
+
+    blocking = False
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key, interval, burst, max_wait):
+        with self._lock:
+            now = time.time()
+            granted, delay, tat = _gcra(self._buckets.get(key), now, interval, burst, max_wait)
+            if granted:
+                self._buckets[key] = tat
+                if len(self._buckets) > self.maxsize:
+                    # A bucket whose arrival time has passed is as good as a fresh one
+                    self._buckets = {k: v for k, v in self._buckets.items() if v > now}
+            return granted, delay
+
+    def acquire_slot(self, name, limit, lease):
+        with self._lock:
+            used = self._slots.get(name, 0)
+            if used >= limit:
+                return None
+            self._slots[name] = used + 1
+            return name
+
+    def release_slot(self, name, slot):
+        with self._lock:
+            self._slots[name] -= 1
+
+class SQLiteBackend:
+    """Shared by all workers on one host through a WAL-mode database file."""
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        db = self._connect()
+        db.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tat REAL NOT NULL)")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_slots ("
+            " id INTEGER PRIMARY KEY, name TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection inherited through fork (gunicorn --preload) must not be reused
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def reserve(self, key, interval, burst, max_wait):
+        with self._transaction() as db:
+            now = time.time()
+            row = db.execute("SELECT tat FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            granted, delay, tat = _gcra(row and row[0], now, interval, burst, max_wait)
+            if granted:
+                db.execute("INSERT OR REPLACE INTO rate_buckets (key, tat) VALUES (?, ?)", (key, tat))
+            return granted, delay
+
+    def acquire_slot(self, name, limit, lease):
+        with self._transaction() as db:
+            now = time.time()
+            # Slots of a worker that died mid-call run out with their lease
+            db.execute("DELETE FROM rate_slots WHERE expires_at <= ?", (now,))
+            used = db.execute("SELECT COUNT(*) FROM rate_slots WHERE name = ?", (name,)).fetchone()[0]
+            if used >= limit:
+                return None
+            return db.execute(
+                "INSERT INTO rate_slots (name, expires_at) VALUES (?, ?)", (name, now + lease)
+            ).lastrowid
+
+    def release_slot(self, name, slot):
+        self._connect().execute("DELETE FROM rate_slots WHERE id = ?", (slot,))
+
+class RedisBackend:
+    """Works with Redis or anything speaking its protocol (KeyDB, Dragonfly...)."""
+
+    blocking = True
+
+    RESERVE = """
+    local now = tonumber(ARGV[1])
+    local interval = tonumber(ARGV[2])
+    local tat = tonumber(redis.call('get', KEYS[1]) or ARGV[1])
+    if tat < now then tat = now end
+    local delay = math.max(0, tat - now - (tonumber(ARGV[3]) - 1) * interval)
+    if delay > tonumber(ARGV[4]) then return {0, tostring(delay)} end
+    redis.call('set', KEYS[1], tostring(tat + interval), 'PX', math.ceil((tat + interval - now) * 1000) + 1000)
+    return {1, tostring(delay)}
+    """
+
+    ACQUIRE = """
+    redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+    if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[2]) then return 0 end
+    redis.call('zadd', KEYS[1], ARGV[3], ARGV[4])
+    return 1
+    """
+
+    def __init__(self, url, prefix="prpr:ratelimit:"):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._reserve = self.redis.register_script(self.RESERVE)
+        self._acquire = self.redis.register_script(self.ACQUIRE)
+
+    def reserve(self, key, interval, burst, max_wait):
+        granted, delay = self._reserve(
+            keys=[self.prefix + "bucket:" + key], args=[time.time(), interval, burst, max_wait]
+        )
+        return bool(granted), float(delay)
+
+    def acquire_slot(self, name, limit, lease):
+        slot = uuid.uuid4().hex
+        now = time.time()
+        if self._acquire(keys=[self.prefix + "slots:" + name], args=[now, limit, now + lease, slot]):
+            return slot
+        return None
+
+    def release_slot(self, name, slot):
+        self.redis.zrem(self.prefix + "slots:" + name, slot)
+
+def make_backend(name, settings):
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'sqlite':
+        return SQLiteBackend(settings.RATE_LIMIT_SQLITE_PATH)
+    if name == 'redis':
+        return RedisBackend(settings.RATE_LIMIT_REDIS_URL)
+    raise ValueError("Unknown rate limit backend: %s" % name)
+
+class Limiter:
+    """Token bucket per key plus a cap on concurrent upstream calls.
+
+    throttle(key) takes a token from the key's bucket, sleeping until it is
+    due; slot() holds one of ``concurrency`` upstream slots, polling for a free
+    one. Both give up with RateLimited once that would take longer than
+    ``wait`` seconds. A rate or concurrency of 0 turns that limit off.
+    Bucket keys and the slot pool are namespaced by ``name``, so limiters for
+    different upstreams can share a backend.
+    """
+
+    def __init__(self, backend, rate, burst, concurrency, wait, lease, poll=0.02, name="upstream"):
+        self.backend = backend
+        self.name = name
+        self.interval = 1.0 / rate if rate else 0
+        self.burst = max(1, burst)
+        self.concurrency = concurrency
+        self.wait = wait
+        self.lease = lease
+        self.poll = poll
+        self._lock = threading.Lock()
+        self.stats = {"delayed": 0, "rejected": 0}
+
+    def _count(self, result):
+        with self._lock:
+            self.stats[result] += 1
+
+    def _reserved(self, granted, delay):
+        if not granted:
+            self._count("rejected")
+            raise RateLimited(delay)
+        if delay:
+            self._count("delayed")
+        return delay
+
+    def throttle(self, key):
+        if not self.interval:
+            return
+        key = self.name + ":" + key
+        delay = self._reserved(*self.backend.reserve(key, self.interval, self.burst, self.wait))
+        if delay:
+            time.sleep(delay)
+
+    async def athrottle(self, key):
+        if not self.interval:
+            return
+        args = (self.name + ":" + key, self.interval, self.burst, self.wait)
+        if self.backend.blocking:
+            reserved = await asyncio.to_thread(self.backend.reserve, *args)
+        else:
+            reserved = self.backend.reserve(*args)
+        delay = self._reserved(*reserved)
+        if delay:
+            await asyncio.sleep(delay)
+
+    @contextlib.contextmanager
+    def slot(self):
+        if not self.concurrency:
+            yield
+            return
+        name = self.name
+        deadline = time.monotonic() + self.wait
+        waited = False
+        while True:
+            slot = self.backend.acquire_slot(name, self.concurrency, self.lease)
+            if slot is not None:
+                break
+            if time.monotonic() >= deadline:
+                self._count("rejected")
+                raise RateLimited(self.poll)
+            waited = True
+            time.sleep(self.poll)
+        if waited:
+            self._count("delayed")
+        try:
+            yield
+        finally:
+            self.backend.release_slot(name, slot)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        if not self.concurrency:
+            yield
+            return
+        name = self.name
+        backend = self.backend
+
+        async def call(method, *args):
+            if backend.blocking:
+                return await asyncio.to_thread(method, *args)
+            return method(*args)
+
+        deadline = time.monotonic() + self.wait
+        waited = False
+        while True:
+            slot = await call(backend.acquire_slot, name, self.concurrency, self.lease)
+            if slot is not None:
+                break
+            if time.monotonic() >= deadline:
+                self._count("rejected")
+                raise RateLimited(self.poll)
+            waited = True
+            await asyncio.sleep(self.poll)
+        if waited:
+            self._count("delayed")
+        try:
+            yield
+        finally:
+            await call(backend.release_slot, name, slot)
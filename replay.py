@@ -0,0 +1,109 @@
+import argparse
+import collections
+import itertools
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import capture
+import converter
+import jsonlib
+
+# Runs captured conversions (CAPTURE_SAMPLE, see capture.py) through a
+# transformer and diffs its output against what was recorded.
+#
+#   python replay.py capture/                                   # current build
+#   python replay.py capture/ --mappings mappings-next.json     # new code tables
+#   python replay.py capture/ --transformer converter_next:convert_receipt --workers 8
+#
+# Exits with 1 when any record differs or fails.
+
+_transformer = None
+
+def _setup(transformer, mappings):
+    global _transformer
+    if mappings:
+        converter.use_mappings(*converter.load_mappings(mappings))
+    _transformer = capture.load_transformer(transformer)
+
+def check(record, limit=20):
+    """(result, differences) for one captured record; result is match, diff or error."""
+    expected = record["output"]
+    try:
+        actual = jsonlib.loads(jsonlib.dumps(_transformer(record["input"], expected.get("orgId"))))
+    except Exception as e:
+        return "error", [("$", "", repr(e))]
+    differences = capture.diff(expected, actual, limit)
+    return ("diff" if differences else "match"), differences
+
+def _check_batch(records):
+    return [check(record) for record in records]
+
+def batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+def replay(paths, transformer="converter:convert_receipt", mappings=None, workers=1, limit=None, batch_size=200):
+    """Yields (record, result, differences) for every captured record."""
+    records = capture.read_capture(paths)
+    if limit:
+        records = itertools.islice(records, limit)
+    if workers <= 1:
+        _setup(transformer, mappings)
+        for record in records:
+            yield (record,) + check(record)
+        return
+    with ProcessPoolExecutor(workers, initializer=_setup, initargs=(transformer, mappings)) as executor:
+        # Records stay in this process; only one window of batches is in flight
+        pending = collections.deque()
+        for batch in batches(records, batch_size):
+            pending.append((batch, executor.submit(_check_batch, batch)))
+            if len(pending) >= workers * 2:
+                batch, future = pending.popleft()
+                yield from ((record,) + outcome for record, outcome in zip(batch, future.result()))
+        while pending:
+            batch, future = pending.popleft()
+            yield from ((record,) + outcome for record, outcome in zip(batch, future.result()))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured conversions and diff the results")
+    parser.add_argument("paths", nargs="+", help="capture directories or segment files")
+    parser.add_argument("--transformer", default="converter:convert_receipt",
+                        help="module:function to test, called like convert_receipt(input_data, orgid)")
+    parser.add_argument("--mappings", help="mappings.json to load before converting")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes")
+    parser.add_argument("--limit", type=int, help="stop after this many records")
+    parser.add_argument("--show", type=int, default=5, help="differing records to print in full")
+    args = parser.parse_args(argv)
+
+    results = collections.Counter()
+    fields = collections.Counter()
+    shown = 0
+    started = time.perf_counter()
+    for record, result, differences in replay(args.paths, args.transformer, args.mappings, args.workers, args.limit):
+        results[result] += 1
+        for path, _, _ in differences:
+            fields[capture.pattern(path)] += 1
+        if differences and shown < args.show:
+            shown += 1
+            print("%s %s" % (result, record["output"].get("externId")))
+            for path, expected, actual in differences:
+                print("    %s: %r -> %r" % (path, expected, actual))
+    elapsed = time.perf_counter() - started
+
+    total = sum(results.values())
+    print("records %d in %.1fs, %.1f/s with %d worker(s)" % (
+        total, elapsed, total / elapsed if elapsed else 0, max(1, args.workers)))
+    print("match %d, diff %d, error %d" % (results["match"], results["diff"], results["error"]))
+    if fields:
+        print("differing fields:")
+        for path, count in fields.most_common(20):
+            print("  %7d  %s" % (count, path))
+    return 1 if results["diff"] or results["error"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+
+from breaker import CircuitBreaker
+from ratelimit import Limiter
+from upstream import UpstreamClient
+
+# Per-credential upstream routing. A JSON table names the upstream
+# environments (stage, prod, a regional mirror...) and says which Basic-auth
+# users go to which one; each upstream gets its own connection pool, timeouts,
+# rate limits and circuit breakers. Without a table everything goes to
+# UPSTREAM_BASE_URL.
+#
+#   {
+#     "version": 3,
+#     "upstreams": {
+#       "stage": {},
+#       "prod": {"base_url": "https://api.vdpaybox.ru", "pool_size": 64, "concurrency": 32},
+#       "msk": {"base_url": "https://msk.api.vdpaybox.ru", "read_timeout": 10}
+#     },
+#     "users": {"shop-42": "prod"},
+#     "prefixes": {"msk-": "msk"},
+#     "default": "stage"
+#   }
+#
+# users match the username exactly, prefixes its start (the longest wins), so
+# tenants whose logins carry an org prefix are routed as a group. The orgId is
+# only known after logging in to an upstream, so it cannot pick one.
+# Options left out of an upstream default to the settings named in OPTIONS.
+
+DEFAULT = "default"
+
+OPTIONS = {
+    "base_url": "UPSTREAM_BASE_URL",
+    "pool_size": "UPSTREAM_POOL_SIZE",
+    "async_pool_size": "ASYNC_POOL_SIZE",
+    "connect_timeout": "UPSTREAM_CONNECT_TIMEOUT",
+    "read_timeout": "UPSTREAM_READ_TIMEOUT",
+    "retries": "UPSTREAM_RETRIES",
+    "retry_backoff": "UPSTREAM_RETRY_BACKOFF",
+    "rate_limit": "RATE_LIMIT",
+    "rate_limit_burst": "RATE_LIMIT_BURST",
+    "concurrency": "UPSTREAM_CONCURRENCY",
+    "compression": "UPSTREAM_COMPRESSION",
+}
+
+def upstream_options(spec, settings):
+    unknown = set(spec) - set(OPTIONS)
+    if unknown:
+        raise ValueError("Unknown options: %s" % ", ".join(sorted(unknown)))
+    return {key: spec.get(key, getattr(settings, setting)) for key, setting in OPTIONS.items()}
+
+def delivery_time(options, settings):
+    """Longest a delivery can take: the throttle, a POST, a login after a 401
+    and the second POST, each waiting for a concurrency slot. The idempotency
+    claim lasts this long, and a sync worker must not be killed sooner (see
+    gunicorn.conf.py)."""
+    attempts = options["retries"] + 1
+    backoff = options["retry_backoff"] * (2 ** options["retries"] - 1)
+    post = settings.RATE_LIMIT_WAIT + attempts * options["connect_timeout"] + backoff + options["read_timeout"]
+    login = settings.RATE_LIMIT_WAIT + attempts * (options["connect_timeout"] + options["read_timeout"]) + backoff
+    return settings.RATE_LIMIT_WAIT + 2 * post + login
+
+def read_table(path):
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    if "version" not in config:
+        raise ValueError("%s has no version" % path)
+    return config
+
+def max_delivery_time(settings, path=None):
+    """delivery_time() of the slowest upstream in the table at ``path``."""
+    config = read_table(path) if path else {}
+    return max(
+        delivery_time(upstream_options(spec, settings), settings)
+        for spec in (config.get("upstreams") or {DEFAULT: {}}).values()
+    )
+
+class Upstream:
+    """One upstream environment and the state kept for it."""
+
+    def __init__(self, name, options, settings, backend):
+        self.name = name
+        self.options = options
+        self.client = UpstreamClient(
+            options["base_url"],
+            pool_size=options["pool_size"],
+            connect_timeout=options["connect_timeout"],
+            read_timeout=options["read_timeout"],
+            retries=options["retries"],
+            backoff=options["retry_backoff"],
+        )
+        self.token_url = self.client.url("/api/atol/login")
+        self.receipt_url = self.client.url("/api/receipt")
+        self.delivery_time = delivery_time(options, settings)
+        self.limiter = Limiter(
+            backend,
+            options["rate_limit"],
+            options["rate_limit_burst"],
+            options["concurrency"],
+            wait=settings.RATE_LIMIT_WAIT,
+            lease=settings.UPSTREAM_SLOT_LEASE,
+            name=name,
+        )
+        self.breakers = {
+            target: CircuitBreaker(
+                target,
+                window=settings.BREAKER_WINDOW,
+                min_calls=settings.BREAKER_MIN_CALLS,
+                failure_rate=settings.BREAKER_FAILURE_RATE,
+                slow_call=settings.BREAKER_SLOW_CALL,
+                slow_rate=settings.BREAKER_SLOW_RATE,
+                open_seconds=settings.BREAKER_OPEN_SECONDS,
+                probes=settings.BREAKER_PROBES,
+            )
+            for target in ("token", "receipt")
+        }
+
+    def close(self):
+        self.client.close()
+
+class Router:
+    def __init__(self, settings, backend):
+        self.settings = settings
+        self.backend = backend
+        self.upstreams = {}
+        self.version = None
+        self._source = None
+        self._lock = threading.Lock()
+        self.load({})
+
+    def load(self, config):
+        """Switch to a parsed routing table. Upstreams whose options did not
+        change are kept with their pools, limits and breaker state; the pools
+        of the others are closed once requests already using them are done."""
+        upstreams = {}
+        for name, spec in (config.get("upstreams") or {DEFAULT: {}}).items():
+            try:
+                options = upstream_options(spec, self.settings)
+            except ValueError as e:
+                raise ValueError("Upstream %s: %s" % (name, e))
+            current = self.upstreams.get(name)
+            if current is not None and current.options == options:
+                upstreams[name] = current
+            else:
+                upstreams[name] = Upstream(name, options, self.settings, self.backend)
+
+        def lookup(name):
+            if name not in upstreams:
+                raise ValueError("Unknown upstream: %s" % name)
+            return upstreams[name]
+
+        default = lookup(config.get("default", DEFAULT if DEFAULT in upstreams else next(iter(upstreams))))
+        users = {user: lookup(name) for user, name in config.get("users", {}).items()}
+        prefixes = sorted(
+            ((prefix, lookup(name)) for prefix, name in config.get("prefixes", {}).items()),
+            key=lambda rule: -len(rule[0]),
+        )
+        # One tuple, so a concurrent route() never sees half a table
+        self._table = users, prefixes, default
+        previous, self.upstreams = self.upstreams, upstreams
+        self.version = config.get("version")
+        for name, upstream in previous.items():
+            if upstreams.get(name) is not upstream:
+                self._retire(upstream)
+
+    def _retire(self, upstream):
+        # A request routed before the swap may still be using the pool
+        timer = threading.Timer(upstream.delivery_time, upstream.close)
+        timer.daemon = True
+        timer.start()
+
+    def reload(self, path):
+        """Load ``path`` if it changed since it was loaded; returns the new
+        version, or None when nothing changed. An empty path keeps the
+        single default upstream."""
+        if not path:
+            return None
+        with self._lock:
+            source = (path, os.stat(path).st_mtime)
+            if source == self._source:
+                return None
+            self.load(read_table(path))
+            self._source = source
+            return self.version
+
+    @property
+    def default(self):
+        return self._table[2]
+
+    def route(self, username):
+        users, prefixes, default = self._table
+        upstream = users.get(username)
+        if upstream is not None:
+            return upstream
+        for prefix, upstream in prefixes:
+            if username.startswith(prefix):
+                return upstream
+        return default
@@ -0,0 +1,161 @@
+import os
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def env_bool(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Bearer tokens from TOKEN_URL are cached per Basic credential
+TOKEN_CACHE_TTL = env_float('TOKEN_CACHE_TTL', 600)
+TOKEN_CACHE_SIZE = env_int('TOKEN_CACHE_SIZE', 1024)
+# Decoded Authorization headers kept, and how long a login the upstream
+# rejected with 401/403 is answered from memory (0 always asks the upstream)
+CREDENTIAL_CACHE_SIZE = env_int('CREDENTIAL_CACHE_SIZE', 4096)
+LOGIN_REJECT_TTL = env_float('LOGIN_REJECT_TTL', 30)
+
+# vdpaybox upstream; point UPSTREAM_BASE_URL at a local stub for testing
+# The longest delivery these timeouts and retries allow (routing.delivery_time)
+# sets the idempotency claim and the gunicorn worker timeout
+UPSTREAM_BASE_URL = os.environ.get('UPSTREAM_BASE_URL', 'https://api.stage.vdpaybox.ru')
+UPSTREAM_POOL_SIZE = env_int('UPSTREAM_POOL_SIZE', 32)
+UPSTREAM_CONNECT_TIMEOUT = env_float('UPSTREAM_CONNECT_TIMEOUT', 3.05)
+UPSTREAM_READ_TIMEOUT = env_float('UPSTREAM_READ_TIMEOUT', 30)
+UPSTREAM_RETRIES = env_int('UPSTREAM_RETRIES', 2)
+UPSTREAM_RETRY_BACKOFF = env_float('UPSTREAM_RETRY_BACKOFF', 0.2)
+
+# /process/batch
+BATCH_CONCURRENCY = env_int('BATCH_CONCURRENCY', 8)
+BATCH_MAX_SIZE = env_int('BATCH_MAX_SIZE', 1000)
+
+# asgi.py serving mode
+ASYNC_POOL_SIZE = env_int('ASYNC_POOL_SIZE', 200)
+ASYNC_POOL_TIMEOUT = env_float('ASYNC_POOL_TIMEOUT', 30)
+
+# Replay of upstream responses for repeated external_id (memory, sqlite, redis or off)
+IDEMPOTENCY_BACKEND = os.environ.get('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL = env_float('IDEMPOTENCY_TTL', 3600)
+IDEMPOTENCY_SIZE = env_int('IDEMPOTENCY_SIZE', 10000)
+IDEMPOTENCY_SQLITE_PATH = os.environ.get('IDEMPOTENCY_SQLITE_PATH', 'idempotency.sqlite3')
+IDEMPOTENCY_REDIS_URL = os.environ.get('IDEMPOTENCY_REDIS_URL', 'redis://localhost:6379/0')
+# Seconds a duplicate in another worker waits for the first one before a 409;
+# the first one's claim lasts as long as its slowest possible delivery
+IDEMPOTENCY_WAIT = env_float('IDEMPOTENCY_WAIT', 30)
+
+# Upstream limits: receipts per second per key (RATE_LIMIT_KEY: org or credential)
+# and concurrent upstream calls across workers sharing RATE_LIMIT_BACKEND
+# (memory, sqlite or redis). 0 turns a limit off. Requests wait up to
+# RATE_LIMIT_WAIT seconds for capacity, then get 429 with Retry-After.
+RATE_LIMIT = env_float('RATE_LIMIT', 0)
+RATE_LIMIT_BURST = env_int('RATE_LIMIT_BURST', 10)
+RATE_LIMIT_KEY = os.environ.get('RATE_LIMIT_KEY', 'org')
+UPSTREAM_CONCURRENCY = env_int('UPSTREAM_CONCURRENCY', 0)
+RATE_LIMIT_WAIT = env_float('RATE_LIMIT_WAIT', 5)
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_SQLITE_PATH = os.environ.get('RATE_LIMIT_SQLITE_PATH', 'ratelimit.sqlite3')
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0')
+# Slots held by a worker that died are freed after this many seconds
+UPSTREAM_SLOT_LEASE = env_float('UPSTREAM_SLOT_LEASE', 120)
+
+# Circuit breaker on token and receipt calls: opens when, among the last
+# BREAKER_WINDOW calls (at least BREAKER_MIN_CALLS), the share of failures or of
+# calls slower than BREAKER_SLOW_CALL seconds reaches its rate; while open,
+# /process answers 503 for BREAKER_OPEN_SECONDS, then BREAKER_PROBES calls test the upstream.
+# Setting both rates to 0 turns the breaker off.
+BREAKER_WINDOW = env_int('BREAKER_WINDOW', 20)
+BREAKER_MIN_CALLS = env_int('BREAKER_MIN_CALLS', 10)
+BREAKER_FAILURE_RATE = env_float('BREAKER_FAILURE_RATE', 0.5)
+BREAKER_SLOW_CALL = env_float('BREAKER_SLOW_CALL', 5)
+BREAKER_SLOW_RATE = env_float('BREAKER_SLOW_RATE', 0.8)
+BREAKER_OPEN_SECONDS = env_float('BREAKER_OPEN_SECONDS', 15)
+BREAKER_PROBES = env_int('BREAKER_PROBES', 3)
+
+# Accept receipts with 202 and deliver them from a local durable queue
+ASYNC_DELIVERY = env_bool('ASYNC_DELIVERY')
+DELIVERY_QUEUE_PATH = os.environ.get('DELIVERY_QUEUE_PATH', 'delivery_queue.sqlite3')
+DELIVERY_WORKERS = env_int('DELIVERY_WORKERS', 4)
+DELIVERY_MAX_ATTEMPTS = env_int('DELIVERY_MAX_ATTEMPTS', 10)
+DELIVERY_BACKOFF = env_float('DELIVERY_BACKOFF', 1)
+DELIVERY_BACKOFF_MAX = env_float('DELIVERY_BACKOFF_MAX', 300)
+DELIVERY_LEASE = env_float('DELIVERY_LEASE', 120)
+# Delivered and failed receipts, answered by GET /process/<id>, are deleted
+# this many seconds after they were last updated (0 keeps them)
+DELIVERY_RETENTION = env_float('DELIVERY_RETENTION', 604800)
+
+# Code tables for the receipt conversion; the file is checked for changes
+# every MAPPINGS_RELOAD_INTERVAL seconds (0 loads it once at startup)
+MAPPINGS_PATH = os.environ.get('MAPPINGS_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mappings.json'))
+MAPPINGS_RELOAD_INTERVAL = env_float('MAPPINGS_RELOAD_INTERVAL', 5)
+
+# Routing table sending Basic-auth users to different upstream environments
+# (see routing.py), checked for changes every UPSTREAMS_RELOAD_INTERVAL
+# seconds. Empty sends everything to UPSTREAM_BASE_URL.
+UPSTREAMS_PATH = os.environ.get('UPSTREAMS_PATH', '')
+UPSTREAMS_RELOAD_INTERVAL = env_float('UPSTREAMS_RELOAD_INTERVAL', 5)
+
+# Request bodies with Content-Encoding gzip or zstd (zstd needs the zstandard
+# package) are decoded up to DECOMPRESS_MAX_SIZE bytes, larger ones get 413.
+# Responses of at least COMPRESS_MIN_SIZE bytes are compressed for clients
+# that accept it; UPSTREAM_COMPRESSION (gzip or zstd) does the same for
+# receipt POSTs to the upstream.
+DECOMPRESS_MAX_SIZE = env_int('DECOMPRESS_MAX_SIZE', 52428800)
+RESPONSE_COMPRESSION = env_bool('RESPONSE_COMPRESSION', True)
+COMPRESS_MIN_SIZE = env_int('COMPRESS_MIN_SIZE', 1024)
+UPSTREAM_COMPRESSION = os.environ.get('UPSTREAM_COMPRESSION', '')
+
+# Swagger UI and spec: on (built from the view docstrings), static (serve the
+# file written by openapi.py, no UI) or off. See gunicorn.conf.py.
+SWAGGER = os.environ.get('SWAGGER', 'on')
+OPENAPI_SPEC_PATH = os.environ.get('OPENAPI_SPEC_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openapi.json'))
+
+# Capture of (input, converted output) pairs for replay.py: a CAPTURE_SAMPLE
+# share of conversions (0 is off) is written off the request thread to gzipped
+# JSON-lines segments in CAPTURE_DIR, rotated after CAPTURE_SEGMENT_SIZE bytes
+# of JSON, keeping the newest CAPTURE_KEEP segments
+CAPTURE_SAMPLE = env_float('CAPTURE_SAMPLE', 0)
+CAPTURE_DIR = os.environ.get('CAPTURE_DIR', 'capture')
+CAPTURE_SEGMENT_SIZE = env_int('CAPTURE_SEGMENT_SIZE', 67108864)
+CAPTURE_KEEP = env_int('CAPTURE_KEEP', 20)
+CAPTURE_QUEUE_SIZE = env_int('CAPTURE_QUEUE_SIZE', 1000)
+# Shadow mode: SHADOW_PERCENT % of conversions are also run through the
+# candidate SHADOW_TRANSFORMER (module:function taking input_data and orgid)
+# in the background; differences are logged, nothing is sent upstream
+SHADOW_TRANSFORMER = os.environ.get('SHADOW_TRANSFORMER', '')
+SHADOW_PERCENT = env_float('SHADOW_PERCENT', 0)
+
+# Add per-stage timings to /process responses as a Server-Timing header
+SERVER_TIMING = env_bool('SERVER_TIMING')
+
+# Structured JSON logs, written to stderr by a background thread
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = env_int('LOG_QUEUE_SIZE', 10000)
+# Fraction of successful receipts logged with their (redacted) payload
+LOG_PAYLOAD_SAMPLE = env_float('LOG_PAYLOAD_SAMPLE', 0)
+LOG_REDACT_FIELDS = os.environ.get(
+    'LOG_REDACT_FIELDS',
+    'password,token,authorization,email,phone,phones,emailOrPhone,inn,vatin,cashier_inn,document_data,birthdate'
+)
+
+# JSON backend: auto (orjson when installed), orjson or json
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+# Return the upstream body of a successful /process call as is, without decoding and re-encoding it
+PASSTHROUGH_RESPONSE = env_bool('PASSTHROUGH_RESPONSE')
+
+# Receipt validation against the /process schema: lenient, strict or off
+VALIDATION = os.environ.get('VALIDATION', 'lenient')
+
+# Bodies of at least this many bytes (or chunked ones) are parsed and sent
+# upstream item by item when ijson is installed; 0 turns streaming off
+STREAM_THRESHOLD = env_int('STREAM_THRESHOLD', 1048576)
+# Converted items are kept in memory up to this size, then spill to a temp file
+STREAM_SPOOL_SIZE = env_int('STREAM_SPOOL_SIZE', 1048576)
@@ -0,0 +1,121 @@
+import tempfile
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import jsonlib
+from converter import convert_item, current_mappings
+
+# Incremental ingestion for receipts with thousands of items: receipt.items is
+# parsed one element at a time and each converted item is spooled, so memory
+# is bounded per item rather than per receipt. Requires ijson.
+
+ITEMS_PREFIX = "receipt.items.item"
+# receiptBody keys that convert_receipt puts after the items
+AFTER_ITEMS = ("payments", "taxes")
+
+class _Reader:
+    # ijson probes the stream with read(0), which werkzeug's LimitedStream
+    # takes for a client disconnect
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size=-1):
+        return self.stream.read(size) if size else b""
+
+def parse_receipt(stream, on_item):
+    """Parse an ATOL receipt from a file-like object without keeping its items.
+
+    Every element of receipt.items is passed to on_item(index, item) as soon as
+    it is complete. The returned receipt has an empty items list.
+    """
+    receipt = ijson.ObjectBuilder()
+    item = None
+    depth = 0
+    index = 0
+    try:
+        for prefix, event, value in ijson.parse(_Reader(stream), use_float=True):
+            if item is None:
+                if prefix != ITEMS_PREFIX:
+                    receipt.event(event, value)
+                    continue
+                item = ijson.ObjectBuilder()
+            item.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth == 0:
+                on_item(index, item.value)
+                index += 1
+                item = None
+    except ijson.JSONError as e:
+        raise ValueError("Invalid JSON: %s" % e)
+    return receipt.value
+
+class StreamedReceipt(dict):
+    """Converted receipt whose receiptBody.items live in a spool file.
+
+    The dict holds everything else, so orgId and externId are read and updated
+    as on a plain converted receipt. chunks() renders the full JSON body and can
+    be called again to resend it. With keep_input, the input items are spooled
+    too, for input_items().
+    """
+
+    def __init__(self, spool_size, keep_input=False):
+        super().__init__()
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self._inputs = tempfile.SpooledTemporaryFile(max_size=spool_size) if keep_input else None
+        # Every item is converted with the tables in use when the receipt started
+        self._mappings = current_mappings()
+        self.count = 0
+
+    def add_item(self, item):
+        if self.count:
+            self._spool.write(b",")
+        self._spool.write(jsonlib.dumps(convert_item(item, self._mappings)))
+        if self._inputs is not None:
+            if self.count:
+                self._inputs.write(b",")
+            self._inputs.write(jsonlib.dumps(item))
+        self.count += 1
+
+    def chunks(self, chunk_size=65536):
+        envelope = dict(self)
+        body = envelope.pop("receiptBody", {})
+        head = jsonlib.dumps(envelope)[:-1]
+        if envelope:
+            head += b","
+        head += b'"receiptBody":'
+        if not self.count:
+            yield head + jsonlib.dumps(body) + b"}"
+            return
+        # Keys in the order convert_receipt gives them, items before the rest
+        before = {key: value for key, value in body.items() if key not in AFTER_ITEMS}
+        after = {key: value for key, value in body.items() if key in AFTER_ITEMS}
+        head += jsonlib.dumps(before)[:-1]
+        if before:
+            head += b","
+        yield head + b'"items":['
+        self._spool.seek(0)
+        while True:
+            chunk = self._spool.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        yield b"]" + (b"," + jsonlib.dumps(after)[1:] if after else b"}") + b"}"
+
+    def load(self):
+        """The converted receipt as a plain dict, items included."""
+        return jsonlib.loads(b"".join(self.chunks()))
+
+    def input_items(self):
+        self._inputs.seek(0)
+        return jsonlib.loads(b"[" + self._inputs.read() + b"]")
+
+    def close(self):
+        self._spool.close()
+        if self._inputs is not None:
+            self._inputs.close()
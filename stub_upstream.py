@@ -0,0 +1,218 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import compress
+
+# Local stand-in for the vdpaybox API: GET /api/atol/login and POST /api/receipt
+# with the same contracts, plus configurable latency, failures and token expiry.
+# Receipt bodies may be gzip or zstd encoded (UPSTREAM_COMPRESSION).
+# Used by bench.py and as the upstream for load tests with loadgen.py.
+#
+#   python stub_upstream.py --port 8081 --receipt-latency lognormal:0.08:0.5 \
+#       --error-rate 0.01 --token-ttl 300 --error-page
+#   UPSTREAM_BASE_URL=http://127.0.0.1:8081 gunicorn -w 4 prpr:app
+#
+# GET /stats returns request counts by endpoint and status.
+
+LOGIN_PATH = "/api/atol/login"
+RECEIPT_PATH = "/api/receipt"
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+def latency(spec):
+    """Parse a latency distribution into a callable returning seconds.
+
+    0.05                  fixed
+    uniform:LOW:HIGH
+    normal:MEAN:STDDEV    (clipped at 0)
+    lognormal:MEDIAN:SIGMA
+    exp:MEAN
+    """
+    kind, _, args = str(spec).partition(":")
+    params = [float(arg) for arg in args.split(":")] if args else []
+    if not args:
+        value = float(kind)
+        return lambda: value
+    if kind == "uniform":
+        low, high = params
+        return lambda: random.uniform(low, high)
+    if kind == "normal":
+        mean, stddev = params
+        return lambda: max(0.0, random.gauss(mean, stddev))
+    if kind == "lognormal":
+        median, sigma = params
+        mu = math.log(median)
+        return lambda: random.lognormvariate(mu, sigma)
+    if kind == "exp":
+        mean, = params
+        return lambda: random.expovariate(1 / mean)
+    raise ValueError("Unknown latency distribution: %s" % spec)
+
+class Stub:
+    """Behaviour and bookkeeping shared by all handler threads."""
+
+    def __init__(self, login_latency="0", receipt_latency="0", error_rate=0.0,
+                 error_status=503, token_ttl=None, orgid="stub-org", error_page=False):
+        self.login_latency = latency(login_latency)
+        self.receipt_latency = latency(receipt_latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # Failures answered with an HTML page, like a proxy in front of the API
+        self.error_page = error_page
+        self.token_ttl = token_ttl
+        self.orgid = orgid
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, endpoint, status):
+        key = "%s %d" % (endpoint, status)
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def failed(self):
+        return self.error_rate and random.random() < self.error_rate
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        expires_at = time.monotonic() + self.token_ttl if self.token_ttl else None
+        with self._lock:
+            self._tokens[token] = expires_at
+        return token
+
+    def token_valid(self, token):
+        with self._lock:
+            if token not in self._tokens:
+                return False
+            expires_at = self._tokens[token]
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._tokens[token]
+                return False
+            return True
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, endpoint, status, body):
+        self.server.stub.count(endpoint, status)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def fail(self, endpoint):
+        stub = self.server.stub
+        if not stub.error_page:
+            return self.reply(endpoint, stub.error_status, {"error": "Stub failure"})
+        stub.count(endpoint, stub.error_status)
+        data = b"<html><body><h1>%d Stub failure</h1></body></html>" % stub.error_status
+        self.send_response(stub.error_status)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self):
+        stub = self.server.stub
+        path = self.path.split("?")[0]
+        if path == "/stats":
+            return self.reply("stats", 200, stub.snapshot())
+        if path != LOGIN_PATH:
+            return self.reply("other", 404, {"error": "Not found"})
+
+        time.sleep(stub.login_latency())
+        if stub.failed():
+            return self.fail("login")
+        if not self.headers.get("Authorization", "").startswith("Basic "):
+            return self.reply("login", 401, {"error": "Authorization required"})
+        self.reply("login", 200, {"token": stub.issue_token(), "orgId": stub.orgid})
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.read_body()
+        if self.path.split("?")[0] != RECEIPT_PATH:
+            return self.reply("other", 404, {"error": "Not found"})
+
+        time.sleep(stub.receipt_latency())
+        if stub.failed():
+            return self.fail("receipt")
+        scheme, _, token = self.headers.get("Authorization", "").partition(" ")
+        if scheme != "Bearer" or not stub.token_valid(token):
+            return self.reply("receipt", 401, {"error": "Token expired"})
+        coding = self.headers.get("Content-Encoding", "").strip()
+        if coding and coding.lower() != "identity":
+            try:
+                body = compress.decode(body, coding, MAX_BODY_SIZE)
+            except compress.DecodeError as e:
+                return self.reply("receipt", e.status_code, {"error": str(e)})
+        try:
+            receipt = json.loads(body)
+        except ValueError:
+            return self.reply("receipt", 400, {"error": "Invalid JSON"})
+        if not isinstance(receipt, dict) or not isinstance(receipt.get("receiptBody"), dict):
+            return self.reply("receipt", 400, {"error": "receiptBody is required"})
+        self.reply("receipt", 200, {"status": "wait", "uuid": str(uuid.uuid4())})
+
+def make_server(stub, host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.stub = stub
+    return server
+
+def start(stub=None, host="127.0.0.1", port=0):
+    """Serve in a daemon thread; returns the server (see server.server_port)."""
+    server = make_server(stub or Stub(), host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the vdpaybox login and receipt API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--login-latency", default="0", help="latency distribution of logins (see latency())")
+    parser.add_argument("--receipt-latency", default="0", help="latency distribution of receipt calls")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--error-page", action="store_true", help="answer failures with an HTML page instead of JSON")
+    parser.add_argument("--token-ttl", type=float, help="seconds until an issued token is rejected with 401")
+    parser.add_argument("--org-id", default="stub-org")
+    args = parser.parse_args(argv)
+
+    stub = Stub(args.login_latency, args.receipt_latency, args.error_rate,
+                args.error_status, args.token_ttl, args.org_id, args.error_page)
+    server = make_server(stub, args.host, args.port)
+    print("stub upstream on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SWAGGER", "off")
+
+import settings
+import stub_upstream
+
+# settings is read once, by whatever imports it first (stub_upstream does,
+# through jsonlib), so the stub's address is set on it directly; prpr must
+# not be imported before this
+upstream_server = stub_upstream.start()
+settings.UPSTREAM_BASE_URL = "http://127.0.0.1:%d" % upstream_server.server_port
+
+@pytest.fixture
+def stub():
+    """The stub upstream, answering normally again after the test."""
+    stub = upstream_server.stub
+    yield stub
+    stub.error_rate = 0.0
+    stub.error_status = 503
+    stub.error_page = False
+
+@pytest.fixture
+def stub_url():
+    return settings.UPSTREAM_BASE_URL
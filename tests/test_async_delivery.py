@@ -0,0 +1,134 @@
+import base64
+import sqlite3
+import time
+
+import pytest
+
+import converter
+import prpr
+from delivery_queue import DELIVERED, QUEUED, DeliveryQueue, DeliveryWorkers
+
+def auth(username):
+    return "Basic " + base64.b64encode(("%s:secret" % username).encode()).decode()
+
+RECEIPT = {
+    "external_id": "queued-1",
+    "receipt": {
+        "company": {"sno": "osn", "inn": "7700000000"},
+        "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+        "payments": [{"type": 1, "sum": 3.0}],
+        "total": 3.0,
+    },
+}
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path):
+    queue = DeliveryQueue(str(tmp_path / "queue.sqlite3"))
+    workers = DeliveryWorkers(queue, prpr.deliver_queued, threads=1, backoff=0.05, backoff_max=0.05, poll=0.05)
+    monkeypatch.setattr(prpr, "delivery_queue", queue)
+    monkeypatch.setattr(prpr, "delivery_workers", workers)
+    yield queue
+    workers.stop(timeout=5)
+
+def wait_for(queue, receipt_id, state, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = queue.status(receipt_id)
+        if status["status"] == state:
+            return status
+        time.sleep(0.05)
+    raise AssertionError("receipt %s is %s" % (receipt_id, status["status"]))
+
+def test_receipt_accepted_while_upstream_fails(queue, stub):
+    stub.error_rate = 1.0
+    client = prpr.app.test_client()
+
+    response = client.post("/process", json=RECEIPT, headers={"Authorization": auth("queued-user")})
+
+    assert response.status_code == 202, response.get_json()
+    assert response.headers["Location"] == "/process/%s" % response.get_json()["id"]
+    stub.error_rate = 0.0
+    status = wait_for(queue, response.get_json()["id"], DELIVERED)
+    assert status["upstream_status"] == 200
+
+def test_batch_accepted_without_login(queue, stub):
+    stub.error_rate = 1.0
+    client = prpr.app.test_client()
+
+    response = client.post("/process/batch", json=[dict(RECEIPT, external_id="queued-b%d" % n) for n in range(3)],
+                           headers={"Authorization": auth("queued-batch-user")})
+
+    assert response.status_code == 200
+    assert [result["status"] for result in response.get_json()["results"]] == [202, 202, 202]
+
+def test_queued_receipt_gets_org_id_on_delivery(queue):
+    data = converter.convert_receipt(RECEIPT)
+    assert "orgId" not in data
+
+    status, body = prpr.deliver_queued(data, auth("queued-org-user"))
+
+    assert status == 200
+    assert data["orgId"] == "stub-org"
+
+def test_duplicate_external_id_queued_once(queue):
+    client = prpr.app.test_client()
+    headers = {"Authorization": auth("queued-dup-user")}
+    first = client.post("/process", json=dict(RECEIPT, external_id="queued-dup"), headers=headers)
+    second = client.post("/process", json=dict(RECEIPT, external_id="queued-dup"), headers=headers)
+    other = client.post("/process", json=dict(RECEIPT, external_id="queued-dup"),
+                        headers={"Authorization": auth("queued-other-user")})
+
+    assert first.get_json()["id"] == second.get_json()["id"]
+    assert other.get_json()["id"] != first.get_json()["id"]
+
+def stored_auth(queue, receipt_id):
+    return queue._connect().execute("SELECT auth FROM receipts WHERE id = ?", (receipt_id,)).fetchone()["auth"]
+
+def test_final_receipts_forget_the_credential(queue):
+    delivered = queue.enqueue({"externId": "a"}, auth("queued-final-user"))
+    failed = queue.enqueue({"externId": "b"}, auth("queued-final-user"))
+    pending = queue.enqueue({"externId": "c"}, auth("queued-final-user"))
+
+    queue.complete(delivered, 200, {})
+    queue.fail(failed, 400, {}, "Upstream rejected the receipt")
+
+    assert stored_auth(queue, delivered) is None
+    assert stored_auth(queue, failed) is None
+    assert stored_auth(queue, pending) == auth("queued-final-user")
+
+def test_prune_deletes_old_final_receipts_only(queue):
+    ids = [queue.enqueue({"externId": str(n)}, auth("queued-prune-user")) for n in range(4)]
+    queue.complete(ids[0], 200, {})
+    queue.fail(ids[1], 400, {}, "Upstream rejected the receipt")
+    queue.complete(ids[2], 200, {})
+    queue._connect().execute("UPDATE receipts SET updated = updated - 3600 WHERE id IN (?, ?, ?)", tuple(ids[:2]) + (ids[3],))
+
+    assert queue.prune(60) == 2
+
+    assert queue.status(ids[0]) is None and queue.status(ids[1]) is None
+    assert queue.status(ids[2])["status"] == DELIVERED
+    assert queue.status(ids[3])["status"] == QUEUED
+
+def test_worker_survives_queue_errors(tmp_path, monkeypatch):
+    queue = DeliveryQueue(str(tmp_path / "queue.sqlite3"))
+    workers = DeliveryWorkers(queue, lambda payload, auth_header: (200, {}), threads=1, poll=0.05, lease=0.2)
+    complete = queue.complete
+    calls = []
+
+    def flaky_complete(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        complete(*args)
+    monkeypatch.setattr(queue, "complete", flaky_complete)
+
+    first = queue.enqueue({"externId": "flaky-1"}, auth("queued-flaky-user"))
+    workers.start()
+    try:
+        second = queue.enqueue({"externId": "flaky-2"}, auth("queued-flaky-user"))
+        workers.notify()
+        wait_for(queue, second, DELIVERED)
+        # The first receipt is delivered again once its lease runs out
+        wait_for(queue, first, DELIVERED)
+    finally:
+        workers.stop(timeout=5)
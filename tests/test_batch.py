@@ -0,0 +1,84 @@
+import base64
+import time
+
+import pytest
+from starlette.testclient import TestClient
+
+import asgi
+import prpr
+import settings
+
+def auth(username):
+    return {"Authorization": "Basic " + base64.b64encode(("%s:secret" % username).encode()).decode()}
+
+def receipt(external_id):
+    return {
+        "external_id": external_id,
+        "receipt": {
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+            "payments": [{"type": 1, "sum": 3.0}],
+            "total": 3.0,
+        },
+    }
+
+def test_results_keep_request_order(monkeypatch):
+    def deliver(data, auth_header, token, passthrough=False):
+        # Later receipts finish first
+        time.sleep(0.01 * (10 - int(data["externId"].split("-")[-1])))
+        return 200, {"externId": data["externId"]}, False
+    monkeypatch.setattr(prpr, "deliver", deliver)
+    body = [receipt("batch-order-%d" % n) for n in range(10)]
+
+    response = prpr.app.test_client().post("/process/batch", json=body, headers=auth("batch-order-user"))
+
+    assert response.status_code == 200
+    assert [result["data"]["externId"] for result in response.get_json()["results"]] == [
+        "batch-order-%d" % n for n in range(10)
+    ]
+
+def test_failed_receipts_do_not_fail_the_batch(stub):
+    body = [receipt("batch-mixed-1"), "not a receipt", {"external_id": "batch-mixed-2"}, receipt("batch-mixed-3")]
+
+    flask = prpr.app.test_client().post("/process/batch", json=body, headers=auth("batch-mixed-user"))
+    with TestClient(asgi.app) as client:
+        starlette = client.post("/process/batch", json=body, headers=auth("batch-mixed-user"))
+
+    for response in (flask.json, starlette.json()):
+        results = response["results"]
+        assert [result["status"] for result in results] == [200, 422, 422, 200]
+        assert results[1]["errors"] == [{"field": "$", "error": "should be object"}]
+        assert results[2]["errors"] == [{"field": "receipt", "error": "is required"}]
+        assert results[0]["data"]["status"] == "wait"
+
+def test_one_login_per_batch(stub):
+    logins = stub.snapshot().get("login 200", 0)
+    body = [receipt("batch-login-%d" % n) for n in range(5)]
+
+    response = prpr.app.test_client().post("/process/batch", json=body, headers=auth("batch-login-user"))
+
+    assert [result["status"] for result in response.get_json()["results"]] == [200] * 5
+    assert stub.snapshot().get("login 200", 0) == logins + 1
+
+def test_upstream_rejection_is_reported_per_receipt(stub):
+    client = prpr.app.test_client()
+    headers = auth("batch-rejected-user")
+    # Log in first, so only the receipt calls fail
+    prpr.get_token(headers["Authorization"])
+    stub.error_rate = 1.0
+    stub.error_status = 400
+
+    response = client.post("/process/batch", json=[receipt("batch-rejected-1")], headers=headers)
+
+    assert response.get_json()["results"] == [{"status": 400, "error": {"error": "Stub failure"}}]
+
+@pytest.mark.parametrize("body, status, error", [
+    ({"receipts": []}, 400, "Body should be a list of receipts"),
+    ([receipt("batch-size-%d" % n) for n in range(3)], 413, "Batch is too large"),
+])
+def test_batch_rejected_as_a_whole(monkeypatch, body, status, error):
+    monkeypatch.setattr(settings, "BATCH_MAX_SIZE", 2)
+
+    response = prpr.app.test_client().post("/process/batch", json=body, headers=auth("batch-size-user"))
+
+    assert (response.status_code, response.get_json()) == (status, {"error": error})
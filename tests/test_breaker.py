@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import pytest
+
+import asgi
+import prpr
+import routing
+import settings
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+
+class Response:
+    status_code = 200
+
+def tripped(probes=1, open_seconds=0.05):
+    breaker = CircuitBreaker("receipt", window=2, min_calls=1, failure_rate=0.5, open_seconds=open_seconds, probes=probes)
+    breaker.before()
+    breaker.after(time.perf_counter(), error=OSError())
+    assert breaker.state == OPEN
+    return breaker
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """A fresh default upstream whose receipt breaker is open."""
+    upstream = routing.Upstream("default", prpr.router.upstreams["default"].options, settings, prpr.router.backend)
+    upstream.breakers["receipt"] = tripped()
+    monkeypatch.setattr(prpr.router, "_table", ({}, [], upstream))
+    monkeypatch.setattr(prpr.router, "upstreams", {"default": upstream})
+    time.sleep(0.06)
+    return upstream
+
+def test_abandoned_probe_is_released():
+    breaker = tripped()
+    time.sleep(0.06)
+    breaker.before()
+    with pytest.raises(CircuitOpen):
+        breaker.before()
+    breaker.abandon()
+    breaker.before()
+    assert breaker.state == HALF_OPEN
+
+def test_lost_probe_is_written_off():
+    breaker = tripped(open_seconds=0.05)
+    time.sleep(0.06)
+    breaker.before()
+    time.sleep(0.06)
+    breaker.before()
+    breaker.after(time.perf_counter(), Response())
+    assert breaker.state == CLOSED
+
+def test_snapshot_reports_half_open_once_open_seconds_passed():
+    breaker = tripped()
+    assert breaker.snapshot()["state"] == OPEN
+    time.sleep(0.06)
+    assert breaker.snapshot() == {"state": HALF_OPEN, "calls": 0, "probes": 0}
+
+def test_send_receipt_error_frees_probe(upstream, monkeypatch):
+    def broken(*args):
+        raise RuntimeError("serializer failed")
+    monkeypatch.setattr(prpr, "receipt_body", broken)
+
+    with pytest.raises(RuntimeError):
+        prpr.send_receipt({}, "token", upstream)
+    with pytest.raises(RuntimeError):
+        prpr.send_receipt({}, "token", upstream)
+
+def test_cancelled_async_send_frees_probe(upstream, monkeypatch):
+    class Hanging:
+        async def post(self, *args, **kwargs):
+            await asyncio.sleep(60)
+    monkeypatch.setattr(asgi, "client_for", lambda upstream: Hanging())
+
+    async def cancel_send():
+        task = asyncio.ensure_future(asgi.send_receipt({}, "token", upstream))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_send())
+    # Another probe is let through instead of CircuitOpen
+    asyncio.run(cancel_send())
+
+def test_health_reports_half_open(upstream):
+    response = prpr.app.test_client().get("/health")
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "recovering"
+    assert response.get_json()["upstream"]["default"]["receipt"]["state"] == HALF_OPEN
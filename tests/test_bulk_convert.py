@@ -0,0 +1,73 @@
+import io
+import json
+
+import pytest
+
+import bulk_convert
+import converter
+
+def receipt(external_id):
+    return {
+        "external_id": external_id,
+        "receipt": {
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+            "payments": [{"type": 1, "sum": 3.0}],
+            "total": 3.0,
+        },
+    }
+
+def lines(count, bad=()):
+    for n in range(count):
+        yield ("{broken\n" if n in bad else json.dumps(receipt("bulk-%d" % n)) + "\n")
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_output_keeps_input_order(workers):
+    out = io.StringIO()
+
+    counts = bulk_convert.convert_stream(lines(50), out, None, workers=workers, chunk_size=4)
+
+    assert counts == (50, 0)
+    assert [json.loads(line)["externId"] for line in out.getvalue().splitlines()] == [
+        "bulk-%d" % n for n in range(50)
+    ]
+
+def test_output_matches_converter():
+    out = io.StringIO()
+
+    bulk_convert.convert_stream(lines(1), out, None, orgid="org-1")
+
+    assert json.loads(out.getvalue()) == converter.convert_receipt(receipt("bulk-0"), "org-1")
+
+def test_rejected_lines_are_reported_with_line_numbers():
+    out, errors = io.StringIO(), io.StringIO()
+    source = list(lines(5, bad={1})) + ["\n", "[1, 2]\n"]
+
+    counts = bulk_convert.convert_stream(source, out, errors, workers=2, chunk_size=2)
+
+    assert counts == (4, 2)
+    rejected = [json.loads(line) for line in errors.getvalue().splitlines()]
+    # Blank lines are skipped but still counted
+    assert [(entry["line"], entry["input"]) for entry in rejected] == [(2, "{broken"), (7, "[1, 2]")]
+    assert rejected[0]["error"].startswith("Invalid JSON")
+    assert rejected[1]["error"] == "Receipt should be an object"
+
+def test_body_only_and_reverse():
+    body = bulk_convert.convert_line(json.dumps(receipt("bulk-body")), body_only=True)
+    converted = bulk_convert.convert_line(json.dumps(receipt("bulk-reverse")))
+    atol = json.loads(bulk_convert.convert_line(converted, reverse=True))
+
+    assert json.loads(body) == converter.convert_receipt(receipt("bulk-body"))["receiptBody"]
+    assert atol == converter.convert_to_atol(json.loads(converted))
+    assert atol["external_id"] == "bulk-reverse"
+
+def test_main_exit_status(tmp_path):
+    source = tmp_path / "archive.jsonl"
+    source.write_text("".join(lines(3, bad={2})), encoding="utf-8")
+    output, errors = tmp_path / "converted.jsonl", tmp_path / "rejects.jsonl"
+
+    status = bulk_convert.main([str(source), "-o", str(output), "--errors", str(errors), "--workers", "1"])
+
+    assert status == 1
+    assert len(output.read_text(encoding="utf-8").splitlines()) == 2
+    assert json.loads(errors.read_text(encoding="utf-8"))["line"] == 3
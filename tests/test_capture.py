@@ -0,0 +1,26 @@
+import gzip
+import os
+
+import capture
+
+def test_prune_keeps_segments_other_workers_have_open(tmp_path, monkeypatch):
+    dead = tmp_path / "capture-20000101T000000-1.jsonl.gz"
+    with gzip.open(dead, "wb") as f:
+        f.write(b"{}\n")
+
+    # A worker with a segment still open, older than any segment to come
+    monkeypatch.setattr(capture.time, "strftime", lambda fmt: "20000101T000001")
+    other = capture.Capture(str(tmp_path), 1, 1 << 20, 1, 10)
+    other.handle(b"{}")
+    open_segment = tmp_path / ("capture-20000101T000001-%d.jsonl.gz" % os.getpid())
+    monkeypatch.undo()
+
+    worker = capture.Capture(str(tmp_path), 1, 1, 1, 10)
+    try:
+        worker.handle(b"{}")
+    finally:
+        other._file.close()
+        other._raw.close()
+
+    assert not dead.exists()
+    assert open_segment.exists()
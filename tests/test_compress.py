@@ -0,0 +1,55 @@
+import base64
+import gzip
+import json
+
+import pytest
+import requests
+
+import compress
+import prpr
+import ratelimit
+import routing
+import settings
+
+AUTH = {"Authorization": "Basic " + base64.b64encode(b"compress-user:secret").decode()}
+
+def receipt(external_id, count):
+    return {
+        "external_id": external_id,
+        "receipt": {
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item %d" % i, "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}
+                      for i in range(count)],
+            "payments": [{"type": 1, "sum": 3.0 * count}],
+            "total": 3.0 * count,
+        },
+    }
+
+@pytest.fixture(params=compress.CODINGS)
+def coding(request, monkeypatch):
+    router = routing.Router(settings, ratelimit.make_backend("memory", settings))
+    router.load({"upstreams": {"default": {"compression": request.param}}})
+    monkeypatch.setattr(prpr, "router", router)
+    return request.param
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_compressed_receipt_accepted_by_stub(coding, streamed, stub, monkeypatch):
+    if streamed:
+        monkeypatch.setattr(settings, "STREAM_THRESHOLD", 1000)
+    before = stub.snapshot().get("receipt 200", 0)
+
+    response = prpr.app.test_client().post(
+        "/process", json=receipt("compressed-%s-%s" % (coding, streamed), 50), headers=AUTH
+    )
+
+    assert response.status_code == 200, response.get_json()
+    assert stub.snapshot().get("receipt 200", 0) == before + 1
+
+def test_stub_rejects_corrupt_body(stub, stub_url):
+    url = stub_url + "/api/receipt"
+    body = gzip.compress(json.dumps({"receiptBody": {}}).encode())[:-8]
+
+    response = requests.post(url, data=body, headers={"Content-Encoding": "gzip", "Authorization": "Bearer " + stub.issue_token()})
+
+    assert response.status_code == 400
+    assert "Malformed" in response.json()["error"]
@@ -0,0 +1,219 @@
+import json
+import random
+import time
+
+import pytest
+
+import converter
+import jsonlib
+import prpr
+
+def maybe(rng, value, empty=(None,)):
+    """value, or now and then one of the empties the converters drop."""
+    return rng.choice(empty) if rng.random() < 0.15 else value
+
+def text(rng, prefix):
+    return "%s-%d" % (prefix, rng.randrange(1000))
+
+def phones(rng):
+    return [maybe(rng, "+7900%07d" % rng.randrange(10 ** 7)) for _ in range(rng.randrange(3))]
+
+def mark_code(rng):
+    kind = rng.choice(("egais20", "egais30", "gs1m", "ean13", "unknown"))
+    return rng.choice((
+        {kind: maybe(rng, text(rng, "mark"), (None, "", {}))},
+        {"gs1m": text(rng, "mark"), kind: text(rng, "mark")},
+        {},
+        None,
+    ))
+
+def agent_info(rng):
+    info = {}
+    if rng.random() < 0.5:
+        info["paying_agent"] = {"operation": maybe(rng, "Перевод"), "phones": phones(rng)}
+    if rng.random() < 0.5:
+        info["receive_payments_operator"] = {"phones": phones(rng)}
+    if rng.random() < 0.5:
+        info["money_transfer_operator"] = {
+            "phones": phones(rng),
+            "name": maybe(rng, text(rng, "operator")),
+            "address": maybe(rng, "Москва"),
+            "inn": maybe(rng, "7700000000"),
+        }
+    return info
+
+def item(rng):
+    item = {
+        "name": maybe(rng, text(rng, "item")),
+        "price": maybe(rng, rng.randrange(1, 10000) / 100),
+        "quantity": maybe(rng, rng.randrange(1, 10)),
+        "sum": maybe(rng, rng.randrange(1, 100000) / 100),
+        "measure": rng.choice(list(converter.current_mappings().measurement_units) + [None, 999]),
+        "payment_method": rng.choice(list(converter.current_mappings().payment_methods) + [None, "barter"]),
+        "payment_object": rng.choice(list(converter.current_mappings().payment_objects) + [None, 999]),
+        "vat": {"type": maybe(rng, rng.choice(("none", "vat0", "vat10", "vat20"))), "sum": maybe(rng, 1.5)},
+        "supplier_info": {"phones": phones(rng), "name": maybe(rng, "Поставщик"), "inn": maybe(rng, "7711111111")},
+        "agent_info": agent_info(rng),
+    }
+    marking = mark_code(rng)
+    if marking is not None:
+        item["mark_code"] = marking
+    return item
+
+def atol_receipt(rng):
+    """A random ATOL receipt, valid input for both forward converters."""
+    receipt = {
+        "external_id": maybe(rng, text(rng, "ext"), (None, "")),
+        "device_number": maybe(rng, text(rng, "device")),
+        "receipt": {
+            "client": {
+                "email": maybe(rng, "buyer@example.com"),
+                "inn": maybe(rng, "7722222222", (None, "")),
+                "name": maybe(rng, "Покупатель"),
+                "address": maybe(rng, "Москва"),
+            },
+            "company": {"sno": maybe(rng, rng.choice(("osn", "usn_income", "envd")))},
+            "items": [item(rng) for _ in range(rng.randrange(4))],
+            "payments": [{"type": 1, "sum": maybe(rng, 10.0)} for _ in range(rng.randrange(3))],
+            "vats": [{"type": maybe(rng, "vat20"), "sum": maybe(rng, 1.0)} for _ in range(rng.randrange(3))],
+        },
+    }
+    if rng.random() < 0.3:
+        receipt["electronically"] = rng.choice(("false", "true"))
+    return receipt
+
+RECEIPTS = [atol_receipt(random.Random(seed)) for seed in range(2000)]
+
+@pytest.mark.parametrize("orgid", [None, "org-1"])
+def test_fast_path_matches_reference_conversion(orgid):
+    for input_data in RECEIPTS:
+        expected = converter.remove_empty_fields(converter.build_target_data(input_data, orgid))
+        assert jsonlib.dumps(converter.convert_receipt(input_data, orgid)) == jsonlib.dumps(expected), input_data
+
+def test_round_trip():
+    for input_data in RECEIPTS:
+        converted = converter.convert_receipt(input_data, "org-1")
+        assert converter.convert_receipt(converter.convert_to_atol(converted), "org-1") == converted, input_data
+
+def test_round_trip_of_bare_receipt_body():
+    for input_data in RECEIPTS[:200]:
+        body = converter.convert_receipt(input_data)["receiptBody"]
+        assert converter.convert_receipt(converter.convert_to_atol(body))["receiptBody"] == body
+
+@pytest.mark.parametrize("mark_type", ["egais20", "egais30"])
+def test_marking_type_kept_without_mark(mark_type):
+    item = {"type": "position", "measurementUnit": "unknown", "paymentMethod": "unknown",
+            "paymentObject": "unknown", "markingCode": {"type": mark_type}}
+
+    reverted = converter.convert_item_to_atol(item)
+
+    assert reverted["mark_code"] == {mark_type: None}
+    assert converter.convert_item(reverted)["markingCode"] == {"type": mark_type}
+
+def test_other_marking_without_mark_is_dropped():
+    reverted = converter.convert_item_to_atol({"markingCode": {"type": "other"}})
+    assert "mark_code" not in reverted
+    assert converter.convert_item(reverted)["markingCode"] == {"type": "other"}
+
+class SwappingItem(dict):
+    """Item that reloads the mapping tables while it is being converted."""
+
+    def get(self, key, default=None):
+        if key == "payment_method":
+            converter.use_mappings("swapped", {
+                "payment_objects": {}, "payment_methods": {}, "measurement_units": {},
+            })
+        return super().get(key, default)
+
+def test_reload_during_conversion_does_not_mix_tables():
+    previous = converter.current_mappings()
+    item = {"measure": 0, "payment_method": "full_payment", "payment_object": 1}
+    try:
+        converted = converter.convert_receipt({"receipt": {"items": [SwappingItem(item), item]}})
+    finally:
+        converter.use_mappings(previous.version, previous._asdict())
+
+    expected = converter.convert_item(item)
+    assert converted["receiptBody"]["items"] == [expected, expected]
+    assert "unknown" not in expected.values()
+
+@pytest.fixture
+def mappings(monkeypatch, tmp_path):
+    """A copy of mappings.json to edit; the tables in use are restored afterwards."""
+    monkeypatch.setattr(converter, "_mappings", converter.current_mappings())
+    monkeypatch.setattr(converter, "_mappings_source", converter._mappings_source)
+    path = tmp_path / "mappings.json"
+    with open(converter.MAPPINGS_PATH, encoding="utf-8") as f:
+        config = json.load(f)
+    path.write_text(json.dumps(config), encoding="utf-8")
+    return path, config
+
+def test_reload_picks_up_a_changed_file(mappings):
+    path, config = mappings
+    config["version"] = 2
+    config["payment_objects"]["1"] = "service"
+    path.write_text(json.dumps(config), encoding="utf-8")
+
+    assert converter.reload_mappings(str(path)) == 2
+    assert converter.reload_mappings(str(path)) is None
+    assert converter.current_mappings().version == 2
+    assert converter.convert_item({"payment_object": 1})["paymentObject"] == "service"
+    assert converter.convert_item_to_atol({"paymentObject": "service"})["payment_object"] == 1
+
+def test_failed_reload_keeps_the_tables_in_use(mappings):
+    path, config = mappings
+    before = converter.current_mappings()
+    del config["payment_methods"]
+    path.write_text(json.dumps(config), encoding="utf-8")
+
+    with pytest.raises(KeyError):
+        converter.reload_mappings(str(path))
+
+    assert converter.current_mappings() is before
+
+def test_watch_keeps_running_through_a_broken_file(mappings):
+    path, config = mappings
+    before = converter.current_mappings()
+    check = prpr.watch("mappings", 1e-6, lambda: converter.reload_mappings(str(path)))
+    path.write_text("{broken", encoding="utf-8")
+
+    time.sleep(0.001)
+    check()
+    assert converter.current_mappings() is before
+
+    config["version"] = 3
+    path.write_text(json.dumps(config), encoding="utf-8")
+    time.sleep(0.001)
+    check()
+    assert converter.current_mappings().version == 3
+
+def test_unknown_codes_are_counted(monkeypatch):
+    monkeypatch.setattr(converter, "_unknown_codes", {})
+
+    item = converter.convert_item({"payment_object": 999, "payment_method": "barter", "measure": None})
+    converter.convert_item({"payment_object": 999})
+    converter.convert_item_to_atol({"paymentMethod": "barter"})
+
+    assert (item["paymentObject"], item["paymentMethod"], item["measurementUnit"]) == ("unknown",) * 3
+    assert converter.unknown_codes() == {("payment_object", "999"): 2, ("payment_method", "barter"): 1,
+                                         ("paymentMethod", "barter"): 1}
+
+def test_unknown_codes_are_capped(monkeypatch):
+    monkeypatch.setattr(converter, "_unknown_codes", {})
+    monkeypatch.setattr(converter, "MAX_UNKNOWN_CODES", 2)
+
+    for code in range(900, 905):
+        converter.convert_item({"payment_object": code})
+    converter.convert_item({"payment_object": 900})
+
+    assert converter.unknown_codes() == {
+        ("payment_object", "900"): 2, ("payment_object", "901"): 1, ("payment_object", "other"): 3,
+    }
+
+def test_unknown_codes_are_exposed_as_metrics(monkeypatch):
+    monkeypatch.setattr(converter, "_unknown_codes", {})
+    converter.convert_item({"payment_object": 'bad"code'})
+
+    text = prpr.app.test_client().get("/metrics").get_data(as_text=True)
+
+    assert 'prpr_unknown_codes_total{field="payment_object",code="bad\\"code"} 1' in text.splitlines()
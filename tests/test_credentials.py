@@ -0,0 +1,119 @@
+import base64
+
+import pytest
+from starlette.testclient import TestClient
+
+import asgi
+import credentials
+import prpr
+from credentials import Credentials, parse_basic
+from token_cache import LoginError
+
+def basic(text):
+    return "Basic " + base64.b64encode(text.encode("utf-8")).decode()
+
+def receipt(external_id):
+    return {
+        "external_id": external_id,
+        "receipt": {
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+            "payments": [{"type": 1, "sum": 3.0}],
+            "total": 3.0,
+        },
+    }
+
+def test_password_may_contain_colons():
+    credential = parse_basic(basic("shop:pass:with:colons"))
+
+    assert (credential.username, credential.password) == ("shop", "pass:with:colons")
+    assert credential.key == credentials.credential_key("shop", "pass:with:colons")
+    assert "pass" not in credential.key
+
+def test_key_tells_the_colon_apart():
+    assert parse_basic(basic("a:b:c")).key != parse_basic(basic("a:b\0c")).key
+
+def test_non_ascii_credentials():
+    assert parse_basic(basic("магазин:пароль"))[:2] == ("магазин", "пароль")
+
+@pytest.mark.parametrize("header, error", [
+    (None, "Authorization header is required and should be Basic"),
+    ("Bearer token", "Authorization header is required and should be Basic"),
+    ("Basic not*base64", "Malformed Basic credentials"),
+    ("Basic " + base64.b64encode(b"\xff\xfe:x").decode(), "Malformed Basic credentials"),
+    (basic("no-colon"), "Malformed Basic credentials"),
+    (basic("shop:"), "Password is required"),
+])
+def test_malformed_headers(header, error):
+    with pytest.raises(LoginError) as raised:
+        parse_basic(header)
+
+    assert (raised.value.status_code, raised.value.body) == (400, {"error": error})
+
+def test_parsed_headers_are_cached_lru():
+    cache = Credentials(maxsize=2, reject_ttl=30)
+    first = cache.parse(basic("a:1"))
+    cache.parse(basic("b:2"))
+    assert cache.parse(basic("a:1")) is first
+
+    cache.parse(basic("c:3"))
+
+    assert list(cache._parsed) == [basic("a:1"), basic("c:3")]
+
+@pytest.mark.parametrize("status, cached", [(401, True), (403, True), (400, False), (429, False), (503, False)])
+def test_only_refused_credentials_are_remembered(status, cached):
+    cache = Credentials(maxsize=10, reject_ttl=30)
+
+    cache.reject("key", LoginError({"error": "nope"}, status))
+
+    if cached:
+        with pytest.raises(LoginError) as raised:
+            cache.check("key")
+        assert (raised.value.status_code, raised.value.body) == (status, {"error": "nope"})
+    else:
+        cache.check("key")
+
+def test_rejection_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(credentials.time, "monotonic", lambda: now[0])
+    cache = Credentials(maxsize=10, reject_ttl=30)
+    cache.reject("key", LoginError({"error": "nope"}, 401))
+
+    now[0] += 29
+    with pytest.raises(LoginError):
+        cache.check("key")
+    now[0] += 1
+    cache.check("key")
+
+    assert cache.stats == {"rejected": 1, "refused": 1}
+    assert not cache._rejected
+
+def test_zero_ttl_turns_the_negative_cache_off():
+    cache = Credentials(maxsize=10, reject_ttl=0)
+
+    cache.reject("key", LoginError({"error": "nope"}, 401))
+
+    cache.check("key")
+
+def test_rejected_login_is_not_retried_upstream(stub):
+    headers = {"Authorization": basic("credentials-rejected:wrong")}
+    stub.error_rate = 1.0
+    stub.error_status = 401
+    first = prpr.app.test_client().post("/process", json=receipt("credentials-1"), headers=headers)
+    stub.error_rate = 0.0
+    logins = stub.snapshot()
+
+    again = prpr.app.test_client().post("/process", json=receipt("credentials-2"), headers=headers)
+    with TestClient(asgi.app) as client:
+        from_asgi = client.post("/process", json=receipt("credentials-3"), headers=headers)
+
+    assert first.status_code == again.status_code == from_asgi.status_code == 401
+    assert again.get_json() == from_asgi.json() == {"error": "Stub failure"}
+    assert stub.snapshot() == logins
+
+def test_colon_in_password_reaches_the_upstream(stub):
+    headers = {"Authorization": basic("credentials-colon:pa:ss")}
+
+    response = prpr.app.test_client().post("/process", json=receipt("credentials-colon"), headers=headers)
+
+    assert response.status_code == 200
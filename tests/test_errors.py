@@ -0,0 +1,124 @@
+import base64
+
+import httpx
+import pytest
+import requests
+from starlette.testclient import TestClient
+
+import asgi
+import prpr
+from breaker import CircuitBreaker, CircuitOpen
+from idempotency import IdempotencyConflict
+from ratelimit import RateLimited
+from token_cache import LoginError
+
+AUTH = {"Authorization": "Basic " + base64.b64encode(b"errors-user:secret").decode()}
+RECEIPT = {
+    "external_id": "errors-1",
+    "receipt": {
+        "company": {"sno": "osn", "inn": "7700000000"},
+        "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+        "payments": [{"type": 1, "sum": 3.0}],
+        "total": 3.0,
+    },
+}
+
+ERRORS = [
+    (LoginError({"error": "Invalid credentials"}, 401), 401, {"error": "Invalid credentials"}, None),
+    (RateLimited(2.5), 429, {"error": "Too many requests"}, "3"),
+    (CircuitOpen("receipt", 10), 503, {"error": "Upstream unavailable"}, "10"),
+    (IdempotencyConflict("key"), 409, {"error": "Receipt with this external_id is already being processed"}, None),
+]
+
+def raising(error):
+    def fail(*args, **kwargs):
+        raise error
+
+    async def afail(*args, **kwargs):
+        raise error
+    return fail, afail
+
+@pytest.mark.parametrize("error, status, body, retry", ERRORS + [
+    (requests.ConnectionError(), 502, {"error": "Failed to send receipt data"}, None),
+])
+def test_delivery_errors_answered_alike(monkeypatch, error, status, body, retry):
+    fail, afail = raising(error)
+    monkeypatch.setattr(prpr, "deliver", fail)
+    monkeypatch.setattr(asgi, "deliver", afail)
+    if isinstance(error, requests.RequestException):
+        monkeypatch.setattr(asgi, "deliver", raising(httpx.ConnectError("refused"))[1])
+
+    flask = prpr.app.test_client().post("/process", json=RECEIPT, headers=AUTH)
+    starlette = TestClient(asgi.app).post("/process", json=RECEIPT, headers=AUTH)
+
+    assert (flask.status_code, flask.get_json(), flask.headers.get("Retry-After")) == (status, body, retry)
+    assert (starlette.status_code, starlette.json(), starlette.headers.get("Retry-After")) == (status, body, retry)
+
+@pytest.mark.parametrize("error, status, body, retry", ERRORS)
+def test_batch_item_errors(monkeypatch, error, status, body, retry):
+    monkeypatch.setattr(prpr, "deliver", raising(error)[0])
+
+    result = prpr.app.test_client().post("/process/batch", json=[RECEIPT], headers=AUTH).get_json()["results"][0]
+
+    assert result["status"] == status
+    assert result["error"] == (body if isinstance(error, LoginError) else body["error"])
+    assert result.get("retry_after") == (int(retry) if retry else None)
+
+def test_login_connection_failure(monkeypatch):
+    monkeypatch.setattr(prpr, "get_token", raising(requests.ConnectionError())[0])
+    response = prpr.app.test_client().post("/process", json=RECEIPT, headers=AUTH)
+    assert response.status_code == 502
+    assert response.get_json() == {"error": "Failed to get token"}
+
+@pytest.fixture
+def error_page(stub, monkeypatch):
+    """The stub failing every call with a proxy's HTML 502 page."""
+    # The failures must not open the breakers other tests go through
+    for upstream in prpr.router.upstreams.values():
+        monkeypatch.setattr(upstream, "breakers", {target: CircuitBreaker(target) for target in upstream.breakers})
+    stub.error_status = 502
+    stub.error_page = True
+    return stub
+
+def test_login_error_page(error_page):
+    error_page.error_rate = 1.0
+    auth = {"Authorization": "Basic " + base64.b64encode(b"error-page-login:secret").decode()}
+
+    flask = prpr.app.test_client().post("/process", json=RECEIPT, headers=auth)
+    with TestClient(asgi.app) as client:
+        starlette = client.post("/process", json=RECEIPT, headers=auth)
+
+    assert (flask.status_code, flask.get_json()) == (502, {"error": "Failed to get token"})
+    assert (starlette.status_code, starlette.json()) == (502, {"error": "Failed to get token"})
+
+@pytest.mark.parametrize("path, body", [
+    ("/process", dict(RECEIPT, external_id="error-page-1")),
+    ("/process/batch", [dict(RECEIPT, external_id="error-page-2")]),
+])
+def test_receipt_error_page(error_page, path, body):
+    auth = {"Authorization": "Basic " + base64.b64encode(b"error-page-receipt:secret").decode()}
+    client = prpr.app.test_client()
+    # Log in while the stub still answers, so only the receipt POST fails
+    assert client.post("/process", json=dict(RECEIPT, external_id="error-page-0"), headers=auth).status_code == 200
+    error_page.error_rate = 1.0
+
+    flask = client.post(path, json=body, headers=auth)
+    with TestClient(asgi.app) as client:
+        starlette = client.post(path, json=body, headers=auth)
+
+    for status, answer in ((flask.status_code, flask.get_json()), (starlette.status_code, starlette.json())):
+        if path == "/process":
+            assert (status, answer) == (502, {"error": "Failed to send receipt data"})
+        else:
+            assert (status, answer["results"]) == (200, [{"status": 502, "error": "Failed to send receipt data"}])
+
+def test_streamed_receipt_error_page(error_page, monkeypatch):
+    monkeypatch.setattr(prpr.settings, "STREAM_THRESHOLD", 1)
+    auth = {"Authorization": "Basic " + base64.b64encode(b"error-page-stream:secret").decode()}
+    client = prpr.app.test_client()
+    assert client.post("/process", json=dict(RECEIPT, external_id="error-page-3"), headers=auth).status_code == 200
+    error_page.error_rate = 1.0
+
+    response = client.post("/process", json=dict(RECEIPT, external_id="error-page-4"), headers=auth)
+
+    assert (response.status_code, response.get_json()) == (502, {"error": "Failed to send receipt data"})
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import prpr
+import settings
+from idempotency import IdempotencyCache, MemoryBackend, SQLiteBackend
+
+@pytest.fixture
+def backend(tmp_path):
+    return SQLiteBackend(str(tmp_path / "idempotency.sqlite3"))
+
+def claim_expiry(backend, key):
+    row = backend._connect().execute("SELECT expires_at FROM idempotency WHERE key = ?", (key,)).fetchone()
+    return row[0] - time.time()
+
+def test_claim_lasts_for_the_lease_not_the_wait(backend):
+    cache = IdempotencyCache(backend, ttl=60, wait=1)
+    seen = []
+
+    def send():
+        seen.append(claim_expiry(backend, "org:1"))
+        return 200, {"status": "wait"}
+
+    assert cache.run("org:1", send, lease=300) == (200, {"status": "wait"}, False)
+    assert 290 < seen[0] <= 300
+
+def test_lease_defaults_to_wait(backend):
+    cache = IdempotencyCache(backend, ttl=60, wait=5)
+    seen = []
+
+    def send():
+        seen.append(claim_expiry(backend, "org:2"))
+        return 503, None
+
+    cache.run("org:2", send)
+    assert 0 < seen[0] <= 5
+
+def test_delivery_time_outlasts_slowest_call():
+    upstream = prpr.router.upstreams["default"]
+    options = upstream.options
+    one_post = options["connect_timeout"] * (options["retries"] + 1) + options["read_timeout"]
+    assert upstream.delivery_time > 2 * one_post + settings.RATE_LIMIT_WAIT
+    assert upstream.delivery_time > settings.IDEMPOTENCY_WAIT
+
+class Interrupted(BaseException):
+    """Stands in for a killed greenlet or a KeyboardInterrupt."""
+
+def test_interrupted_delivery_is_taken_over(backend):
+    cache = IdempotencyCache(backend, ttl=60, wait=1)
+    calls = []
+    waiting = threading.Event()
+
+    def send():
+        calls.append(1)
+        if len(calls) == 1:
+            waiting.wait(5)
+            raise Interrupted()
+        return 200, {"status": "wait"}
+
+    interrupted = []
+
+    def leader():
+        try:
+            cache.run("org:3", send)
+        except Interrupted:
+            interrupted.append(True)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    while not calls:
+        time.sleep(0.001)
+    # Released once the duplicate below is waiting on the leader
+    threading.Timer(0.1, waiting.set).start()
+
+    assert cache.run("org:3", send) == (200, {"status": "wait"}, False)
+    thread.join()
+    assert interrupted == [True]
+    assert len(calls) == 2
+
+def test_cancelled_async_delivery_is_taken_over():
+    async def scenario():
+        cache = IdempotencyCache(MemoryBackend(10), ttl=60)
+        calls = []
+        started = asyncio.Event()
+
+        async def send():
+            calls.append(1)
+            if len(calls) == 1:
+                started.set()
+                await asyncio.sleep(10)
+            return 200, {"status": "wait"}
+
+        leader = asyncio.create_task(cache.arun("org:4", send))
+        await started.wait()
+        duplicate = asyncio.create_task(cache.arun("org:4", send))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        assert await duplicate == (200, {"status": "wait"}, False)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,70 @@
+import base64
+import json
+
+import pytest
+from starlette.testclient import TestClient
+
+import asgi
+import jsonlib
+import prpr
+import settings
+
+def auth(username):
+    return {"Authorization": "Basic " + base64.b64encode(("%s:secret" % username).encode()).decode()}
+
+def receipt(external_id):
+    return {
+        "external_id": external_id,
+        "receipt": {
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+            "payments": [{"type": 1, "sum": 3.0}],
+            "total": 3.0,
+        },
+    }
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(jsonlib, "orjson", None)
+    elif jsonlib.orjson is None:
+        pytest.skip("orjson is not installed")
+    return request.param
+
+def test_raw_json_is_written_as_is(backend):
+    raw = jsonlib.RawJSON(b'{"status":  "wait" ,"uuid": "1"}')
+
+    assert jsonlib.dumps(raw) == b'{"status":  "wait" ,"uuid": "1"}'
+    assert type(jsonlib.dumps(raw)) is bytes
+
+def test_plain_decodes_only_raw_json(backend):
+    decoded = {"status": "wait"}
+
+    assert jsonlib.plain(jsonlib.RawJSON(b'{"status": "wait"}')) == decoded
+    assert jsonlib.plain(decoded) is decoded
+
+def test_dumps_is_compact_utf8(backend):
+    assert jsonlib.dumps({"name": "Товар", "items": [1, 2]}) == '{"name":"Товар","items":[1,2]}'.encode("utf-8")
+
+def test_dumps_falls_back_for_values_orjson_rejects(backend):
+    assert jsonlib.loads(jsonlib.dumps({1: 2 ** 70})) == {"1": 2 ** 70}
+
+def passthrough_bodies(monkeypatch, enabled):
+    monkeypatch.setattr(settings, "PASSTHROUGH_RESPONSE", enabled)
+    flask = prpr.app.test_client().post(
+        "/process", json=receipt("jsonlib-flask-%s" % enabled), headers=auth("jsonlib-user"))
+    with TestClient(asgi.app) as client:
+        starlette = client.post(
+            "/process", json=receipt("jsonlib-asgi-%s" % enabled), headers=auth("jsonlib-user"))
+    assert flask.status_code == starlette.status_code == 200
+    return flask.data, starlette.content
+
+def test_passthrough_returns_upstream_bytes(monkeypatch, stub):
+    for body in passthrough_bodies(monkeypatch, True):
+        # The stub writes json.dumps defaults, which jsonlib never produces
+        assert body == json.dumps(json.loads(body)).encode("utf-8")
+        assert b'", "' in body
+
+def test_without_passthrough_the_body_is_reencoded(monkeypatch, stub):
+    for body in passthrough_bodies(monkeypatch, False):
+        assert body == jsonlib.dumps(json.loads(body))
@@ -0,0 +1,60 @@
+import json
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+import loadgen
+import prpr
+from bench import SHAPES
+
+@pytest.fixture
+def service():
+    """prpr served over HTTP, in front of the stub upstream."""
+    server = make_server("127.0.0.1", 0, prpr.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d" % server.server_port
+    server.shutdown()
+
+def test_parse_mix():
+    assert loadgen.parse_mix("1-item:80,dense-50") == [("1-item", 80.0), ("dense-50", 1.0)]
+    assert {shape for shape, _ in loadgen.parse_mix(loadgen.DEFAULT_MIX)} <= set(SHAPES)
+    with pytest.raises(ValueError):
+        loadgen.parse_mix("1-item:80,50-items:20")
+
+def test_templates_take_a_fresh_external_id():
+    head, tail = loadgen.templates([("1-item", 1.0)])["1-item"]
+
+    receipt = json.loads(head + b"run-7" + tail)
+
+    assert receipt == dict(SHAPES["1-item"], external_id="run-7")
+
+def test_percentile():
+    values = [0.1 * n for n in range(1, 11)]
+
+    assert loadgen.percentile([], 0.5) == 0.0
+    assert loadgen.percentile(values, 0.5) == values[5]
+    assert loadgen.percentile(values, 0.99) == values[-1]
+
+def test_run_against_the_service(service, stub):
+    results = loadgen.run(service, rps=40, duration=0.5, concurrency=4, mix="1-item:3,dense-50:1", users=2, seed=1)
+
+    assert len(results) == 20
+    assert {status for _, status, _ in results} == {200}
+    assert {shape for shape, _, _ in results} == {"1-item", "dense-50"}
+    assert all(latency > 0 for _, _, latency in results)
+
+def test_failed_connections_are_reported(stub):
+    results = loadgen.run("http://127.0.0.1:9", rps=20, duration=0.1, concurrency=2, mix="1-item", timeout=1)
+
+    assert [status for _, status, _ in results] == [0, 0]
+
+def test_summarize():
+    results = [("1-item", 200, 0.010), ("1-item", 200, 0.020), ("dense-50", 0, 0.5), ("dense-50", 503, 0.1)]
+
+    lines = loadgen.summarize(results, 2.0).splitlines()
+
+    assert lines[0] == "requests 4 in 2.0s, 2.0 req/s, errors 50.00%"
+    assert lines[1] == "status   failed: 1, 200: 2, 503: 1"
+    assert [line.split()[0] for line in lines[2:]] == ["all", "1-item", "dense-50"]
+    assert "max    500.0 ms" in lines[2]
@@ -0,0 +1,104 @@
+import base64
+import json
+import logging
+
+import pytest
+
+import logs
+import prpr
+import settings
+
+def auth(username, password="secret"):
+    return {"Authorization": "Basic " + base64.b64encode(("%s:%s" % (username, password)).encode()).decode()}
+
+def receipt(external_id):
+    return {
+        "external_id": external_id,
+        "receipt": {
+            "client": {"email": "buyer@example.com", "inn": "500100732259"},
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+            "payments": [{"type": 1, "sum": 3.0}],
+            "total": 3.0,
+        },
+    }
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.setFormatter(logs.JsonFormatter())
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+@pytest.fixture
+def written():
+    """Log lines as the JSON writer would print them."""
+    handler = ListHandler()
+    logger = logging.getLogger("prpr")
+    logger.addHandler(handler)
+    yield handler.lines
+    logger.removeHandler(handler)
+
+def test_redactor_masks_fields_at_any_depth():
+    redact = logs.Redactor(["Password", " authorization ", "phones", ""])
+    data = {
+        "password": "secret",
+        "AUTHORIZATION": "Basic dXNlcjpzZWNyZXQ=",
+        "client": {"phones": ["+79000000000"], "name": "Buyer"},
+        "items": [{"password": "nested"}],
+        "token": None,
+        1: "numeric key",
+    }
+
+    assert redact(data) == {
+        "password": logs.REDACTED,
+        "AUTHORIZATION": logs.REDACTED,
+        "client": {"phones": logs.REDACTED, "name": "Buyer"},
+        "items": [{"password": logs.REDACTED}],
+        "token": None,
+        1: "numeric key",
+    }
+
+def test_redactor_leaves_input_unchanged():
+    data = {"password": "secret"}
+
+    logs.Redactor(["password"])(data)
+
+    assert data == {"password": "secret"}
+
+def test_default_fields_cover_credentials():
+    redact = logs.Redactor(settings.LOG_REDACT_FIELDS.split(","))
+
+    assert redact({"password": "p", "token": "t", "Authorization": "a"}) == {
+        "password": logs.REDACTED, "token": logs.REDACTED, "Authorization": logs.REDACTED,
+    }
+
+def test_rejected_receipt_is_logged_redacted(stub, written):
+    headers = auth("logs-rejected-user", "logs-password")
+    prpr.get_token(headers["Authorization"])
+    stub.error_rate = 1.0
+    stub.error_status = 400
+
+    prpr.app.test_client().post("/process", json=receipt("logs-rejected"), headers=headers)
+
+    entry = json.loads(next(line for line in written if "Upstream rejected receipt" in line))
+    assert entry["extern_id"] == "logs-rejected"
+    assert entry["payload"]["receiptBody"]["clientInfo"] == {"emailOrPhone": logs.REDACTED, "vatin": logs.REDACTED}
+    assert entry["level"] == "WARNING"
+
+def test_credentials_never_reach_the_log(stub, written):
+    headers = auth("logs-login-user", "logs-password")
+    stub.error_rate = 1.0
+    stub.error_status = 401
+
+    response = prpr.app.test_client().post("/process", json=receipt("logs-login"), headers=headers)
+
+    assert response.status_code == 401
+    entry = json.loads(next(line for line in written if "Login failed" in line))
+    assert entry["user"] == "logs-login-user"
+    text = "\n".join(written)
+    assert "logs-password" not in text
+    assert headers["Authorization"].split()[1] not in text
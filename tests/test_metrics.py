@@ -0,0 +1,104 @@
+import base64
+
+import metrics
+import prpr
+import settings
+
+def auth(username):
+    return {"Authorization": "Basic " + base64.b64encode(("%s:secret" % username).encode()).decode()}
+
+def receipt(external_id):
+    return {
+        "external_id": external_id,
+        "receipt": {
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+            "payments": [{"type": 1, "sum": 3.0}],
+            "total": 3.0,
+        },
+    }
+
+def sample(text, series):
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+def test_counter_exposition():
+    registry = metrics.Registry()
+    counter = registry.counter("test_total", "Test counter", ("path",))
+    counter.inc('a"b\\c\n')
+    counter.inc("plain", amount=2.5)
+
+    assert registry.render().splitlines() == [
+        "# HELP test_total Test counter",
+        "# TYPE test_total counter",
+        'test_total{path="a\\"b\\\\c\\n"} 1',
+        'test_total{path="plain"} 2.5',
+    ]
+
+def test_histogram_buckets_are_cumulative():
+    registry = metrics.Registry()
+    histogram = registry.histogram("test_seconds", "Test histogram", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        "test_seconds_count 4",
+        "test_seconds_sum 3.65",
+    ]
+
+def test_callback_counter_reads_values_at_scrape_time():
+    values = {}
+    registry = metrics.Registry()
+    registry.register(metrics.CallbackCounter("test_callback_total", "Test callback", ("kind",), lambda: values))
+
+    values[("late",)] = 3
+
+    assert registry.render().splitlines()[-1] == 'test_callback_total{kind="late"} 3'
+
+def test_server_timing_sums_repeated_stages():
+    timings = [("token", 0.002), ("deliver", 0.010), ("deliver", 0.0005)]
+
+    assert metrics.server_timing_header(timings) == "token;dur=2.000, deliver;dur=10.500"
+
+def test_process_is_counted(stub):
+    client = prpr.app.test_client()
+    before = client.get("/metrics").get_data(as_text=True)
+
+    response = client.post("/process", json=receipt("metrics-process"), headers=auth("metrics-user"))
+
+    after = client.get("/metrics").get_data(as_text=True)
+    assert response.status_code == 200
+    assert sample(after, 'prpr_requests_total{endpoint="process",status="200"}') == \
+        sample(before, 'prpr_requests_total{endpoint="process",status="200"}') + 1
+    assert sample(after, 'prpr_upstream_request_seconds_count{target="receipt"}') == \
+        sample(before, 'prpr_upstream_request_seconds_count{target="receipt"}') + 1
+    assert sample(after, 'prpr_receipt_items_count') == sample(before, 'prpr_receipt_items_count') + 1
+
+def test_upstream_errors_are_counted_by_status(stub):
+    client = prpr.app.test_client()
+    headers = auth("metrics-error-user")
+    prpr.get_token(headers["Authorization"])
+    stub.error_rate = 1.0
+    stub.error_status = 400
+    series = 'prpr_upstream_errors_total{target="receipt",kind="400"}'
+    before = sample(client.get("/metrics").get_data(as_text=True), series)
+
+    client.post("/process", json=receipt("metrics-error"), headers=headers)
+
+    assert sample(client.get("/metrics").get_data(as_text=True), series) == before + 1
+
+def test_server_timing_header(monkeypatch, stub):
+    client = prpr.app.test_client()
+    monkeypatch.setattr(settings, "SERVER_TIMING", False)
+    plain = client.post("/process", json=receipt("metrics-timing-1"), headers=auth("metrics-timing-user"))
+    monkeypatch.setattr(settings, "SERVER_TIMING", True)
+    timed = client.post("/process", json=receipt("metrics-timing-2"), headers=auth("metrics-timing-user"))
+
+    assert "Server-Timing" not in plain.headers
+    stages = [entry.split(";")[0] for entry in timed.headers["Server-Timing"].split(", ")]
+    assert {"parse", "convert", "deliver"} <= set(stages)
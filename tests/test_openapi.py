@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import validation
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in the worker: reports what SWAGGER=static loaded and how it answers
+PROBE = """
+import base64, json, sys
+import prpr
+client = prpr.app.test_client()
+auth = {"Authorization": "Basic " + base64.b64encode(b"openapi-user:secret").decode()}
+receipt = {"external_id": "openapi-1", "receipt": {
+    "company": {"sno": "osn", "inn": "7700000000"},
+    "items": [{"name": "Item", "price": "1.5", "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+    "payments": [{"type": 1, "sum": 3.0}], "total": 3.0}}
+spec = client.get(prpr.SPEC_ROUTE)
+process = client.post("/process", json=receipt, headers=auth)
+print(json.dumps({
+    "modules": sorted(name for name in ("flasgger", "yaml") if name in sys.modules),
+    "spec": [spec.status_code, spec.get_json()],
+    "process": [process.status_code, process.get_json()],
+}))
+"""
+
+def start(tmp_path, code="import prpr", **env):
+    """Import prpr in a fresh interpreter, as a worker would."""
+    env = dict(os.environ, OPENAPI_SPEC_PATH=str(tmp_path / "openapi.json"), **env)
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True)
+
+@pytest.fixture(scope="module")
+def spec(tmp_path_factory):
+    """The spec as openapi.py writes it."""
+    path = tmp_path_factory.mktemp("spec") / "openapi.json"
+    env = dict(os.environ, SWAGGER="on")
+    subprocess.run([sys.executable, "openapi.py", "-o", str(path)], cwd=ROOT, env=env, check=True, capture_output=True)
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def probe(tmp_path, spec):
+    (tmp_path / "openapi.json").write_text(json.dumps(spec), encoding="utf-8")
+    result = start(tmp_path, PROBE, SWAGGER="static")
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+def test_static_mode_needs_the_generated_spec(tmp_path):
+    result = start(tmp_path, SWAGGER="static")
+    assert result.returncode != 0
+    assert "SWAGGER=static needs %s" % (tmp_path / "openapi.json") in result.stderr
+
+def test_generated_spec_documents_the_endpoints(spec):
+    assert {"/process", "/process/batch"} <= set(spec["paths"])
+    schema = validation.spec_body_schema(spec, "/process", "post")
+    assert "receipt" in schema["required"]
+
+def test_static_mode_serves_the_file_without_flasgger(tmp_path, spec):
+    result = probe(tmp_path, spec)
+
+    assert result["modules"] == []
+    assert result["spec"] == [200, spec]
+    assert result["process"] == [422, {
+        "error": "Receipt validation failed",
+        "errors": [{"field": "receipt.items[0].price", "error": "should be number"}],
+    }]
+
+def test_static_mode_validates_against_the_file(tmp_path, spec):
+    spec = json.loads(json.dumps(spec))
+    schema = validation.spec_body_schema(spec, "/process", "post")
+    schema["properties"]["receipt"]["properties"]["items"]["items"]["properties"]["price"]["type"] = "string"
+    schema["properties"]["receipt"]["properties"]["total"]["type"] = "string"
+
+    result = probe(tmp_path, spec)
+
+    assert result["process"] == [422, {
+        "error": "Receipt validation failed",
+        "errors": [{"field": "receipt.total", "error": "should be string"}],
+    }]
@@ -0,0 +1,205 @@
+import asyncio
+import base64
+
+import pytest
+from starlette.testclient import TestClient
+
+import asgi
+import prpr
+import ratelimit
+import routing
+import settings
+from ratelimit import Limiter, RateLimited
+
+AUTH = {"Authorization": "Basic " + base64.b64encode(b"ratelimit-user:secret").decode()}
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "time", clock.time)
+    return clock
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return ratelimit.MemoryBackend()
+    return ratelimit.SQLiteBackend(str(tmp_path / "ratelimit.sqlite3"))
+
+def receipt(external_id):
+    return {
+        "external_id": external_id,
+        "receipt": {
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+            "payments": [{"type": 1, "sum": 3.0}],
+            "total": 3.0,
+        },
+    }
+
+def test_gcra_grants_a_burst_then_delays():
+    tat, results = None, []
+    for _ in range(4):
+        granted, delay, new_tat = ratelimit._gcra(tat, 100.0, 0.5, 3, 1.0)
+        results.append((granted, delay))
+        tat = new_tat if granted else tat
+
+    assert results == [(True, 0.0), (True, 0.0), (True, 0.0), (True, 0.5)]
+    assert ratelimit._gcra(tat, 100.0, 0.5, 3, 0.9) == (False, 1.0, None)
+
+def test_bucket_refills_over_time(backend, clock):
+    assert [backend.reserve("key", 1.0, 2, 0)[0] for _ in range(3)] == [True, True, False]
+    # A refused request does not use up capacity
+    assert backend.reserve("key", 1.0, 2, 0) == (False, 1.0)
+    assert backend.reserve("other", 1.0, 2, 0) == (True, 0.0)
+
+    clock.now += 1.0
+
+    assert backend.reserve("key", 1.0, 2, 0) == (True, 0.0)
+    assert backend.reserve("key", 1.0, 2, 0)[0] is False
+
+def test_slots_are_capped_and_released(backend, clock):
+    first = backend.acquire_slot("pool", 2, 30)
+    second = backend.acquire_slot("pool", 2, 30)
+
+    assert first is not None and second is not None
+    assert backend.acquire_slot("pool", 2, 30) is None
+    assert backend.acquire_slot("other", 2, 30) is not None
+
+    backend.release_slot("pool", first)
+
+    assert backend.acquire_slot("pool", 2, 30) is not None
+
+def test_slot_of_a_dead_worker_expires_with_its_lease(tmp_path, clock):
+    backend = ratelimit.SQLiteBackend(str(tmp_path / "ratelimit.sqlite3"))
+    backend.acquire_slot("pool", 1, 30)
+
+    assert backend.acquire_slot("pool", 1, 30) is None
+    clock.now += 30
+    assert backend.acquire_slot("pool", 1, 30) is not None
+
+def test_sqlite_buckets_are_shared_between_connections(tmp_path, clock):
+    path = str(tmp_path / "ratelimit.sqlite3")
+    ratelimit.SQLiteBackend(path).reserve("key", 1.0, 1, 0)
+
+    assert ratelimit.SQLiteBackend(path).reserve("key", 1.0, 1, 0) == (False, 1.0)
+
+def test_memory_backend_drops_spent_buckets(clock):
+    backend = ratelimit.MemoryBackend(maxsize=2)
+    backend.reserve("a", 1.0, 1, 0)
+    backend.reserve("b", 1.0, 1, 0)
+    clock.now += 5
+    backend.reserve("c", 1.0, 1, 0)
+
+    assert list(backend._buckets) == ["c"]
+
+def test_throttle_waits_for_its_token(monkeypatch, clock):
+    monkeypatch.setattr(ratelimit.time, "sleep", clock.sleep)
+    limiter = Limiter(ratelimit.MemoryBackend(), rate=2, burst=1, concurrency=0, wait=0.5, lease=30)
+
+    limiter.throttle("key")
+    limiter.throttle("key")
+    with pytest.raises(RateLimited) as raised:
+        limiter.throttle("key")
+
+    assert clock.slept == [0.5]
+    assert raised.value.retry_after == 1.0
+    assert limiter.stats == {"delayed": 1, "rejected": 1}
+
+def test_athrottle_matches_throttle(monkeypatch, backend, clock):
+    async def sleep(seconds):
+        clock.sleep(seconds)
+    monkeypatch.setattr(ratelimit.asyncio, "sleep", sleep)
+    limiter = Limiter(backend, rate=2, burst=1, concurrency=0, wait=0.5, lease=30)
+
+    async def run():
+        await limiter.athrottle("key")
+        await limiter.athrottle("key")
+        with pytest.raises(RateLimited):
+            await limiter.athrottle("key")
+
+    asyncio.run(run())
+    assert clock.slept == [0.5]
+
+def test_zero_turns_limits_off():
+    limiter = Limiter(None, rate=0, burst=1, concurrency=0, wait=0, lease=30)
+
+    limiter.throttle("key")
+    with limiter.slot():
+        pass
+    asyncio.run(limiter.athrottle("key"))
+
+def test_slot_gives_up_after_wait(backend):
+    limiter = Limiter(backend, rate=0, burst=1, concurrency=1, wait=0.05, lease=30, poll=0.01)
+
+    with limiter.slot():
+        with pytest.raises(RateLimited):
+            with limiter.slot():
+                pass
+
+    with limiter.slot():
+        pass
+    assert limiter.stats == {"delayed": 0, "rejected": 1}
+
+def test_aslot_waits_for_a_free_slot(backend):
+    limiter = Limiter(backend, rate=0, burst=1, concurrency=1, wait=1, lease=30, poll=0.01)
+    inside, peak = [], []
+
+    async def call():
+        async with limiter.aslot():
+            inside.append(True)
+            peak.append(len(inside))
+            await asyncio.sleep(0.05)
+            inside.pop()
+
+    async def run():
+        await asyncio.gather(call(), call())
+
+    asyncio.run(run())
+    assert peak == [1, 1]
+    assert limiter.stats == {"delayed": 1, "rejected": 0}
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        ratelimit.make_backend("memcached", settings)
+
+@pytest.fixture
+def limited(monkeypatch):
+    """The default upstream allows one receipt per 10 seconds and does not wait."""
+    monkeypatch.setattr(settings, "RATE_LIMIT_WAIT", 0)
+    router = routing.Router(settings, ratelimit.make_backend("memory", settings))
+    router.load({"version": 1, "upstreams": {"default": {"rate_limit": 0.1, "rate_limit_burst": 1}}, "default": "default"})
+    monkeypatch.setattr(prpr, "router", router)
+    return router
+
+def test_process_answers_429_with_retry_after(limited, stub):
+    client = prpr.app.test_client()
+
+    first = client.post("/process", json=receipt("ratelimit-1"), headers=AUTH)
+    second = client.post("/process", json=receipt("ratelimit-2"), headers=AUTH)
+    with TestClient(asgi.app) as asgi_client:
+        third = asgi_client.post("/process", json=receipt("ratelimit-3"), headers=AUTH)
+
+    assert first.status_code == 200
+    assert (second.status_code, second.get_json()) == (429, {"error": "Too many requests"})
+    assert (third.status_code, third.json()) == (429, {"error": "Too many requests"})
+    assert 1 <= int(third.headers["Retry-After"]) <= int(second.headers["Retry-After"]) == 10
+
+def test_batch_reports_retry_after_per_receipt(limited, stub):
+    response = prpr.app.test_client().post(
+        "/process/batch", json=[receipt("ratelimit-batch-1"), receipt("ratelimit-batch-2")], headers=AUTH)
+
+    results = response.get_json()["results"]
+    assert results[0]["status"] == 200
+    assert results[1] == {"status": 429, "error": "Too many requests", "retry_after": 10}
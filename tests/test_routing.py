@@ -0,0 +1,114 @@
+import asyncio
+import base64
+import json
+import os
+import runpy
+import time
+
+import pytest
+
+import asgi
+import prpr
+import ratelimit
+import routing
+import settings
+
+def auth(username):
+    return "Basic " + base64.b64encode(("%s:secret" % username).encode()).decode()
+
+@pytest.fixture
+def router(monkeypatch):
+    router = routing.Router(settings, ratelimit.make_backend("memory", settings))
+    router.load({
+        "version": 1,
+        "upstreams": {"stage": {}, "prod": {}},
+        "users": {"shop-prod": "prod"},
+        "default": "stage",
+    })
+    monkeypatch.setattr(prpr, "router", router)
+    return router
+
+def trip(upstream):
+    breaker = upstream.breakers["receipt"]
+    breaker.min_calls = 1
+    breaker.before()
+    breaker.after(time.perf_counter(), error=OSError())
+
+def test_idempotency_key_is_per_upstream(router):
+    data = {"orgId": "org-1", "externId": "ext-1"}
+    stage = prpr.idempotency_key(router.upstreams["stage"], data, auth("shop"))
+    prod = prpr.idempotency_key(router.upstreams["prod"], data, auth("shop"))
+    assert stage != prod
+
+def test_idempotency_key_without_org_id_is_per_credential(router):
+    data = {"externId": "ext-1"}
+    upstream = router.upstreams["stage"]
+    assert prpr.idempotency_key(upstream, data, auth("shop-a")) != prpr.idempotency_key(upstream, data, auth("shop-b"))
+
+def test_idempotency_key_needs_external_id(router):
+    assert prpr.idempotency_key(router.upstreams["stage"], {"orgId": "org-1"}, auth("shop")) is None
+
+def test_other_upstream_open_keeps_instance_healthy(router):
+    trip(router.upstreams["prod"])
+    client = prpr.app.test_client()
+
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "degraded"
+    assert response.get_json()["upstream"]["prod"]["receipt"]["state"] == "open"
+
+    assert client.get("/health?upstream=prod").status_code == 503
+    assert client.get("/health?upstream=nowhere").status_code == 404
+
+def test_default_upstream_open_fails_health(router):
+    trip(router.upstreams["stage"])
+    response = prpr.app.test_client().get("/health")
+    assert response.status_code == 503
+    assert response.get_json()["status"] == "unavailable"
+
+def test_worker_timeout_outlasts_slowest_delivery(tmp_path, monkeypatch):
+    table = tmp_path / "upstreams.json"
+    table.write_text(json.dumps({"version": 1, "upstreams": {"stage": {}, "slow": {"read_timeout": 120}}}))
+    monkeypatch.setattr(settings, "UPSTREAMS_PATH", str(table))
+    monkeypatch.setenv("WORKER_TIMEOUT", "60")
+
+    config = runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py"))
+
+    router = routing.Router(settings, ratelimit.make_backend("memory", settings))
+    router.reload(str(table))
+    slowest = max(upstream.delivery_time for upstream in router.upstreams.values())
+    assert slowest == routing.max_delivery_time(settings, str(table))
+    assert slowest > routing.delivery_time(router.upstreams["stage"].options, settings)
+    assert config["timeout"] > slowest
+
+def test_reload_closes_replaced_pools(router, monkeypatch):
+    stage, prod = router.upstreams["stage"], router.upstreams["prod"]
+    closed = []
+    for upstream in (stage, prod):
+        upstream.delivery_time = 0
+        monkeypatch.setattr(upstream.client, "close", lambda name=upstream.name: closed.append(name))
+
+    router.load({"version": 2, "upstreams": {"stage": {}, "msk": {"read_timeout": 1}}})
+
+    deadline = time.monotonic() + 5
+    while not closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert closed == ["prod"]
+    assert router.upstreams["stage"] is stage
+
+def test_async_pools_of_replaced_upstreams_are_closed(router):
+    async def scenario():
+        old = router.upstreams["stage"]
+        old.delivery_time = 0
+        client = asgi.client_for(old)
+        router.load({"version": 2, "upstreams": {"stage": {"read_timeout": 1}}, "default": "stage"})
+        asgi.client_for(router.upstreams["stage"])
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert client.is_closed
+        assert client not in asgi.retired
+        for _, current in asgi.clients.values():
+            await current.aclose()
+        asgi.clients.clear()
+
+    asyncio.run(scenario())
@@ -0,0 +1,106 @@
+import base64
+import json
+import logging
+
+import pytest
+
+import capture
+import converter
+import jsonlib
+import logs
+import prpr
+import settings
+import streaming
+
+AUTH = {"Authorization": "Basic " + base64.b64encode(b"stream-user:secret").decode()}
+
+def receipt(external_id, count):
+    item = {
+        "name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0,
+        "payment_object": 1, "measurement_unit": "шт", "vat": {"type": "vat20", "sum": 0.5},
+    }
+    return json.dumps({
+        "external_id": external_id,
+        "receipt": {
+            "client": {"email": "buyer@example.com"},
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [dict(item, name="Item %d" % i) for i in range(count)],
+            "payments": [{"type": 1, "sum": 3.0 * count}],
+            "total": 3.0 * count,
+        },
+    }).encode()
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(settings, "STREAM_THRESHOLD", 1000)
+    return prpr.app.test_client()
+
+@pytest.fixture
+def records():
+    """Log records of the prpr loggers, which do not propagate to the root logger."""
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger = logging.getLogger("prpr")
+    logger.addHandler(handler)
+    yield records
+    logger.removeHandler(handler)
+
+def delivery_record(records):
+    return next(r for r in records if r.getMessage() in ("Receipt delivered", "Upstream rejected receipt"))
+
+def test_streamed_receipt_logged_with_payload(client, records, monkeypatch):
+    monkeypatch.setattr(logs, "_payload_sample", 1.0)
+    body = receipt("stream-ok", 100)
+    assert len(body) >= settings.STREAM_THRESHOLD
+
+    response = client.post("/process", data=body, content_type="application/json", headers=AUTH)
+
+    assert response.status_code == 200, response.get_json()
+    record = delivery_record(records)
+    assert record.getMessage() == "Receipt delivered"
+    assert record.fields["extern_id"] == "stream-ok"
+    assert record.fields["payload"]["externId"] == "stream-ok"
+    assert record.fields["payload"]["receiptBody"]["clientInfo"]["emailOrPhone"] == logs.REDACTED
+
+def test_streamed_receipt_logged_when_rejected(client, records, stub):
+    # Log in first, so only the receipt call fails
+    prpr.get_token(AUTH["Authorization"])
+    stub.error_rate = 1.0
+    stub.error_status = 422
+
+    response = client.post("/process", data=receipt("stream-rejected", 100),
+                           content_type="application/json", headers=AUTH)
+
+    assert response.status_code == 422
+    assert response.get_json() == {"error": "Stub failure"}
+    record = delivery_record(records)
+    assert record.getMessage() == "Upstream rejected receipt"
+    assert record.fields["status"] == 422
+    assert record.fields["payload"]["externId"] == "stream-rejected"
+    assert record.fields["response"] == {"error": "Stub failure"}
+
+@pytest.mark.parametrize("orgid", [None, "org-1"])
+def test_streamed_body_matches_convert_receipt(orgid):
+    input_data = json.loads(receipt("stream-order", 5))
+    input_data["receipt"]["vats"] = [{"type": "vat20", "sum": 2.5}]
+    data = streaming.StreamedReceipt(1024)
+    for item in input_data["receipt"]["items"]:
+        data.add_item(item)
+    data.update(converter.convert_receipt(dict(input_data, receipt=dict(input_data["receipt"], items=[])), orgid))
+
+    assert b"".join(data.chunks()) == jsonlib.dumps(converter.convert_receipt(input_data, orgid))
+
+def test_streamed_receipt_is_captured(client, monkeypatch):
+    recorded = []
+    shadow = capture.Shadow("converter:convert_receipt", 100, 10)
+    monkeypatch.setattr(shadow, "submit", recorded.append)
+    monkeypatch.setattr(prpr, "shadow", shadow)
+    body = receipt("stream-captured", 100)
+
+    response = client.post("/process", data=body, content_type="application/json", headers=AUTH)
+
+    assert response.status_code == 200, response.get_json()
+    input_data, orgid, output = recorded[0]
+    assert input_data == json.loads(body)
+    assert jsonlib.loads(output) == converter.convert_receipt(input_data, orgid)
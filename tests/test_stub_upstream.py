@@ -0,0 +1,106 @@
+import base64
+import gzip
+import json
+import time
+
+import pytest
+import requests
+
+import stub_upstream
+
+BASIC = "Basic " + base64.b64encode(b"stub-user:secret").decode()
+
+@pytest.fixture(scope="module")
+def running():
+    server = stub_upstream.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def server(running):
+    """A stub server with fresh state for each test."""
+    running.stub = stub_upstream.Stub(token_ttl=0.2, orgid="org-under-test")
+    return running
+
+def url(server, path):
+    return "http://127.0.0.1:%d%s" % (server.server_port, path)
+
+def login(server):
+    response = requests.get(url(server, stub_upstream.LOGIN_PATH), headers={"Authorization": BASIC})
+    assert response.status_code == 200
+    return response.json()
+
+def send(server, body, token, **headers):
+    headers["Authorization"] = "Bearer " + token
+    return requests.post(url(server, stub_upstream.RECEIPT_PATH), data=body, headers=headers)
+
+def test_latency_distributions():
+    assert stub_upstream.latency("0.05")() == 0.05
+    assert stub_upstream.latency(0)() == 0
+    assert all(0.1 <= stub_upstream.latency("uniform:0.1:0.2")() <= 0.2 for _ in range(100))
+    assert all(stub_upstream.latency("normal:0:1")() >= 0 for _ in range(100))
+    assert all(stub_upstream.latency("lognormal:0.08:0.5")() > 0 for _ in range(100))
+    assert all(stub_upstream.latency("exp:0.01")() >= 0 for _ in range(100))
+
+@pytest.mark.parametrize("spec", ["pareto:1:2", "uniform:1", "fast"])
+def test_bad_latency_spec(spec):
+    with pytest.raises(ValueError):
+        stub_upstream.latency(spec)
+
+def test_login_and_receipt(server):
+    session = login(server)
+    receipt = json.dumps({"receiptBody": {"externId": "stub-1"}})
+
+    response = send(server, receipt, session["token"])
+
+    assert session["orgId"] == "org-under-test"
+    assert response.status_code == 200
+    assert response.json()["status"] == "wait"
+
+def test_login_needs_basic_auth(server):
+    response = requests.get(url(server, stub_upstream.LOGIN_PATH), headers={"Authorization": "Bearer x"})
+
+    assert response.status_code == 401
+
+def test_token_expires_after_ttl(server):
+    token = login(server)["token"]
+    receipt = json.dumps({"receiptBody": {}})
+
+    assert send(server, receipt, token).status_code == 200
+    time.sleep(0.25)
+    assert send(server, receipt, token).json() == {"error": "Token expired"}
+    assert send(server, receipt, "made-up").status_code == 401
+
+@pytest.mark.parametrize("body, error", [
+    (b"{broken", "Invalid JSON"),
+    (b"[]", "receiptBody is required"),
+    (b'{"receiptBody": []}', "receiptBody is required"),
+])
+def test_malformed_receipts(server, body, error):
+    response = send(server, body, login(server)["token"])
+
+    assert (response.status_code, response.json()) == (400, {"error": error})
+
+def test_compressed_and_chunked_bodies(server):
+    token = login(server)["token"]
+    receipt = json.dumps({"receiptBody": {"externId": "stub-gzip"}}).encode()
+
+    compressed = send(server, gzip.compress(receipt), token, **{"Content-Encoding": "gzip"})
+    chunked = send(server, iter([receipt[:10], receipt[10:]]), token)
+
+    assert compressed.status_code == chunked.status_code == 200
+
+def test_failures_and_stats(server):
+    server.stub.error_rate = 1.0
+    server.stub.error_status = 502
+    failed = requests.get(url(server, stub_upstream.LOGIN_PATH), headers={"Authorization": BASIC})
+    server.stub.error_page = True
+    page = requests.get(url(server, stub_upstream.LOGIN_PATH), headers={"Authorization": BASIC})
+    requests.get(url(server, "/elsewhere"))
+
+    stats = requests.get(url(server, "/stats")).json()
+
+    assert (failed.status_code, failed.json()) == (502, {"error": "Stub failure"})
+    assert (page.status_code, page.headers["Content-Type"]) == (502, "text/html")
+    assert stats == {"login 502": 2, "other 404": 1}
@@ -0,0 +1,160 @@
+import asyncio
+import base64
+import threading
+import time
+
+import pytest
+
+import prpr
+import token_cache
+from token_cache import LoginError, TokenCache
+
+RECEIPT = {
+    "external_id": "token-refresh-1",
+    "receipt": {
+        "company": {"sno": "osn", "inn": "7700000000"},
+        "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+        "payments": [{"type": 1, "sum": 3.0}],
+        "total": 3.0,
+    },
+}
+
+class Interrupted(BaseException):
+    """Stands in for a killed greenlet or a KeyboardInterrupt."""
+
+def test_interrupted_login_is_taken_over():
+    cache = TokenCache(60, 10)
+    calls = []
+
+    def login():
+        calls.append(1)
+        if len(calls) == 1:
+            while not cache.stats["shared"]:
+                time.sleep(0.001)
+            raise Interrupted()
+        return "token", "org"
+
+    interrupted = []
+
+    def leader():
+        try:
+            cache.get("key", login)
+        except Interrupted:
+            interrupted.append(True)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    while not calls:
+        time.sleep(0.001)
+
+    assert cache.get("key", login) == ("token", "org")
+    thread.join()
+    assert interrupted == [True]
+    assert len(calls) == 2
+
+def test_cancelled_async_login_is_taken_over():
+    async def scenario():
+        cache = TokenCache(60, 10)
+        calls = []
+        started = asyncio.Event()
+
+        async def login():
+            calls.append(1)
+            if len(calls) == 1:
+                started.set()
+                await asyncio.sleep(10)
+            return "token", "org"
+
+        leader = asyncio.create_task(cache.aget("key", login))
+        await started.wait()
+        follower = asyncio.create_task(cache.aget("key", login))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        assert await follower == ("token", "org")
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+def test_concurrent_misses_share_one_login():
+    cache = TokenCache(60, 10)
+    calls = []
+    release = threading.Event()
+
+    def login():
+        calls.append(1)
+        release.wait(5)
+        return "token", "org"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("key", login))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while cache.stats["miss"] + cache.stats["shared"] < 8:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == [("token", "org")] * 8
+    assert cache.stats == {"hit": 0, "miss": 1, "shared": 7}
+
+def test_failed_login_is_not_cached():
+    cache = TokenCache(60, 10)
+
+    def fail():
+        raise LoginError({"error": "Invalid credentials"}, 401)
+
+    with pytest.raises(LoginError):
+        cache.get("key", fail)
+    assert cache.get("key", lambda: ("token", "org")) == ("token", "org")
+
+def test_token_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(token_cache.time, "monotonic", lambda: now[0])
+    cache = TokenCache(60, 10)
+    tokens = iter(["first", "second"])
+
+    def login():
+        return next(tokens), "org"
+
+    assert cache.get("key", login) == ("first", "org")
+    now[0] += 59
+    assert cache.get("key", login) == ("first", "org")
+    now[0] += 1
+    assert cache.get("key", login) == ("second", "org")
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TokenCache(60, 2)
+    cache.get("a", lambda: ("token-a", "org"))
+    cache.get("b", lambda: ("token-b", "org"))
+    cache.get("a", lambda: ("unused", "org"))
+    cache.get("c", lambda: ("token-c", "org"))
+
+    assert cache.get("a", lambda: ("new-a", "org")) == ("token-a", "org")
+    assert cache.get("b", lambda: ("new-b", "org")) == ("new-b", "org")
+
+def test_invalidate_drops_only_the_rejected_token():
+    cache = TokenCache(60, 10)
+    cache.get("key", lambda: ("fresh", "org"))
+
+    cache.invalidate("key", "stale")
+    assert cache.get("key", lambda: ("other", "org")) == ("fresh", "org")
+    cache.invalidate("key", "fresh")
+    assert cache.get("key", lambda: ("other", "org")) == ("other", "org")
+
+def test_expired_upstream_token_is_refreshed_once(stub):
+    auth = "Basic " + base64.b64encode(b"token-refresh-user:secret").decode()
+    key = prpr.token_key(prpr.route(auth), auth)
+    # A token the upstream no longer accepts, still within our TTL
+    prpr.token_cache.get(key, lambda: ("expired-upstream", "stub-org"))
+    logins = stub.snapshot().get("login 200", 0)
+
+    response = prpr.app.test_client().post("/process", json=RECEIPT, headers={"Authorization": auth})
+
+    assert response.status_code == 200, response.get_json()
+    assert stub.snapshot().get("login 200", 0) == logins + 1
+    assert prpr.token_cache.get(key, lambda: ("unused", None))[0] != "expired-upstream"
@@ -0,0 +1,43 @@
+import threading
+
+from upstream import UpstreamClient
+
+def test_sessions_are_per_thread_and_share_one_pool(stub_url):
+    client = UpstreamClient(stub_url)
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.append(client.session)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+
+    assert client.session is client.session
+    assert sessions[0] is not sessions[1]
+    assert sessions[0].get_adapter(stub_url) is sessions[1].get_adapter(stub_url)
+
+def test_connection_is_kept_alive(stub_url):
+    client = UpstreamClient(stub_url)
+    for _ in range(3):
+        assert client.get(client.url("/stats")).status_code == 200
+
+    pools = [client._adapter.poolmanager.pools[key] for key in client._adapter.poolmanager.pools.keys()]
+    assert [pool.num_connections for pool in pools] == [1]
+
+def test_login_retried_on_unavailable_upstream(stub, stub_url):
+    stub.error_rate = 1.0
+    client = UpstreamClient(stub_url, retries=2, backoff=0)
+    before = stub.snapshot().get("login 503", 0)
+
+    response = client.get(client.url("/api/atol/login"), headers={"Authorization": "Basic eDp5"})
+
+    assert response.status_code == 503
+    assert stub.snapshot().get("login 503", 0) - before == 3
+
+def test_receipt_post_is_never_resent(stub, stub_url):
+    stub.error_rate = 1.0
+    client = UpstreamClient(stub_url, retries=2, backoff=0)
+    before = stub.snapshot().get("receipt 503", 0)
+
+    response = client.post(client.url("/api/receipt"), json={"receiptBody": {}})
+
+    assert response.status_code == 503
+    assert stub.snapshot().get("receipt 503", 0) - before == 1
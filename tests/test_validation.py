@@ -0,0 +1,111 @@
+import base64
+
+import pytest
+from starlette.testclient import TestClient
+
+import asgi
+import prpr
+import validation
+
+AUTH = {"Authorization": "Basic " + base64.b64encode(b"validation-user:secret").decode()}
+
+@pytest.mark.parametrize("body", [[], ["receipt"], "receipt", 1])
+def test_body_that_is_not_an_object_without_validation(monkeypatch, body):
+    monkeypatch.setattr(prpr, "receipt_validator", None)
+
+    flask = prpr.app.test_client().post("/process", json=body, headers=AUTH)
+    with TestClient(asgi.app) as client:
+        starlette = client.post("/process", json=body, headers=AUTH)
+
+    assert (flask.status_code, flask.get_json()) == (400, {"error": "Body should be a JSON object"})
+    assert (starlette.status_code, starlette.json()) == (400, {"error": "Body should be a JSON object"})
+
+SCHEMA = {
+    "type": "object",
+    "required": ["name", "items"],
+    "properties": {
+        "name": {"type": "string"},
+        "total": {"type": "number"},
+        "items": {"type": "array", "items": {
+            "type": "object",
+            "required": ["price"],
+            "properties": {"price": {"type": "number"}, "quantity": {"type": "integer"}},
+        }},
+    },
+}
+
+def receipt(**fields):
+    body = {
+        "external_id": "validation-1",
+        "receipt": {
+            "company": {"sno": "osn", "inn": "7700000000"},
+            "items": [{"name": "Item", "price": 1.5, "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}],
+            "payments": [{"type": 1, "sum": 3.0}],
+            "total": 3.0,
+        },
+    }
+    body["receipt"].update(fields)
+    return body
+
+def test_type_errors_name_the_field():
+    validate = validation.compile_schema(SCHEMA)
+
+    assert validate({"name": 1, "total": True, "items": [{"price": 1}, {"price": "1", "quantity": 1.5}]}) == [
+        {"field": "name", "error": "should be string"},
+        {"field": "total", "error": "should be number"},
+        {"field": "items[1].price", "error": "should be number"},
+        {"field": "items[1].quantity", "error": "should be integer"},
+    ]
+
+def test_lenient_treats_null_as_absent_and_allows_unknown_fields():
+    validate = validation.compile_schema(SCHEMA)
+
+    assert validate({"name": "x", "items": [], "total": None, "extra": 1}) == []
+    assert validate({"name": None, "items": [{"price": None}]}) == [
+        {"field": "name", "error": "is required"},
+        {"field": "items[0].price", "error": "is required"},
+    ]
+
+def test_strict_rejects_nulls_and_unknown_fields():
+    validate = validation.compile_schema(SCHEMA, strict=True)
+
+    assert validate({"name": None, "items": [{"price": 1, "extra": 1}], "total": None}) == [
+        {"field": "name", "error": "should not be null"},
+        {"field": "items[0].extra", "error": "is not allowed"},
+        {"field": "total", "error": "should not be null"},
+    ]
+
+def test_validation_modes():
+    assert validation.from_schema(SCHEMA, "off") is None
+    with pytest.raises(ValueError):
+        validation.from_schema(SCHEMA, "loose")
+
+@pytest.mark.parametrize("mode, body, status", [
+    ("lenient", receipt(extra="kept"), 200),
+    ("lenient", receipt(total=None), 200),
+    ("strict", receipt(extra="kept"), 422),
+    ("strict", receipt(total=None), 422),
+    ("strict", receipt(), 200),
+])
+def test_modes_on_process(monkeypatch, stub, mode, body, status):
+    monkeypatch.setattr(prpr, "receipt_validator", validation.from_schema(prpr.receipt_schema, mode))
+
+    flask = prpr.app.test_client().post("/process", json=body, headers=AUTH)
+    with TestClient(asgi.app) as client:
+        starlette = client.post("/process", json=body, headers=AUTH)
+
+    assert flask.status_code == starlette.status_code == status
+
+def test_invalid_receipt_is_not_sent_upstream(stub):
+    sent = stub.snapshot().get("receipt 200", 0)
+    body = receipt(items=[{"name": "Item", "price": "1.5", "quantity": 2, "sum": 3.0, "vat": {"type": "vat20"}}])
+
+    flask = prpr.app.test_client().post("/process", json=body, headers=AUTH)
+    with TestClient(asgi.app) as client:
+        starlette = client.post("/process", json=body, headers=AUTH)
+
+    expected = {"error": "Receipt validation failed",
+                "errors": [{"field": "receipt.items[0].price", "error": "should be number"}]}
+    assert (flask.status_code, flask.get_json()) == (422, expected)
+    assert (starlette.status_code, starlette.json()) == (422, expected)
+    assert stub.snapshot().get("receipt 200", 0) == sent
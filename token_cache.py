@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class LoginError(Exception):
+    """Login to the upstream failed; carries the response to hand back to the client."""
+
+    def __init__(self, body, status_code):
+        super().__init__(status_code)
+        self.body = body
+        self.status_code = status_code
+
+
+class _Abandoned(Exception):
+    """The leading call was interrupted; a waiting caller takes over."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        if self.result is None:
+            raise _Abandoned()
+        return self.result
+
+
+class TokenCache:
+    """LRU cache of (token, orgId) per credential key with a TTL.
+
+    Concurrent misses for the same key share a single login call. If that
+    call is interrupted (a cancelled task, a killed greenlet), one of the
+    callers waiting for it logs in instead.
+    """
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._async_inflight = {}
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "miss": 0, "shared": 0}
+
+    def get(self, key, login):
+        while True:
+            with self._lock:
+                cached = self._lookup(key)
+                if cached is not None:
+                    self.stats["hit"] += 1
+                    return cached
+                call = self._inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = self._inflight[key] = _Call()
+                self.stats["miss" if leader else "shared"] += 1
+            if leader:
+                break
+            try:
+                return call.wait()
+            except _Abandoned:
+                continue
+
+        try:
+            call.result = login()
+        except Exception as exc:
+            call.error = exc
+            raise
+        else:
+            self._store(key, *call.result)
+            return call.result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+
+    async def aget(self, key, login):
+        """Coroutine flavour of get() for the ASGI app; login is an async callable."""
+        while True:
+            with self._lock:
+                cached = self._lookup(key)
+                future = self._async_inflight.get(key)
+                if cached is not None:
+                    self.stats["hit"] += 1
+                else:
+                    self.stats["miss" if future is None else "shared"] += 1
+            if cached is not None:
+                return cached
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except _Abandoned:
+                continue
+
+        future = self._async_inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await login()
+        except Exception as exc:
+            future.set_exception(exc)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        except BaseException:
+            # Cancelled, e.g. the client went away; must not cancel the others
+            future.set_exception(_Abandoned())
+            future.exception()
+            raise
+        else:
+            self._store(key, *result)
+            future.set_result(result)
+            return result
+        finally:
+            del self._async_inflight[key]
+
+    def invalidate(self, key, token):
+        # Only drop the entry if it still holds the rejected token, so that
+        # several requests failing with the same token trigger one refresh.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == token:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, token, orgid = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return token, orgid
+
+    def _store(self, key, token, orgid):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, token, orgid)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
@@ -0,0 +1,58 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class InvalidResponse(requests.RequestException):
+    """The upstream answered with a body that is not JSON, such as the HTML
+    error page of a proxy in front of it."""
+
+
+class UpstreamClient:
+    """Keep-alive HTTP client for the vdpaybox API.
+
+    Every thread gets its own ``requests.Session`` but they all share one
+    adapter, so connections are pooled process-wide. Connection failures are
+    retried for any method; read failures and 502/503/504 only for idempotent
+    ones, so a receipt POST is never sent twice.
+    """
+
+    def __init__(self, base_url, pool_size=32, connect_timeout=3.05, read_timeout=30,
+                 retries=2, backoff=0.2):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self._local = threading.local()
+
+    def url(self, path):
+        return self.base_url + path
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        self._adapter.close()
@@ -0,0 +1,103 @@
+import inspect
+
+
+# Validator compiled from the Swagger schema in the process() docstring.
+#
+# lenient: present fields must have the documented type, required fields must
+#          be present; null counts as absent and unknown fields are allowed.
+# strict:  additionally rejects unknown fields and nulls.
+
+def _type_check(expected):
+    if expected == "string":
+        return lambda v: isinstance(v, str)
+    if expected == "integer":
+        return lambda v: isinstance(v, int) and not isinstance(v, bool)
+    if expected == "number":
+        return lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)
+    if expected == "boolean":
+        return lambda v: isinstance(v, bool)
+    if expected == "object":
+        return lambda v: isinstance(v, dict)
+    if expected == "array":
+        return lambda v: isinstance(v, list)
+    return None
+
+def _compile(schema, strict):
+    expected = schema.get("type")
+    check = _type_check(expected)
+    properties = {
+        name: _compile(sub, strict) for name, sub in (schema.get("properties") or {}).items()
+    }
+    required = tuple(schema.get("required") or ())
+    items = _compile(schema["items"], strict) if "items" in schema else None
+    type_error = "should be %s" % expected
+
+    def validate(value, path, errors):
+        if value is None:
+            if strict:
+                errors.append({"field": path or "$", "error": "should not be null"})
+            return
+        if check is not None and not check(value):
+            errors.append({"field": path or "$", "error": type_error})
+            return
+        if expected == "object" or properties:
+            if not isinstance(value, dict):
+                return
+            prefix = path + "." if path else ""
+            for name in required:
+                # In strict mode a null is reported by the field's own check
+                if (name not in value) if strict else (value.get(name) is None):
+                    errors.append({"field": prefix + name, "error": "is required"})
+            for name, field in value.items():
+                sub = properties.get(name)
+                if sub is not None:
+                    sub(field, prefix + name, errors)
+                elif strict and properties:
+                    errors.append({"field": prefix + name, "error": "is not allowed"})
+        elif items is not None and isinstance(value, list):
+            for index, item in enumerate(value):
+                items(item, "%s[%d]" % (path, index), errors)
+
+    return validate
+
+def compile_schema(schema, strict=False):
+    """Compile a Swagger/JSON schema into validate(value) -> list of errors."""
+    validate = _compile(schema, strict)
+
+    def run(value, path=""):
+        errors = []
+        validate(value, path, errors)
+        return errors
+
+    return run
+
+def body_schema(docstring):
+    """The schema of the body parameter in a flasgger docstring."""
+    # Imported here so that SWAGGER=static workers never load it
+    import yaml
+    spec = yaml.safe_load(inspect.cleandoc(docstring).split("---", 1)[1])
+    for parameter in spec.get("parameters") or ():
+        if parameter.get("in") == "body":
+            return parameter["schema"]
+    raise ValueError("No body parameter in docstring")
+
+def spec_body_schema(spec, path, method):
+    """The schema of the body parameter of an operation in a built Swagger spec."""
+    for parameter in spec["paths"][path][method].get("parameters") or ():
+        if parameter.get("in") == "body":
+            schema = parameter["schema"]
+            ref = schema.get("$ref", "")
+            if ref.startswith("#/definitions/"):
+                schema = spec["definitions"][ref[len("#/definitions/"):]]
+            return schema
+    raise ValueError("No body parameter for %s %s" % (method.upper(), path))
+
+def from_schema(schema, mode):
+    if mode == 'off':
+        return None
+    if mode not in ('lenient', 'strict'):
+        raise ValueError("Unknown validation mode: %s" % mode)
+    return compile_schema(schema, strict=mode == 'strict')
+
+def from_docstring(docstring, mode):
+    return from_schema(body_schema(docstring), mode)